@@ -1,13 +1,17 @@
 """
 Create sample completed trips for today to test revenue analytics
+
+    python add_today_trips.py --count 50000 --seed 7
 """
 
+import argparse
 import asyncio
 import random
 from datetime import datetime, timezone, timedelta
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 from dotenv import load_dotenv
+from loadgen import insert_batches
 
 load_dotenv()
 
@@ -16,39 +20,39 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
-async def create_completed_trips_today():
-    """Create 10 completed trips for today"""
-    print("🚕 Creating 10 completed trips for today...")
-    
-    # Get existing drivers and passengers
-    drivers = await db.users.find({"role": "driver", "is_active": True}, {"_id": 0}).to_list(20)
-    passengers = await db.users.find({"role": "passenger"}, {"_id": 0}).to_list(20)
-    
-    if not drivers or not passengers:
-        print("❌ No drivers or passengers found!")
-        return
-    
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Add completed trips for today")
+    parser.add_argument("--count", type=int, default=10, help="number of trips (default: 10)")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for reproducible trips")
+    parser.add_argument("--sample-users", type=int, default=1000,
+                        help="drivers/passengers loaded to pick from (default: 1000)")
+    parser.add_argument("--batch-size", type=int, default=5000, help="documents per insert_many (default: 5000)")
+    parser.add_argument("--concurrency", type=int, default=4, help="insert_many calls in flight (default: 4)")
+    return parser.parse_args(argv)
+
+def generate_trips(rng, drivers, passengers, count, batch_size):
+    """Yield batches of completed trips spread over the last 12 hours"""
     today = datetime.now(timezone.utc)
+    run_tag = rng.randint(1000, 9999)
     trips = []
     
-    for i in range(10):
-        driver = random.choice(drivers)
-        passenger = random.choice(passengers)
+    for i in range(count):
+        driver = rng.choice(drivers)
+        passenger = rng.choice(passengers)
         
         # Random time today
-        hours_ago = random.randint(1, 12)
-        created_at = today - timedelta(hours=hours_ago)
-        accepted_at = created_at + timedelta(minutes=random.randint(1, 3))
-        started_at = accepted_at + timedelta(minutes=random.randint(3, 8))
-        completed_at = started_at + timedelta(minutes=random.randint(10, 45))
+        created_at = today - timedelta(seconds=rng.randint(3600, 12 * 3600))
+        accepted_at = created_at + timedelta(minutes=rng.randint(1, 3))
+        started_at = accepted_at + timedelta(minutes=rng.randint(3, 8))
+        completed_at = started_at + timedelta(minutes=rng.randint(10, 45))
         
-        distance_km = random.uniform(3, 18)
+        distance_km = rng.uniform(3, 18)
         base_fare = 5000
         per_km = 3000
         price = base_fare + (distance_km * per_km)
         
         trip = {
-            "id": f"trip_today_{i+1}_{random.randint(1000, 9999)}",
+            "id": f"trip_today_{i+1}_{run_tag}",
             "passenger_id": passenger["id"],
             "passenger_name": passenger["name"],
             "passenger_phone": passenger["phone"],
@@ -57,14 +61,14 @@ async def create_completed_trips_today():
             "driver_phone": driver["phone"],
             "driver_car_model": driver.get("car_model", "پژو 206"),
             "origin": {
-                "lat": 35.6892 + random.uniform(-0.05, 0.05),
-                "lng": 51.3890 + random.uniform(-0.05, 0.05),
-                "address": f"خیابان {random.choice(['ولیعصر', 'انقلاب', 'آزادی', 'ستارخان'])}"
+                "lat": 35.6892 + rng.uniform(-0.05, 0.05),
+                "lng": 51.3890 + rng.uniform(-0.05, 0.05),
+                "address": f"خیابان {rng.choice(['ولیعصر', 'انقلاب', 'آزادی', 'ستارخان'])}"
             },
             "destination": {
-                "lat": 35.6892 + random.uniform(-0.05, 0.05),
-                "lng": 51.3890 + random.uniform(-0.05, 0.05),
-                "address": f"میدان {random.choice(['تجریش', 'رسالت', 'قدس', 'شهدا'])}"
+                "lat": 35.6892 + rng.uniform(-0.05, 0.05),
+                "lng": 51.3890 + rng.uniform(-0.05, 0.05),
+                "address": f"میدان {rng.choice(['تجریش', 'رسالت', 'قدس', 'شهدا'])}"
             },
             "price": round(price, 0),
             "status": "completed",
@@ -76,18 +80,48 @@ async def create_completed_trips_today():
             "completed_at": completed_at.isoformat()
         }
         trips.append(trip)
+        if len(trips) >= batch_size:
+            yield trips
+            trips = []
+    if trips:
+        yield trips
+
+async def create_completed_trips_today(args):
+    """Create completed trips for today"""
+    print(f"🚕 Creating {args.count:,} completed trips for today...")
+    rng = random.Random(args.seed)
+    
+    # Get existing drivers and passengers (sorted so a seed picks the same users every run)
+    user_fields = {"_id": 0, "id": 1, "name": 1, "phone": 1, "car_model": 1}
+    drivers = await db.users.find(
+        {"role": "driver", "is_active": True}, user_fields
+    ).sort("id", 1).limit(args.sample_users).to_list(args.sample_users)
+    passengers = await db.users.find(
+        {"role": "passenger"}, user_fields
+    ).sort("id", 1).limit(args.sample_users).to_list(args.sample_users)
+    
+    if not drivers or not passengers:
+        print("❌ No drivers or passengers found!")
+        return
+    
+    total_revenue = 0
+    
+    def batches():
+        nonlocal total_revenue
+        for batch in generate_trips(rng, drivers, passengers, args.count, args.batch_size):
+            total_revenue += sum(trip["price"] for trip in batch)
+            yield batch
     
     # Insert trips
-    result = await db.trips.insert_many(trips)
-    print(f"✅ Created {len(result.inserted_ids)} completed trips for today")
+    inserted = await insert_batches(db.trips, batches(), args.concurrency)
+    print(f"✅ Created {inserted:,} completed trips for today")
     
     # Calculate total revenue
-    total_revenue = sum(trip["price"] for trip in trips)
     print(f"💰 Total revenue from today's trips: {total_revenue:,.0f} تومان")
 
-async def main():
+async def main(argv=None):
     try:
-        await create_completed_trips_today()
+        await create_completed_trips_today(parse_args(argv))
     finally:
         client.close()
 
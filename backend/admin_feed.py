@@ -0,0 +1,184 @@
+"""
+Live Admin Dashboard Feed
+فید زنده داشبورد مدیریت
+
+One change-stream consumer per worker turns trip and driver changes into small
+deltas on the /admin Socket.IO namespace, so dashboard load does not grow with
+the number of open admin tabs. Clients load a snapshot once (realtime-stats)
+and apply the deltas. Revenue is counted when a completed trip's final fare is
+written, not at completion, since the fare can change then. On a standalone mongod, where change streams are
+unavailable, the API publishes the same events in-process instead.
+"""
+
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+ADMIN_NAMESPACE = "/admin"
+
+# Change streams need a replica set or sharded cluster
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+TRIP_PROJECTION = {
+    "operationType": 1,
+    "updateDescription.updatedFields.status": 1,
+    "updateDescription.updatedFields.fare_source": 1,
+    "fullDocument.id": 1,
+    "fullDocument.status": 1,
+    "fullDocument.price": 1,
+    "fullDocument.driver_id": 1,
+    "fullDocument.passenger_id": 1,
+    "fullDocument.accepted_at": 1,
+    "fullDocument.started_at": 1,
+    "fullDocument.completed_at": 1,
+    "fullDocument.fare_source": 1,
+}
+
+DRIVER_PROJECTION = {
+    "operationType": 1,
+    "fullDocument.id": 1,
+    "fullDocument.role": 1,
+    "fullDocument.is_active": 1,
+    "fullDocument.name": 1,
+}
+
+
+def previous_trip_status(trip: Dict[str, Any]) -> Optional[str]:
+    """
+    Status a trip had before its latest transition, derived from its timestamps.
+    The state machine only moves forward, so the timestamps tell where it came from.
+    """
+    status = trip.get("status")
+    if status == "pending":
+        return None
+    if status == "accepted":
+        return "pending"
+    if status == "in_progress":
+        return "accepted"
+    if status == "completed":
+        return "in_progress"
+    # cancelled: from whichever stage it had reached
+    if trip.get("started_at"):
+        return "in_progress"
+    if trip.get("accepted_at"):
+        return "accepted"
+    return "pending"
+
+
+class AdminFeed:
+    def __init__(self, db, sio, namespace: str = ADMIN_NAMESPACE):
+        self.db = db
+        self.sio = sio
+        self.namespace = namespace
+        self.change_stream_active = False
+        self._tasks = []
+
+    async def publish_trip_change(self, trip: Dict[str, Any], created: bool = False):
+        """Emit trip_status and the matching stats_delta for one trip change"""
+        status = trip.get("status")
+        previous = None if created else previous_trip_status(trip)
+        if previous == status:
+            return
+
+        by_status = {status: 1}
+        if previous:
+            by_status[previous] = -1
+        delta: Dict[str, Any] = {"trips_by_status": by_status}
+
+        await self.sio.emit("trip_status", {
+            "trip_id": trip.get("id"),
+            "status": status,
+            "previous_status": previous,
+            "driver_id": trip.get("driver_id"),
+            "price": trip.get("price"),
+        }, namespace=self.namespace)
+        await self.sio.emit("stats_delta", delta, namespace=self.namespace)
+
+    async def publish_trip_fare(self, trip: Dict[str, Any]):
+        """Emit the final fare of a completed trip and add it to the revenue"""
+        await self.sio.emit("trip_fare", {
+            "trip_id": trip.get("id"),
+            "price": trip.get("price"),
+            "fare_source": trip.get("fare_source"),
+        }, namespace=self.namespace)
+        await self.sio.emit("stats_delta", {"revenue": trip.get("price", 0)}, namespace=self.namespace)
+
+    async def publish_driver_change(self, driver: Dict[str, Any]):
+        """Emit driver_status when a driver goes online (active) or offline"""
+        is_active = bool(driver.get("is_active"))
+        await self.sio.emit("driver_status", {
+            "driver_id": driver.get("id"),
+            "name": driver.get("name"),
+            "online": is_active,
+        }, namespace=self.namespace)
+        await self.sio.emit("stats_delta", {"active_drivers": 1 if is_active else -1}, namespace=self.namespace)
+
+    async def _consume(self, collection, pipeline, handler):
+        resume_token = None
+        while True:
+            try:
+                async with collection.watch(
+                    pipeline,
+                    full_document="updateLookup",
+                    resume_after=resume_token
+                ) as stream:
+                    self.change_stream_active = True
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        if change.get("fullDocument"):
+                            await handler(change)
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                    logger.warning("Change streams unavailable; admin feed falls back to in-process events")
+                    self.change_stream_active = False
+                    return
+                logger.error(f"Admin feed change stream failed on {collection.name}: {e}")
+                resume_token = None
+            except PyMongoError as e:
+                logger.error(f"Admin feed change stream interrupted on {collection.name}: {e}")
+            await asyncio.sleep(1)
+
+    async def _handle_trip(self, change):
+        trip = change["fullDocument"]
+        updated = change.get("updateDescription", {}).get("updatedFields", {})
+        if change["operationType"] == "insert" or "status" in updated:
+            await self.publish_trip_change(trip, created=change["operationType"] == "insert")
+        if "fare_source" in updated and trip.get("status") == "completed":
+            await self.publish_trip_fare(trip)
+
+    async def _handle_driver(self, change):
+        driver = change["fullDocument"]
+        if driver.get("role") == "driver":
+            await self.publish_driver_change(driver)
+
+    def start(self):
+        if self._tasks:
+            return
+        trip_pipeline = [
+            {"$match": {"$or": [
+                {"operationType": "insert"},
+                {"operationType": "update", "updateDescription.updatedFields.status": {"$exists": True}},
+                {"operationType": "update", "updateDescription.updatedFields.fare_source": {"$exists": True}},
+            ]}},
+            {"$project": TRIP_PROJECTION},
+        ]
+        driver_pipeline = [
+            {"$match": {
+                "operationType": "update",
+                "updateDescription.updatedFields.is_active": {"$exists": True},
+            }},
+            {"$project": DRIVER_PROJECTION},
+        ]
+        self._tasks = [
+            asyncio.create_task(self._consume(self.db.trips, trip_pipeline, self._handle_trip)),
+            asyncio.create_task(self._consume(self.db.users, driver_pipeline, self._handle_driver)),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
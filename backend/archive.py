@@ -0,0 +1,149 @@
+"""
+Trip Archive (hot/cold tiering)
+بایگانی سفرهای قدیمی
+
+Completed and cancelled trips older than the retention window are moved from
+`trips` into `trips_archive`, so the hot collection (and its indexes) only
+holds recent and active trips. History reads go through find_trips /
+count_trips, which query both tiers and merge the results.
+
+Moves are copy-then-delete with upserts keyed on _id, so an interrupted run is
+simply repeated by the next one; several workers may run it concurrently.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from pymongo import ReplaceOne
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_COLLECTION = "trips_archive"
+ARCHIVABLE_STATUSES = ["completed", "cancelled"]
+
+
+async def find_trips(
+    db,
+    query: Dict[str, Any],
+    projection: Optional[Dict[str, Any]] = None,
+    sort_field: str = "created_at",
+    descending: bool = True,
+    limit: int = 1000
+) -> List[Dict[str, Any]]:
+    """Trips matching `query` from the hot and archive tiers, sorted and limited as one list"""
+    direction = -1 if descending else 1
+    # `id` is needed to merge the tiers
+    projection = {"_id": 0, "id": 1, **projection} if projection else {"_id": 0}
+    hot, cold = await asyncio.gather(
+        db.trips.find(query, projection).sort(sort_field, direction).limit(limit).to_list(limit),
+        db[ARCHIVE_COLLECTION].find(query, projection).sort(sort_field, direction).limit(limit).to_list(limit),
+    )
+    if not cold:
+        return hot
+
+    # A trip caught mid-move can briefly exist in both tiers
+    merged = {trip.get("id"): trip for trip in cold}
+    merged.update({trip.get("id"): trip for trip in hot})
+    trips = sorted(merged.values(), key=lambda t: t.get(sort_field) or "", reverse=descending)
+    return trips[:limit]
+
+
+async def count_trips(db, query: Dict[str, Any]) -> int:
+    hot, cold = await asyncio.gather(
+        db.trips.count_documents(query),
+        db[ARCHIVE_COLLECTION].count_documents(query),
+    )
+    return hot + cold
+
+
+async def chain_cursors(*cursors) -> AsyncIterator[Dict[str, Any]]:
+    """Iterate several cursors one after another (e.g. archive, then hot)"""
+    for cursor in cursors:
+        async for doc in cursor:
+            yield doc
+
+
+class TripArchiver:
+    """Periodically moves old finished trips into the archive collection"""
+
+    def __init__(self, db, archive_after_days: int, interval_seconds: float = 3600, batch_size: int = 1000):
+        self.db = db
+        self.archive_after_days = archive_after_days
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "runs": 0,
+            "archived_total": 0,
+            "last_archived": 0,
+            "last_run_at": None,
+            "last_run_ms": 0.0,
+            "archive_after_days": archive_after_days,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.archive_after_days > 0
+
+    def cutoff(self) -> str:
+        return (datetime.now(timezone.utc) - timedelta(days=self.archive_after_days)).isoformat()
+
+    async def _move_batch(self, cutoff: str) -> int:
+        trips = await self.db.trips.find({
+            "status": {"$in": ARCHIVABLE_STATUSES},
+            "created_at": {"$lt": cutoff},
+        }).limit(self.batch_size).to_list(self.batch_size)
+        if not trips:
+            return 0
+
+        await self.db[ARCHIVE_COLLECTION].bulk_write(
+            [ReplaceOne({"_id": trip["_id"]}, trip, upsert=True) for trip in trips],
+            ordered=False
+        )
+        # Re-check the status so nothing that changed meanwhile is dropped from the hot tier
+        result = await self.db.trips.delete_many({
+            "_id": {"$in": [trip["_id"] for trip in trips]},
+            "status": {"$in": ARCHIVABLE_STATUSES},
+        })
+        return result.deleted_count
+
+    async def run_once(self) -> int:
+        """Archive everything past the cutoff; returns the number of trips moved"""
+        started = time.perf_counter()
+        cutoff = self.cutoff()
+        archived = 0
+        while True:
+            moved = await self._move_batch(cutoff)
+            archived += moved
+            if moved < self.batch_size:
+                break
+
+        stats = self.stats
+        stats["runs"] += 1
+        stats["archived_total"] += archived
+        stats["last_archived"] = archived
+        stats["last_run_at"] = datetime.now(timezone.utc).isoformat()
+        stats["last_run_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        if archived:
+            logger.info(f"Archived {archived} trips created before {cutoff}")
+        return archived
+
+    async def _run_forever(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Trip archive run failed: {e}")
+            await asyncio.sleep(self.interval_seconds)
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
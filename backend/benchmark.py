@@ -0,0 +1,441 @@
+"""
+Snabb API Benchmark
+بنچمارک مسیرهای پرترافیک API و Socket.IO
+
+Seeds a dedicated MongoDB database with synthetic data (see loadgen.py), runs
+the FastAPI app in-process and measures latency percentiles and throughput of
+the hot HTTP paths, then Socket.IO fan-out to N connected clients over a real
+local websocket server. Results are printed and optionally written as JSON so
+runs can be compared commit to commit.
+
+    python benchmark.py --requests 1000 --concurrency 50 --socket-clients 500 --output bench.json
+    python benchmark.py --compare bench.json --fail-on-regression 20
+
+The Socket.IO scenario needs aiohttp (python-socketio's asyncio client); it is
+skipped when aiohttp is not installed.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Snabb API against a local MongoDB")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db-name", default="snabb_benchmark",
+                        help="database to (re)create; it is dropped first (default: snabb_benchmark)")
+    parser.add_argument("--force", action="store_true", help="allow a database name without 'bench' in it")
+    parser.add_argument("--drivers", type=int, default=2000)
+    parser.add_argument("--passengers", type=int, default=20000)
+    parser.add_argument("--trips", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--requests", type=int, default=500, help="requests per HTTP scenario (default: 500)")
+    parser.add_argument("--concurrency", type=int, default=20, help="requests in flight per scenario (default: 20)")
+    parser.add_argument("--scenarios", default="all",
+                        help="comma-separated scenario names, or 'all' (see --list)")
+    parser.add_argument("--list", action="store_true", help="list scenarios and exit")
+    parser.add_argument("--socket-clients", type=int, default=200, help="simulated Socket.IO clients (default: 200)")
+    parser.add_argument("--socket-rounds", type=int, default=20, help="fan-out broadcasts to time (default: 20)")
+    parser.add_argument("--port", type=int, default=8765, help="local port for the Socket.IO server (default: 8765)")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="previous JSON results to compare against")
+    parser.add_argument("--fail-on-regression", type=float, default=None, metavar="PCT",
+                        help="exit 1 if any scenario's p99 grew by more than PCT percent vs --compare")
+    return parser.parse_args(argv)
+
+
+ARGS = parse_args()
+
+# The app reads its database settings at import time
+os.environ["MONGO_URL"] = ARGS.mongo_url
+os.environ["DB_NAME"] = ARGS.db_name
+os.environ.setdefault("MATCHING_ENABLED", "false")
+# All benchmark traffic comes from one client; measure the endpoints, not the limiter
+for name in ("RATE_LIMIT_LOGIN", "RATE_LIMIT_ESTIMATE", "RATE_LIMIT_REQUEST_RIDE", "RATE_LIMIT_LOCATION"):
+    os.environ.setdefault(name, "0")
+
+import httpx  # noqa: E402
+import socketio  # noqa: E402
+import uvicorn  # noqa: E402
+
+import server  # noqa: E402
+from loadgen import SyntheticData, insert_batches  # noqa: E402
+
+HTTP_SCENARIOS = [
+    "estimate_price",
+    "update_driver_location",
+    "request_ride",
+    "nearby_requests",
+    "accept_trip",
+    "realtime_stats",
+]
+ALL_SCENARIOS = HTTP_SCENARIOS + ["socketio_fanout"]
+
+
+# ===================== Statistics =====================
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Linear-interpolated percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def latency_summary(latencies_ms: List[float]) -> Dict[str, float]:
+    values = sorted(latencies_ms)
+    return {
+        "p50": round(percentile(values, 50), 3),
+        "p90": round(percentile(values, 90), 3),
+        "p99": round(percentile(values, 99), 3),
+        "mean": round(sum(values) / len(values), 3) if values else 0.0,
+        "max": round(values[-1], 3) if values else 0.0,
+    }
+
+
+async def run_http_scenario(
+    name: str,
+    send: Callable[[int], Awaitable[httpx.Response]],
+    count: int,
+    concurrency: int
+) -> Dict[str, Any]:
+    """Call send(i) for i in range(count) with `concurrency` workers; 4xx/5xx count as errors"""
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    next_index = iter(range(count))
+
+    async def worker():
+        for i in next_index:
+            started = time.perf_counter()
+            try:
+                response = await send(i)
+                failed = str(response.status_code) if response.status_code >= 400 else None
+            except Exception as e:
+                failed = type(e).__name__
+            latencies.append((time.perf_counter() - started) * 1000)
+            if failed:
+                errors[failed] = errors.get(failed, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, count)))))
+    elapsed = time.perf_counter() - started
+    return {
+        "name": name,
+        "requests": count,
+        "concurrency": concurrency,
+        "errors": sum(errors.values()),
+        "error_statuses": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(count / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": latency_summary(latencies),
+    }
+
+
+# ===================== Setup =====================
+
+async def prepare_database(args) -> Dict[str, Any]:
+    """Drop and seed the benchmark database; returns ids the scenarios use"""
+    db = server.db
+    await server.client.drop_database(args.db_name)
+
+    data = SyntheticData(args.seed, args.drivers, args.passengers)
+    started = time.perf_counter()
+    await insert_batches(db.users, data.users("driver", args.drivers, 5000), concurrency=4)
+    await insert_batches(db.users, data.users("passenger", args.passengers, 5000), concurrency=4)
+    await insert_batches(db.trips, data.trips(args.trips, 90, 5000), concurrency=4)
+    await server.create_indexes()
+    seed_seconds = time.perf_counter() - started
+
+    admin = server.Admin(
+        id="benchmark_admin",
+        email="benchmark@snabb.local",
+        password_hash="-",
+        name="Benchmark",
+        admin_role=server.AdminRole.SUPER_ADMIN
+    ).model_dump()
+    admin["created_at"] = admin["created_at"].isoformat()
+    await db.admins.insert_one(admin)
+
+    active_drivers = await db.users.find(
+        {"role": server.UserRole.DRIVER, "is_active": True}, {"_id": 0, "id": 1}
+    ).to_list(None)
+    # Passengers with an active trip were taken from the front, so free ones come from the back
+    busy = set(await db.trips.distinct("passenger_id", {"status": {"$in": server.ACTIVE_TRIP_STATUSES}}))
+    free_passengers = []
+    for i in range(args.passengers - 1, -1, -1):
+        if len(free_passengers) >= args.requests:
+            break
+        passenger_id = data.user("passenger", i, search_fields=False)["id"]
+        if passenger_id not in busy:
+            free_passengers.append(passenger_id)
+
+    return {
+        "data": data,
+        "driver_ids": [d["id"] for d in active_drivers],
+        "passenger_ids": free_passengers,
+        "admin_token": server.create_access_token({"sub": admin["id"]}),
+        "seed_seconds": round(seed_seconds, 1),
+    }
+
+
+# ===================== Scenarios =====================
+
+def build_http_scenarios(http: httpx.AsyncClient, ctx: Dict[str, Any], args):
+    """{name: (send, request count)} plus the list request_ride fills with created trip ids"""
+    data: SyntheticData = ctx["data"]
+    drivers = ctx["driver_ids"]
+    passengers = ctx["passenger_ids"]
+    created_trips: List[str] = []
+    admin_headers = {"Authorization": f"Bearer {ctx['admin_token']}"}
+
+    def point(kind: str, i: int) -> Dict[str, float]:
+        lat, lng, _ = data.location(data._rng(kind, i))
+        return {"lat": lat, "lng": lng}
+
+    async def estimate_price(i):
+        return await http.post("/api/estimate-price", json={"origin": point("trip", i), "destination": point("trip", i + 1)})
+
+    async def update_driver_location(i):
+        driver_id = drivers[i % len(drivers)]
+        location = point("driver", i)
+        return await http.put(f"/api/driver/{driver_id}/location", json={"user_id": driver_id, **location})
+
+    async def request_ride(i):
+        response = await http.post(
+            f"/api/passenger/{passengers[i % len(passengers)]}/request-ride",
+            json={"passenger_id": passengers[i % len(passengers)], "origin": point("trip", i), "destination": point("trip", i + 7)}
+        )
+        if response.status_code == 200:
+            created_trips.append(response.json()["id"])
+        return response
+
+    async def nearby_requests(i):
+        return await http.get(f"/api/driver/{drivers[i % len(drivers)]}/nearby-requests")
+
+    async def accept_trip(i):
+        trip_id = created_trips[i % len(created_trips)]
+        return await http.post(f"/api/driver/{drivers[i % len(drivers)]}/accept-trip/{trip_id}")
+
+    async def realtime_stats(i):
+        return await http.get("/api/admin/dashboard/realtime-stats", headers=admin_headers)
+
+    scenarios = {
+        "estimate_price": (estimate_price, args.requests),
+        "update_driver_location": (update_driver_location, args.requests),
+        "request_ride": (request_ride, min(args.requests, len(passengers))),
+        "nearby_requests": (nearby_requests, args.requests),
+        # One accept per created trip; further accepts of the same trip would only measure the 400 path
+        "accept_trip": (accept_trip, None),
+        "realtime_stats": (realtime_stats, args.requests),
+    }
+    return scenarios, created_trips
+
+
+async def run_socketio_fanout(http: httpx.AsyncClient, args) -> Dict[str, Any]:
+    """
+    N clients join the driver role room; each round an admin notification is sent to
+    that room over HTTP and the time until every client received it is measured.
+    """
+    name = "socketio_fanout"
+    try:
+        import aiohttp  # noqa: F401
+    except ImportError:
+        return {"name": name, "skipped": "aiohttp is not installed"}
+
+    config = uvicorn.Config(server.socket_app, host="127.0.0.1", port=args.port, log_level="warning", lifespan="off")
+    uvicorn_server = uvicorn.Server(config)
+    serve_task = asyncio.create_task(uvicorn_server.serve())
+    while not uvicorn_server.started:
+        await asyncio.sleep(0.05)
+
+    received: Dict[str, List[float]] = {}
+    round_done: Dict[str, asyncio.Event] = {}
+    clients: List[socketio.AsyncClient] = []
+    connect_limit = asyncio.Semaphore(50)
+
+    async def connect(i: int):
+        client = socketio.AsyncClient(reconnection=False)
+
+        @client.on("notification")
+        async def on_notification(payload):
+            key = payload.get("message")
+            if key in received:
+                received[key].append(time.perf_counter())
+                if len(received[key]) >= args.socket_clients:
+                    round_done[key].set()
+
+        async with connect_limit:
+            await client.connect(f"http://127.0.0.1:{args.port}", transports=["websocket"])
+            await client.call("register_user", {"user_id": f"benchmark_client_{i}", "role": "driver"})
+        clients.append(client)
+
+    connect_started = time.perf_counter()
+    try:
+        await asyncio.gather(*(connect(i) for i in range(args.socket_clients)))
+        connect_seconds = time.perf_counter() - connect_started
+
+        delivery_ms: List[float] = []
+        round_ms: List[float] = []
+        lost = 0
+        for r in range(args.socket_rounds):
+            key = f"benchmark-fanout-{r}"
+            received[key] = []
+            round_done[key] = asyncio.Event()
+            sent_at = time.perf_counter()
+            await http.post("/api/admin/notifications", json={"role": "driver", "message": key})
+            try:
+                await asyncio.wait_for(round_done[key].wait(), timeout=10)
+            except asyncio.TimeoutError:
+                pass
+            times = received.pop(key)
+            lost += args.socket_clients - len(times)
+            delivery_ms.extend((t - sent_at) * 1000 for t in times)
+            if times:
+                round_ms.append((max(times) - sent_at) * 1000)
+    finally:
+        await asyncio.gather(*(c.disconnect() for c in clients), return_exceptions=True)
+        uvicorn_server.should_exit = True
+        await serve_task
+
+    total_round_s = sum(round_ms) / 1000
+    return {
+        "name": name,
+        "clients": args.socket_clients,
+        "rounds": args.socket_rounds,
+        "connect_s": round(connect_seconds, 3),
+        "lost_deliveries": lost,
+        "deliveries_per_s": round(len(delivery_ms) / total_round_s, 1) if total_round_s else 0.0,
+        "latency_ms": latency_summary(delivery_ms),
+        "round_completion_ms": latency_summary(round_ms),
+    }
+
+
+# ===================== Reporting =====================
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results: List[Dict[str, Any]]):
+    print(f"\n{'scenario':<24}{'req/s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}")
+    for r in results:
+        if r.get("skipped"):
+            print(f"{r['name']:<24}  skipped: {r['skipped']}")
+            continue
+        lat = r["latency_ms"]
+        rate = r.get("throughput_rps", r.get("deliveries_per_s", 0))
+        errors = r.get("errors", r.get("lost_deliveries", 0))
+        print(f"{r['name']:<24}{rate:>10}{lat['p50']:>10}{lat['p90']:>10}{lat['p99']:>10}{lat['max']:>10}{errors:>8}")
+
+
+def compare_results(current: List[Dict[str, Any]], baseline_path: str, threshold: Optional[float]) -> bool:
+    """Print p50/p99 changes vs a baseline run; False if p99 regressed beyond `threshold` percent"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {r["name"]: r for r in json.load(f)["scenarios"]}
+
+    ok = True
+    print(f"\nCompared with {baseline_path}:")
+    for r in current:
+        before = baseline.get(r["name"])
+        if r.get("skipped") or not before or before.get("skipped"):
+            continue
+        changes = {}
+        for key in ("p50", "p99"):
+            old, new = before["latency_ms"][key], r["latency_ms"][key]
+            changes[key] = (new - old) / old * 100 if old else 0.0
+        regressed = threshold is not None and changes["p99"] > threshold
+        ok = ok and not regressed
+        marker = "  REGRESSION" if regressed else ""
+        print(f"  {r['name']:<24} p50 {changes['p50']:+6.1f}%  p99 {changes['p99']:+6.1f}%{marker}")
+    return ok
+
+
+# ===================== Main =====================
+
+async def main(args) -> int:
+    if args.list:
+        print("\n".join(ALL_SCENARIOS))
+        return 0
+    if "bench" not in args.db_name and not args.force:
+        print(f"Refusing to drop database '{args.db_name}'; use a name containing 'bench' or pass --force")
+        return 2
+
+    selected = ALL_SCENARIOS if args.scenarios == "all" else [s.strip() for s in args.scenarios.split(",")]
+    unknown = set(selected) - set(ALL_SCENARIOS)
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        return 2
+    if "accept_trip" in selected and "request_ride" not in selected:
+        # Accepts need fresh pending trips
+        selected.insert(selected.index("accept_trip"), "request_ride")
+
+    print(f"Seeding {args.db_name}: {args.drivers:,} drivers, {args.passengers:,} passengers, {args.trips:,} trips...")
+    ctx = await prepare_database(args)
+    print(f"Seeded in {ctx['seed_seconds']}s")
+
+    results = []
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=30) as http:
+        for _ in range(20):
+            await http.get("/api/health")
+
+        scenarios, created_trips = build_http_scenarios(http, ctx, args)
+        for name in HTTP_SCENARIOS:
+            if name not in selected:
+                continue
+            send, count = scenarios[name]
+            if name == "accept_trip":
+                count = len(created_trips)
+                if not count:
+                    results.append({"name": name, "skipped": "request_ride created no trips"})
+                    continue
+            print(f"Running {name} ({count} requests, concurrency {args.concurrency})...")
+            results.append(await run_http_scenario(name, send, count, args.concurrency))
+
+        if "socketio_fanout" in selected:
+            print(f"Running socketio_fanout ({args.socket_clients} clients, {args.socket_rounds} rounds)...")
+            results.append(await run_socketio_fanout(http, args))
+
+    print_table(results)
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        # mongo_url is left out since it may carry credentials
+        "config": {k: v for k, v in vars(args).items() if k not in ("mongo_url", "compare", "output", "list")},
+        "seed_seconds": ctx["seed_seconds"],
+        "scenarios": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nResults written to {args.output}")
+
+    if args.compare and not compare_results(results, args.compare, args.fail_on_regression):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(asyncio.run(main(ARGS)))
+    finally:
+        server.client.close()
@@ -0,0 +1,204 @@
+"""
+Streaming Data Export
+خروجی جریانی CSV و Parquet برای حسابداری
+
+Turns a Motor cursor into CSV or Parquet bytes one batch at a time, so an
+export of a year of trips never holds more than one batch in memory. Parquet
+needs pyarrow, which is optional; CSV is always available.
+"""
+
+import csv
+import io
+from typing import Any, AsyncIterator, Dict, List, Sequence, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional; only CSV exports are offered without it
+    pa = None
+    pq = None
+
+# (column name, dotted document path, type) where type is string/float/int/bool
+ExportColumn = Tuple[str, str, str]
+
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+TRIP_EXPORT_COLUMNS: List[ExportColumn] = [
+    ("id", "id", "string"),
+    ("status", "status", "string"),
+    ("created_at", "created_at", "string"),
+    ("accepted_at", "accepted_at", "string"),
+    ("started_at", "started_at", "string"),
+    ("completed_at", "completed_at", "string"),
+    ("cancelled_at", "cancelled_at", "string"),
+    ("cancel_reason", "cancel_reason", "string"),
+    ("passenger_id", "passenger_id", "string"),
+    ("passenger_name", "passenger_name", "string"),
+    ("passenger_phone", "passenger_phone", "string"),
+    ("driver_id", "driver_id", "string"),
+    ("driver_name", "driver_name", "string"),
+    ("driver_phone", "driver_phone", "string"),
+    ("origin_address", "origin.address", "string"),
+    ("origin_lat", "origin.lat", "float"),
+    ("origin_lng", "origin.lng", "float"),
+    ("destination_address", "destination.address", "string"),
+    ("destination_lat", "destination.lat", "float"),
+    ("destination_lng", "destination.lng", "float"),
+    ("distance_km", "distance_km", "float"),
+    ("duration_minutes", "duration_minutes", "int"),
+    ("price", "price", "float"),
+]
+
+DRIVER_FINANCE_EXPORT_COLUMNS: List[ExportColumn] = [
+    ("driver_id", "driver_id", "string"),
+    ("driver_name", "driver_name", "string"),
+    ("driver_phone", "driver_phone", "string"),
+    ("total_earnings", "total_earnings", "float"),
+    ("commission_rate", "commission_rate", "float"),
+    ("commission_owed", "commission_owed", "float"),
+    ("commission_paid", "commission_paid", "float"),
+    ("commission_pending", "commission_pending", "float"),
+    ("net_earnings", "net_earnings", "float"),
+    ("account_locked", "account_locked", "bool"),
+    ("debt_limit", "debt_limit", "float"),
+    ("currency", "currency", "string"),
+    ("updated_at", "updated_at", "string"),
+]
+
+COMMISSION_PAYMENT_EXPORT_COLUMNS: List[ExportColumn] = [
+    ("id", "id", "string"),
+    ("payment_date", "payment_date", "string"),
+    ("driver_id", "driver_id", "string"),
+    ("driver_name", "driver_name", "string"),
+    ("amount", "amount", "float"),
+    ("payment_method", "payment_method", "string"),
+    ("recorded_by", "recorded_by", "string"),
+    ("recorded_by_name", "recorded_by_name", "string"),
+    ("notes", "notes", "string"),
+]
+
+
+def parquet_available() -> bool:
+    return pq is not None
+
+
+def export_projection(columns: Sequence[ExportColumn]) -> Dict[str, int]:
+    """Mongo projection fetching only the exported fields"""
+    projection = {"_id": 0}
+    for _, path, _ in columns:
+        projection[path] = 1
+    return projection
+
+
+def _lookup(doc: Dict[str, Any], path: str) -> Any:
+    value: Any = doc
+    for part in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+def _coerce(value: Any, kind: str) -> Any:
+    if value is None or value == "":
+        return None
+    try:
+        if kind == "float":
+            return float(value)
+        if kind == "int":
+            return int(value)
+        if kind == "bool":
+            return bool(value)
+    except (TypeError, ValueError):
+        return None
+    return str(value)
+
+
+def _csv_value(value: Any) -> Any:
+    return "" if value is None else value
+
+
+async def iter_batches(cursor, batch_size: int) -> AsyncIterator[List[Dict[str, Any]]]:
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def stream_csv(cursor, columns: Sequence[ExportColumn], batch_size: int) -> AsyncIterator[bytes]:
+    """CSV with a header row; starts with a BOM so spreadsheet apps read Persian text as UTF-8"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _, _ in columns])
+    yield ("\ufeff" + buffer.getvalue()).encode("utf-8")
+
+    async for batch in iter_batches(cursor, batch_size):
+        buffer.seek(0)
+        buffer.truncate()
+        for doc in batch:
+            writer.writerow([_csv_value(_lookup(doc, path)) for _, path, _ in columns])
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object whose contents are drained after every row group"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _arrow_schema(columns: Sequence[ExportColumn]):
+    types = {"string": pa.string(), "float": pa.float64(), "int": pa.int64(), "bool": pa.bool_()}
+    return pa.schema([(name, types[kind]) for name, _, kind in columns])
+
+
+async def stream_parquet(cursor, columns: Sequence[ExportColumn], batch_size: int) -> AsyncIterator[bytes]:
+    """Parquet with one row group per batch; requires pyarrow"""
+    if pq is None:
+        raise RuntimeError("pyarrow is not installed")
+    schema = _arrow_schema(columns)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="snappy")
+    try:
+        async for batch in iter_batches(cursor, batch_size):
+            arrays = {
+                name: [_coerce(_lookup(doc, path), kind) for doc in batch]
+                for name, path, kind in columns
+            }
+            writer.write_table(pa.Table.from_pydict(arrays, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def stream_export(cursor, columns: Sequence[ExportColumn], fmt: str, batch_size: int) -> AsyncIterator[bytes]:
+    if fmt == "parquet":
+        return stream_parquet(cursor, columns, batch_size)
+    return stream_csv(cursor, columns, batch_size)
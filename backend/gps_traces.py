@@ -0,0 +1,277 @@
+"""
+GPS Trace Storage
+ذخیره مسیر GPS رانندگان
+
+Every driver location ping is kept as a breadcrumb in the `gps_traces`
+MongoDB time-series collection (metaField `driver_id`, timeField `ts`), so trip
+routes can be reconstructed, fares audited and real distances measured. A
+trip's trace is the driver's breadcrumbs between the trip's start and end, so
+no trip lookup is needed on the ping path.
+
+Pings are buffered in memory and written with unordered insert_many batches
+by a background task; a batch that fails is put back and retried on the next
+flush. The buffer is bounded and drops pings when MongoDB cannot keep up. Queries return a Douglas–Peucker simplified polyline.
+"""
+
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from pymongo.errors import BulkWriteError, CollectionInvalid, OperationFailure
+
+logger = logging.getLogger(__name__)
+
+TRACE_COLLECTION = "gps_traces"
+EARTH_RADIUS_M = 6_371_000
+# Longer traces are simplified in a worker thread to keep the event loop free
+OFFLOAD_POINTS = 10_000
+
+
+async def ensure_trace_collection(db, retention_days: int = 0):
+    """Create the time-series collection (MongoDB 5.0+); older servers get a plain indexed collection"""
+    options: Dict[str, Any] = {
+        "timeseries": {"timeField": "ts", "metaField": "driver_id", "granularity": "seconds"}
+    }
+    if retention_days > 0:
+        options["expireAfterSeconds"] = retention_days * 86400
+    try:
+        await db.create_collection(TRACE_COLLECTION, **options)
+    except CollectionInvalid:
+        pass  # already exists
+    except OperationFailure as e:
+        logger.warning(f"Time-series collections unavailable, using a regular collection for GPS traces: {e}")
+    indexes = [([("driver_id", 1), ("ts", 1)], {})]
+    collection_info = await db.list_collections(filter={"name": TRACE_COLLECTION}).to_list(None)
+    if retention_days > 0 and not any(info.get("type") == "timeseries" for info in collection_info):
+        # A regular collection has no expireAfterSeconds of its own: keep the retention with a TTL index
+        indexes.append(([("ts", 1)], {"expireAfterSeconds": retention_days * 86400}))
+    for keys, index_options in indexes:
+        try:
+            await db[TRACE_COLLECTION].create_index(keys, **index_options)
+        except OperationFailure as e:
+            logger.warning(f"Could not create GPS trace index {keys}: {e}")
+
+
+def parse_time(value) -> Optional[datetime]:
+    """Trip timestamps are stored as ISO strings; traces need datetimes"""
+    if value is None or isinstance(value, datetime):
+        return value
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def trip_window(trip: Dict[str, Any]) -> Tuple[Optional[datetime], datetime]:
+    """Time range of a trip's route: from pickup (or acceptance) until completion/cancellation (or now)"""
+    start = parse_time(trip.get("started_at") or trip.get("accepted_at"))
+    end = parse_time(trip.get("completed_at") or trip.get("cancelled_at")) or datetime.now(timezone.utc)
+    return start, end
+
+
+def trace_cursor(db, driver_id: str, start: datetime, end: datetime, batch_size: int = 5000):
+    """Breadcrumbs of one driver in [start, end], oldest first"""
+    return db[TRACE_COLLECTION].find(
+        {"driver_id": driver_id, "ts": {"$gte": start, "$lte": end}},
+        {"_id": 0, "lat": 1, "lng": 1, "ts": 1}
+    ).sort("ts", 1).batch_size(batch_size)
+
+
+async def iter_trip_points(db, trip: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+    start, end = trip_window(trip)
+    if not trip.get("driver_id") or start is None:
+        return
+    async for point in trace_cursor(db, trip["driver_id"], start, end):
+        yield point
+
+
+def haversine_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(1.0, a)))
+
+
+class TraceDistance:
+    """
+    Streaming distance/time accumulator over ordered breadcrumbs: O(1) memory,
+    so a trace of any length is measured straight from the cursor. Points that
+    imply an impossible speed (GPS spikes) are skipped.
+    """
+
+    def __init__(self, max_speed_kmh: float = 200):
+        self.max_speed_ms = max_speed_kmh / 3.6
+        self.meters = 0.0
+        self.points = 0
+        self.skipped = 0
+        self.first_ts: Optional[float] = None
+        self.last: Optional[Tuple[float, float, float]] = None
+
+    def add(self, lat: float, lng: float, ts: float):
+        if self.last is None:
+            self.first_ts = ts
+        else:
+            last_lat, last_lng, last_ts = self.last
+            segment = haversine_m(last_lat, last_lng, lat, lng)
+            if segment > self.max_speed_ms * max(ts - last_ts, 1):
+                self.skipped += 1
+                return
+            self.meters += segment
+        self.last = (lat, lng, ts)
+        self.points += 1
+
+    @property
+    def distance_km(self) -> float:
+        return self.meters / 1000
+
+    @property
+    def elapsed_seconds(self) -> float:
+        return self.last[2] - self.first_ts if self.last else 0.0
+
+
+async def measure_trip(
+    db,
+    trip: Dict[str, Any],
+    max_speed_kmh: float = 200,
+    buffered: Sequence[Dict[str, Any]] = ()
+) -> TraceDistance:
+    """
+    Driven distance and covered time of a trip, streamed from its recorded trace.
+    `buffered` are the driver's pings not written yet (TraceWriter.pending), newer than the stored ones.
+    """
+    measure = TraceDistance(max_speed_kmh)
+    start, end = trip_window(trip)
+    async for point in iter_trip_points(db, trip):
+        ts = point["ts"]
+        measure.add(point["lat"], point["lng"], (ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)).timestamp())
+    for point in buffered:
+        if start is not None and start <= point["ts"] <= end:
+            measure.add(point["lat"], point["lng"], point["ts"].timestamp())
+    return measure
+
+
+def douglas_peucker(lat: np.ndarray, lng: np.ndarray, tolerance_m: float) -> np.ndarray:
+    """Indexes of the points kept by Douglas–Peucker (iterative, on a local equirectangular projection)"""
+    count = len(lat)
+    if count <= 2 or tolerance_m <= 0:
+        return np.arange(count)
+    # Metres on a plane tangent at the mean latitude: accurate enough at city scale
+    x = np.radians(lng) * math.cos(math.radians(float(lat.mean()))) * EARTH_RADIUS_M
+    y = np.radians(lat) * EARTH_RADIUS_M
+
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length = math.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(px, py)
+        else:
+            distances = np.abs(dx * py - dy * px) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance_m:
+            index = first + 1 + farthest
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return np.flatnonzero(keep)
+
+
+async def simplified_trace(db, trip: Dict[str, Any], tolerance_m: float = 10) -> Dict[str, Any]:
+    """Trip route as [[lat, lng, unix seconds], ...] simplified to within tolerance_m"""
+    lats, lngs, times = [], [], []
+    async for point in iter_trip_points(db, trip):
+        lats.append(point["lat"])
+        lngs.append(point["lng"])
+        ts = point["ts"]
+        times.append((ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)).timestamp())
+    lat, lng = np.array(lats, dtype=float), np.array(lngs, dtype=float)
+    if len(lat) > OFFLOAD_POINTS:
+        kept = await asyncio.to_thread(douglas_peucker, lat, lng, tolerance_m)
+    else:
+        kept = douglas_peucker(lat, lng, tolerance_m)
+    return {
+        "trip_id": trip.get("id"),
+        "raw_points": len(lats),
+        "tolerance_m": tolerance_m,
+        "points": [[round(float(lat[i]), 6), round(float(lng[i]), 6), int(times[i])] for i in kept],
+    }
+
+
+class TraceWriter:
+    """Buffers location pings and writes them to the trace collection in batches"""
+
+    def __init__(self, db, flush_interval_seconds: float = 1.0, batch_size: int = 1000, max_buffer: int = 100_000):
+        self.db = db
+        self.flush_interval_seconds = flush_interval_seconds
+        self.batch_size = batch_size
+        self._buffer: deque = deque(maxlen=max_buffer)
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"written": 0, "dropped": 0, "failed_batches": 0, "last_flush_ms": 0.0}
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def pending(self, driver_id: str) -> List[Dict[str, Any]]:
+        """One driver's buffered pings, oldest first, without writing the whole buffer"""
+        return [ping for ping in self._buffer if ping["driver_id"] == driver_id]
+
+    def add(self, driver_id: str, lat: float, lng: float, ts: Optional[datetime] = None):
+        """O(1) on the ping path; the oldest ping is dropped when the buffer is full"""
+        if len(self._buffer) == self._buffer.maxlen:
+            self.stats["dropped"] += 1
+        self._buffer.append({
+            "driver_id": driver_id,
+            "ts": ts or datetime.now(timezone.utc),
+            "lat": lat,
+            "lng": lng,
+        })
+
+    async def flush(self) -> int:
+        started = time.perf_counter()
+        written = 0
+        while self._buffer:
+            batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            try:
+                await self.db[TRACE_COLLECTION].insert_many(batch, ordered=False)
+                written += len(batch)
+            except BulkWriteError as e:
+                # Unordered: everything except the failed documents was written; those are not retried
+                inserted = e.details.get("nInserted", 0)
+                written += inserted
+                self.stats["dropped"] += len(batch) - inserted
+                logger.error(f"GPS trace batch: {len(batch) - inserted} of {len(batch)} pings rejected: {e}")
+            except Exception as e:
+                # Traces are fare input: put the batch back in order and retry on the next flush
+                self.stats["failed_batches"] += 1
+                overflow = max(0, len(self._buffer) + len(batch) - self._buffer.maxlen)
+                self._buffer.extendleft(reversed(batch))  # a full buffer loses its newest pings
+                self.stats["dropped"] += overflow
+                logger.error(f"GPS trace batch of {len(batch)} pings failed, will retry: {e}")
+                break
+        self.stats["written"] += written
+        self.stats["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        return written
+
+    async def _run_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval_seconds)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
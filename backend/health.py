@@ -0,0 +1,134 @@
+"""
+Health & Readiness
+بررسی سلامت و آمادگی سرویس
+
+Liveness says the process and its event loop still run; readiness says this
+worker should receive traffic right now. Readiness fails (503) when the event
+loop lags, MongoDB is slow or unreachable, the connection pool is nearly
+exhausted or a background queue is backed up, so the load balancer sheds load
+from a saturated worker before its requests start timing out.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
+
+from pymongo import monitoring
+
+
+class LoopLagMonitor:
+    """
+    Measures event-loop lag as the overshoot of a periodic sleep. The worst lag
+    of the last window_seconds is kept, so every reader (several probes, the
+    load balancer and an operator) sees the same spike, not only the first one
+    """
+
+    def __init__(self, interval_seconds: float = 0.5, window_seconds: float = 10.0):
+        self.interval_seconds = interval_seconds
+        self.window_seconds = window_seconds
+        self.lag_ms = 0.0
+        self._samples: deque = deque()  # (monotonic time, lag ms), oldest first
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, lag_ms: float, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        self.lag_ms = lag_ms
+        self._samples.append((now, lag_ms))
+        while self._samples[0][0] < now - self.window_seconds:
+            self._samples.popleft()
+
+    def max_lag_ms(self, now: Optional[float] = None) -> float:
+        """Worst lag sampled in the last window_seconds; reading does not reset it"""
+        now = time.monotonic() if now is None else now
+        return max((lag for at, lag in self._samples if at >= now - self.window_seconds), default=0.0)
+
+    async def _run_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval_seconds)
+            self.record(max(0.0, (loop.time() - started - self.interval_seconds) * 1000))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """Counts checked-out connections per server to report pool saturation"""
+
+    def __init__(self):
+        self.checked_out: Dict[Tuple[str, int], int] = {}
+        self.checkout_failures = 0
+        self._lock = threading.Lock()
+
+    def _adjust(self, address, delta: int):
+        with self._lock:
+            self.checked_out[address] = max(0, self.checked_out.get(address, 0) + delta)
+
+    def connection_checked_out(self, event):
+        self._adjust(event.address, 1)
+
+    def connection_checked_in(self, event):
+        self._adjust(event.address, -1)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.checked_out.pop(event.address, None)
+
+    def pool_closed(self, event):
+        self.pool_cleared(event)
+
+    # Events that do not change the checked-out count
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def busiest(self) -> int:
+        with self._lock:
+            return max(self.checked_out.values(), default=0)
+
+
+async def mongo_ping_ms(db, timeout_seconds: float) -> Optional[float]:
+    """Ping round trip in ms, or None when MongoDB did not answer in time"""
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout_seconds)
+    except Exception:
+        return None
+    return round((time.perf_counter() - started) * 1000, 2)
+
+
+def evaluate(checks: Dict[str, Dict[str, Any]]) -> Tuple[bool, Dict[str, Any]]:
+    """Readiness verdict: every check needs `ok`; the failing check names are listed"""
+    failing = [name for name, check in checks.items() if not check["ok"]]
+    return not failing, {
+        "status": "ready" if not failing else "not_ready",
+        "failing": failing,
+        "checks": checks,
+    }
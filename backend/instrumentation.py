@@ -0,0 +1,276 @@
+"""
+Metrics & Instrumentation
+سنجه‌های عملکرد (Prometheus)
+
+Per-route latency histograms, MongoDB command counts/durations attributed to
+the request that issued them, and Socket.IO emit counts and payload sizes per
+event, exposed in the Prometheus text format. Metrics are kept per process;
+with several workers, scrape each one (or aggregate in Prometheus).
+
+Mongo commands are attributed through a context variable set by the HTTP
+middleware. Motor runs PyMongo calls in an executor with a copy of the
+caller's context, so the command listener sees the request that issued them.
+"""
+
+import json
+import re
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MONGO_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+COMMAND_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100, 250)
+PAYLOAD_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144)
+
+# Handshake/auth traffic is not application work
+IGNORED_COMMANDS = {"hello", "ismaster", "isMaster", "saslStart", "saslContinue", "authenticate", "getnonce", "endSessions"}
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_float(value: float) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Tuple[str, ...] = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_float(value)}"
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # labels -> [per-bucket counts..., sum, count]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Tuple[str, ...], value: float):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._series.items()]
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = f'le="{_format_float(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_float(series[-2])}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {series[-1]}"
+
+
+class RequestStats:
+    """Mongo work done on behalf of one HTTP request"""
+
+    __slots__ = ("mongo_commands", "mongo_seconds", "_lock")
+
+    def __init__(self):
+        self.mongo_commands = 0
+        self.mongo_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add_command(self, seconds: float):
+        with self._lock:
+            self.mongo_commands += 1
+            self.mongo_seconds += seconds
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+class Metrics:
+    def __init__(self, dynamic_event_prefixes: Sequence[str] = ()):
+        self.http_duration = Histogram(
+            "http_request_duration_seconds", "HTTP request latency by route",
+            ("method", "route", "status"))
+        self.http_mongo_commands = Histogram(
+            "http_request_mongo_commands", "MongoDB commands issued per HTTP request",
+            ("method", "route"), COMMAND_COUNT_BUCKETS)
+        self.http_mongo_duration = Histogram(
+            "http_request_mongo_duration_seconds", "Time spent in MongoDB per HTTP request",
+            ("method", "route"))
+        self.mongo_duration = Histogram(
+            "mongo_command_duration_seconds", "MongoDB command latency",
+            ("command", "collection"), MONGO_LATENCY_BUCKETS)
+        self.mongo_failures = Counter(
+            "mongo_command_failures_total", "Failed MongoDB commands", ("command", "collection"))
+        self.socket_emits = Counter(
+            "socketio_emits_total", "Socket.IO emit calls by event", ("event", "namespace"))
+        self.socket_recipients = Counter(
+            "socketio_recipients_total", "Local clients addressed by Socket.IO emits", ("event", "namespace"))
+        self.socket_payload = Histogram(
+            "socketio_emit_payload_bytes", "Serialized Socket.IO payload size per emit",
+            ("event", "namespace"), PAYLOAD_BUCKETS)
+        self.socket_sent_bytes = Counter(
+            "socketio_sent_bytes_total", "Payload bytes times local recipients", ("event", "namespace"))
+        self._collectors = [
+            self.http_duration, self.http_mongo_commands, self.http_mongo_duration,
+            self.mongo_duration, self.mongo_failures,
+            self.socket_emits, self.socket_recipients, self.socket_payload, self.socket_sent_bytes,
+        ]
+        # Events with an id suffix (e.g. driver_location_<id>) are reported as one series
+        self._dynamic_event = re.compile(
+            "^(" + "|".join(re.escape(p) for p in dynamic_event_prefixes) + ").+$"
+        ) if dynamic_event_prefixes else None
+
+    def render(self) -> str:
+        lines = []
+        for collector in self._collectors:
+            lines.extend(collector.render())
+        return "\n".join(lines) + "\n"
+
+    # ----------- HTTP -----------
+    def observe_request(self, method: str, route: str, status: int, seconds: float, stats: RequestStats):
+        self.http_duration.observe((method, route, str(status)), seconds)
+        self.http_mongo_commands.observe((method, route), stats.mongo_commands)
+        self.http_mongo_duration.observe((method, route), stats.mongo_seconds)
+
+    # ----------- Socket.IO -----------
+    def event_label(self, event: str) -> str:
+        if self._dynamic_event:
+            match = self._dynamic_event.match(event)
+            if match:
+                return match.group(1) + "{id}"
+        return event
+
+    def observe_emit(self, event: str, namespace: str, data, recipients: int):
+        labels = (self.event_label(event), namespace)
+        if isinstance(data, (bytes, bytearray)):
+            size = len(data)  # binary attachment, sent as is
+        else:
+            try:
+                size = len(json.dumps(data, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8"))
+            except (TypeError, ValueError):
+                size = 0
+        self.socket_emits.inc(labels)
+        self.socket_recipients.inc(labels, recipients)
+        self.socket_payload.observe(labels, size)
+        self.socket_sent_bytes.inc(labels, size * recipients)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every MongoDB command and charges it to the current request, if any"""
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self._pending: Dict[Tuple[int, object], Tuple[str, str, Optional[RequestStats]]] = {}
+
+    def started(self, event):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        if not isinstance(collection, str):
+            collection = ""
+        self._pending[(event.request_id, event.connection_id)] = (
+            event.command_name, collection, current_request.get()
+        )
+
+    def _finish(self, event, failed: bool):
+        pending = self._pending.pop((event.request_id, event.connection_id), None)
+        if pending is None:
+            return
+        command, collection, stats = pending
+        seconds = event.duration_micros / 1_000_000
+        self.metrics.mongo_duration.observe((command, collection), seconds)
+        if failed:
+            self.metrics.mongo_failures.inc((command, collection))
+        if stats is not None:
+            stats.add_command(seconds)
+
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+
+    def failed(self, event):
+        self._finish(event, failed=True)
+
+
+def route_label(scope) -> str:
+    """Route template (e.g. /api/driver/{driver_id}/trips) so ids do not explode label cardinality"""
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+async def time_request(metrics: Metrics, request, call_next):
+    """HTTP middleware body: latency plus the Mongo work done for this request"""
+    stats = RequestStats()
+    token = current_request.set(stats)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        current_request.reset(token)
+        metrics.observe_request(
+            request.method, route_label(request.scope), status, time.perf_counter() - started, stats
+        )
+
+
+def local_recipients(sio, namespace: str, room: Optional[str]) -> int:
+    """Clients on this worker that an emit to `room` (None = broadcast) reaches"""
+    try:
+        return len(sio.manager.rooms.get(namespace, {}).get(room) or ())
+    except AttributeError:
+        return 0
+
+
+def instrument_socketio(sio, metrics: Metrics):
+    """Wrap sio.emit so every emit is counted and sized by event"""
+    emit = sio.emit
+
+    async def instrumented_emit(event, data=None, to=None, room=None, namespace=None, **kwargs):
+        namespace = namespace or "/"
+        target = to if to is not None else room
+        metrics.observe_emit(event, namespace, data, local_recipients(sio, namespace, target))
+        return await emit(event, data, to=to, room=room, namespace=namespace, **kwargs)
+
+    sio.emit = instrumented_emit
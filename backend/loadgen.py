@@ -0,0 +1,311 @@
+"""
+Synthetic Data Generator
+تولید داده‌های آزمایشی در مقیاس واقعی
+
+Deterministic (seeded) generators for users, trips and notifications with
+production-like distributions: pickups cluster around city hotspots, demand
+follows the daily commute curve, trip lengths are log-normal, and only recent
+trips are still active (at most one per passenger). Documents are produced in
+batches and written with bounded-concurrency insert_many, so millions of rows
+can be generated without holding them in memory.
+
+User attributes are a pure function of (seed, role, index), so trips can
+reference any user without keeping the user list around.
+"""
+
+import asyncio
+import math
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from text_search import user_search_fields
+
+CITY_CENTER = (35.6892, 51.3890)  # Tehran
+
+# (name, lat, lng, weight): pickups and drop-offs concentrate around these
+HOTSPOTS = [
+    ("میدان ولیعصر، تهران", 35.7006, 51.4054, 8),
+    ("میدان تجریش، تهران", 35.8045, 51.4336, 6),
+    ("میدان آزادی، تهران", 35.6997, 51.3380, 6),
+    ("میدان انقلاب، تهران", 35.7009, 51.3914, 7),
+    ("خیابان ستارخان، تهران", 35.7117, 51.3580, 3),
+    ("خیابان کارگر، تهران", 35.7150, 51.3890, 3),
+    ("خیابان نیاوران، تهران", 35.8120, 51.4700, 2),
+    ("میدان شهدا، تهران", 35.6925, 51.4468, 4),
+    ("میدان رسالت، تهران", 35.7356, 51.4985, 4),
+    ("میدان قدس، تهران", 35.7950, 51.4390, 3),
+    ("خیابان پاسداران، تهران", 35.7730, 51.4650, 4),
+    ("خیابان جمهوری، تهران", 35.6930, 51.4070, 5),
+    ("راه‌آهن، تهران", 35.6608, 51.4012, 4),
+]
+HOTSPOT_SPREAD_DEG = 0.012  # ~1.3 km standard deviation around a hotspot
+BACKGROUND_SHARE = 0.25  # share of points spread across the whole city
+CITY_RADIUS_DEG = 0.12
+
+# Relative demand per hour of day (morning and evening commute peaks)
+HOURLY_DEMAND = [
+    1, 0.6, 0.4, 0.3, 0.3, 0.6, 2, 5, 6, 4, 3, 3,
+    3.5, 3.5, 3, 3, 4, 6, 6.5, 5, 4, 3, 2, 1.5,
+]
+# Relative demand per weekday (Monday=0); Friday is the weekend
+WEEKDAY_DEMAND = [1.0, 1.0, 1.0, 1.0, 0.6, 0.8, 1.0]
+
+FIRST_NAMES = [
+    "علی", "حسین", "محمد", "رضا", "مهدی", "سعید", "امیر", "حمید", "مسعود", "فرهاد",
+    "فاطمه", "زهرا", "مریم", "سارا", "نرگس", "لیلا", "مینا", "پریسا", "احمد", "یوسف",
+]
+LAST_NAMES = [
+    "محمدی", "رضایی", "احمدی", "کریمی", "حسینی", "نوری", "صادقی", "باقری", "مرادی", "یوسفی",
+    "جعفری", "رحیمی", "عباسی", "موسوی", "قاسمی", "هاشمی", "اکبری", "نظری", "زمانی", "کاظمی",
+]
+CAR_MODELS = ["پژو 206", "پژو 207", "سمند", "پراید", "تیبا", "دنا", "رانا"]
+
+# Phone prefixes per role; the index fills the remaining 7 digits (10M users per role)
+PHONE_PREFIXES = {"driver": "079", "passenger": "078"}
+
+NOTIFICATION_MESSAGES = [
+    "به سیستم اسنپ خوش آمدید",
+    "تغییرات جدید در نرخ کرایه اعمال شد",
+    "یک درخواست سفر جدید در نزدیکی شما",
+    "سفر شما با موفقیت تکمیل شد",
+    "راننده در مسیر است",
+    "لطفاً اطلاعات خود را به‌روزرسانی کنید",
+    "پاداش جدید برای شما فعال شد",
+    "تخفیف ویژه برای سفر بعدی شما",
+]
+
+# Salts for per-document random streams
+_STREAM_SALTS = {"driver": 1, "passenger": 2, "trip": 3, "notification": 4}
+
+BASE_FARE = 20  # AFN, matches the default PricingConfig
+PER_KM = 10
+AVG_SPEED_KMH = 24
+
+
+class SyntheticData:
+    """Seeded document factories; the same seed and counts always produce the same data"""
+
+    def __init__(self, seed: int, drivers: int, passengers: int, now: Optional[datetime] = None):
+        self.seed = seed
+        self.driver_count = drivers
+        self.passenger_count = passengers
+        self.now = now or datetime.now(timezone.utc)
+        self.rng = random.Random(seed)
+        self._hotspot_weights = [h[3] for h in HOTSPOTS]
+        self._hour_weights = HOURLY_DEMAND
+
+    def _rng(self, kind: str, index: int) -> random.Random:
+        """Independent random stream for one document (integer seeds are cheap to set up)"""
+        return random.Random((self.seed << 40) ^ (_STREAM_SALTS[kind] << 36) ^ index)
+
+    # ----------- Space and time -----------
+    def location(self, rng: random.Random) -> Tuple[float, float, str]:
+        """A point near a weighted hotspot, or anywhere in the city"""
+        if rng.random() < BACKGROUND_SHARE:
+            angle = rng.uniform(0, 2 * math.pi)
+            radius = CITY_RADIUS_DEG * math.sqrt(rng.random())
+            lat = CITY_CENTER[0] + radius * math.sin(angle)
+            lng = CITY_CENTER[1] + radius * math.cos(angle)
+            address = rng.choice(HOTSPOTS)[0]
+        else:
+            name, h_lat, h_lng, _ = rng.choices(HOTSPOTS, weights=self._hotspot_weights)[0]
+            lat = rng.gauss(h_lat, HOTSPOT_SPREAD_DEG)
+            lng = rng.gauss(h_lng, HOTSPOT_SPREAD_DEG)
+            address = name
+        return round(lat, 6), round(lng, 6), address
+
+    def destination(self, rng: random.Random, origin: Tuple[float, float]) -> Tuple[float, float, float]:
+        """Drop-off at a log-normal distance (median ~6 km) in a random direction"""
+        distance_km = min(max(rng.lognormvariate(math.log(6), 0.55), 0.8), 40)
+        bearing = rng.uniform(0, 2 * math.pi)
+        lat = origin[0] + (distance_km / 111.0) * math.cos(bearing)
+        lng = origin[1] + (distance_km / (111.0 * math.cos(math.radians(origin[0])))) * math.sin(bearing)
+        return round(lat, 6), round(lng, 6), distance_km
+
+    def request_time(self, rng: random.Random, days: float) -> datetime:
+        """A request time within the last `days` days, following weekday and hourly demand"""
+        while True:
+            day_offset = rng.randrange(max(1, math.ceil(days)))
+            day = (self.now - timedelta(days=day_offset)).replace(hour=0, minute=0, second=0, microsecond=0)
+            if rng.random() > WEEKDAY_DEMAND[day.weekday()]:
+                continue
+            hour = rng.choices(range(24), weights=self._hour_weights)[0]
+            created_at = day + timedelta(hours=hour, seconds=rng.randrange(3600))
+            if self.now - timedelta(days=days) <= created_at <= self.now:
+                return created_at
+
+    # ----------- Users -----------
+    def user(self, role: str, index: int, search_fields: bool = True) -> Dict[str, Any]:
+        """User document `index` of `role`; deterministic so trips can reference it cheaply"""
+        rng = self._rng(role, index)
+        name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+        phone = f"{PHONE_PREFIXES[role]}{index:07d}"
+        doc = {
+            "id": f"{role}_{index + 1}_{self.seed}",
+            "phone": phone,
+            "name": name,
+            "role": role,
+            "is_active": True,
+            "created_at": (self.now - timedelta(days=rng.randint(1, 365))).isoformat(),
+        }
+        if search_fields:
+            doc.update(user_search_fields(name, phone))
+        if role == "driver":
+            lat, lng, _ = self.location(rng)
+            doc.update({
+                "is_active": rng.random() < 0.75,
+                "current_location": {"lat": lat, "lng": lng},
+                "location_updated_at": self.now.isoformat(),
+                "car_model": rng.choice(CAR_MODELS),
+                "car_plate": f"{rng.randint(10, 99)}{chr(rng.randint(1575, 1610))}{rng.randint(100, 999)}-{rng.randint(10, 99)}",
+            })
+        return doc
+
+    def users(self, role: str, count: int, batch_size: int) -> Iterator[List[Dict[str, Any]]]:
+        for start in range(0, count, batch_size):
+            yield [self.user(role, i) for i in range(start, min(start + batch_size, count))]
+
+    # ----------- Trips -----------
+    def trip(self, index: int, created_at: datetime, status: str, passenger_index: int) -> Dict[str, Any]:
+        rng = self._rng("trip", index)
+        passenger = self.user("passenger", passenger_index, search_fields=False)
+        o_lat, o_lng, o_address = self.location(rng)
+        d_lat, d_lng, distance_km = self.destination(rng, (o_lat, o_lng))
+        duration_minutes = max(1, int(distance_km / AVG_SPEED_KMH * 60 * rng.uniform(0.8, 1.5)))
+
+        trip = {
+            "id": f"trip_{index + 1}_{self.seed}",
+            "passenger_id": passenger["id"],
+            "passenger_name": passenger["name"],
+            "passenger_phone": passenger["phone"],
+            "origin": {"lat": o_lat, "lng": o_lng, "address": o_address},
+            "destination": {"lat": d_lat, "lng": d_lng, "address": rng.choice(HOTSPOTS)[0]},
+            "price": round(BASE_FARE + distance_km * PER_KM, 0),
+            "status": status,
+            "distance_km": round(distance_km, 2),
+            "duration_minutes": duration_minutes,
+            "created_at": created_at.isoformat(),
+        }
+
+        if status == "pending" or self.driver_count == 0:
+            return trip
+
+        # Cancelled trips were mostly never accepted
+        if status == "cancelled" and rng.random() < 0.7:
+            trip["cancelled_at"] = (created_at + timedelta(minutes=rng.randint(1, 10))).isoformat()
+            trip["cancel_reason"] = rng.choice(["expired", None])
+            return trip
+
+        driver = self.user("driver", rng.randrange(self.driver_count), search_fields=False)
+        accepted_at = created_at + timedelta(seconds=rng.randint(20, 300))
+        trip.update({
+            "driver_id": driver["id"],
+            "driver_name": driver["name"],
+            "driver_phone": driver["phone"],
+            "driver_car_model": driver["car_model"],
+            "accepted_at": accepted_at.isoformat(),
+        })
+        if status == "cancelled":
+            trip["cancelled_at"] = (accepted_at + timedelta(minutes=rng.randint(1, 8))).isoformat()
+            return trip
+
+        if status in ("in_progress", "completed"):
+            started_at = accepted_at + timedelta(minutes=rng.randint(3, 12))
+            trip["started_at"] = started_at.isoformat()
+            if status == "completed":
+                trip["completed_at"] = (started_at + timedelta(minutes=duration_minutes)).isoformat()
+        return trip
+
+    def trips(
+        self,
+        count: int,
+        days: float,
+        batch_size: int,
+        active_share: float = 0.01,
+        cancelled_share: float = 0.12,
+        start_index: int = 0
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Historical trips are completed or cancelled; `active_share` of them are recent
+        pending/accepted/in-progress trips, each for a different passenger.
+        """
+        if self.passenger_count == 0:
+            return
+        active_count = min(int(count * active_share), self.passenger_count)
+        # Active trips use passengers 0..active_count-1, so nobody has two active trips
+        batch = []
+        for i in range(count):
+            index = start_index + i
+            if i < active_count:
+                status = self.rng.choice(["pending", "accepted", "in_progress"])
+                created_at = self.now - timedelta(seconds=self.rng.randint(5, 1800))
+                passenger_index = i
+            else:
+                status = "cancelled" if self.rng.random() < cancelled_share else "completed"
+                created_at = self.request_time(self.rng, days)
+                passenger_index = self.rng.randrange(self.passenger_count)
+            batch.append(self.trip(index, created_at, status, passenger_index))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    # ----------- Notifications -----------
+    def notifications(self, count: int, days: float, batch_size: int) -> Iterator[List[Dict[str, Any]]]:
+        batch = []
+        for i in range(count):
+            rng = self._rng("notification", i)
+            batch.append({
+                "id": f"notif_{i + 1}_{self.seed}",
+                "user_id": None,  # Broadcast
+                "role": rng.choice(["driver", "passenger", None]),
+                "message": rng.choice(NOTIFICATION_MESSAGES),
+                "created_at": (self.now - timedelta(seconds=rng.randrange(max(1, int(days * 86400))))).isoformat(),
+            })
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+async def insert_batches(
+    collection,
+    batches: Iterator[List[Dict[str, Any]]],
+    concurrency: int = 4,
+    on_progress: Optional[Callable[[int], None]] = None
+) -> int:
+    """insert_many every batch with at most `concurrency` writes in flight; returns rows inserted"""
+    semaphore = asyncio.Semaphore(concurrency)
+    inserted = 0
+    errors: List[Exception] = []
+    tasks = set()
+
+    async def write(batch):
+        nonlocal inserted
+        try:
+            result = await collection.insert_many(batch, ordered=False)
+            inserted += len(result.inserted_ids)
+            if on_progress:
+                on_progress(inserted)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            semaphore.release()
+
+    for batch in batches:
+        await semaphore.acquire()
+        if errors:
+            # Stop generating once a write has failed
+            semaphore.release()
+            break
+        task = asyncio.create_task(write(batch))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks)
+    if errors:
+        raise errors[0]
+    return inserted
@@ -0,0 +1,210 @@
+"""
+Compact Location Frames
+فریم‌های باینری فشرده برای موقعیت رانندگان
+
+Map views that opt in (subscribe_locations with format "binary") receive the
+latest position of every moving driver as one binary Socket.IO event per
+flush interval instead of one JSON event per ping. A frame is a small header
+followed by fixed 16-byte records:
+
+    header  <BBHI   version, flags (0), record count, index epoch
+    record  <IiiI   driver index, lat * 1e6, lng * 1e6, unix seconds
+
+Driver ids are replaced by small integer indexes. New indexes are announced in
+a "location_index" event ({epoch, drivers: {index: driver_id}}) before the
+first frame that uses them. The epoch is random per worker, so with several
+workers a client keeps one index table per epoch. Frames reach the clients of
+every worker, but a client only gets its own worker's full table on subscribe,
+so every `index_resend_seconds` each worker also re-sends the indexes of the
+drivers that moved since its last resend; records of an epoch whose table has
+not arrived yet are skipped.
+
+Drivers idle for `index_idle_seconds` lose their index. Indexes are never
+reused within an epoch, so once most of them have expired the worker switches
+to a new epoch with the remaining drivers renumbered from 0 and announces its
+full table; clients can drop tables of epochs they no longer receive frames for.
+"""
+
+import asyncio
+import logging
+import random
+import struct
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+FRAME_VERSION = 1
+COORD_SCALE = 1_000_000  # ~0.1 m at the equator
+HEADER = struct.Struct("<BBHI")
+RECORD = struct.Struct("<IiiI")
+MAX_RECORDS_PER_FRAME = 0xFFFF
+
+LOCATION_EVENT = "locations"
+INDEX_EVENT = "location_index"
+BINARY_ROOM = "locations_binary"
+
+
+def encode_frame(epoch: int, records: List[Tuple[int, float, float, float]]) -> bytes:
+    """Pack (driver index, lat, lng, timestamp) records into one frame"""
+    frame = bytearray(HEADER.size + RECORD.size * len(records))
+    HEADER.pack_into(frame, 0, FRAME_VERSION, 0, len(records), epoch)
+    offset = HEADER.size
+    for index, lat, lng, timestamp in records:
+        RECORD.pack_into(frame, offset, index, round(lat * COORD_SCALE), round(lng * COORD_SCALE), int(timestamp))
+        offset += RECORD.size
+    return bytes(frame)
+
+
+def decode_frame(frame: bytes) -> Tuple[int, List[Tuple[int, float, float, int]]]:
+    """(epoch, [(driver index, lat, lng, unix seconds), ...]); reference decoder for clients and tests"""
+    version, _flags, count, epoch = HEADER.unpack_from(frame, 0)
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unsupported location frame version {version}")
+    records = [
+        (index, lat / COORD_SCALE, lng / COORD_SCALE, timestamp)
+        for index, lat, lng, timestamp in RECORD.iter_unpack(frame[HEADER.size:HEADER.size + count * RECORD.size])
+    ]
+    return epoch, records
+
+
+class DriverIndex:
+    """Stable driver id -> small integer mapping for this worker, bounded to recently moving drivers"""
+
+    def __init__(self, idle_seconds: float = 300):
+        self.idle_seconds = idle_seconds
+        self.epoch = random.getrandbits(32)
+        self._indexes: Dict[str, int] = {}
+        self._last_seen: Dict[str, float] = {}
+        self._next_index = 0
+
+    def get(self, driver_id: str, now: Optional[float] = None) -> Tuple[int, bool]:
+        """(index, newly assigned)"""
+        self._last_seen[driver_id] = time.monotonic() if now is None else now
+        index = self._indexes.get(driver_id)
+        if index is not None:
+            return index, False
+        index = self._indexes[driver_id] = self._next_index
+        self._next_index += 1
+        return index, True
+
+    def table(self, since: Optional[float] = None) -> Dict[str, object]:
+        """The index table; with `since`, only drivers seen at or after that monotonic time"""
+        return {"epoch": self.epoch, "drivers": {
+            index: driver_id for driver_id, index in self._indexes.items()
+            if since is None or self._last_seen[driver_id] >= since
+        }}
+
+    def expire(self, now: Optional[float] = None) -> bool:
+        """
+        Forget drivers idle for idle_seconds. Returns True when the remaining ones were
+        renumbered under a new epoch, in which case the full table must be announced
+        """
+        now = time.monotonic() if now is None else now
+        for driver_id in [d for d, seen in self._last_seen.items() if seen < now - self.idle_seconds]:
+            del self._indexes[driver_id]
+            del self._last_seen[driver_id]
+        if self._next_index < 2 * len(self._indexes) or self._next_index < 64:
+            return False
+        # Most indexes of this epoch are unused: start a new one with small, dense indexes
+        self.epoch = random.getrandbits(32)
+        self._indexes = {driver_id: index for index, driver_id in enumerate(self._indexes)}
+        self._next_index = len(self._indexes)
+        return True
+
+
+class LocationBatcher:
+    """Collects the latest ping per driver and flushes them as binary frames"""
+
+    def __init__(
+        self,
+        sio,
+        interval_seconds: float = 0.25,
+        room: str = BINARY_ROOM,
+        index_resend_seconds: float = 30,
+        index_idle_seconds: float = 300
+    ):
+        self.sio = sio
+        self.interval_seconds = interval_seconds
+        self.room = room
+        self.index = DriverIndex(index_idle_seconds)
+        self.index_resend_seconds = index_resend_seconds
+        self._index_sent_at = time.monotonic()
+        self._pending: Dict[str, Tuple[float, float, float]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "frames": 0, "records": 0, "bytes": 0, "index_resends": 0, "index_rotations": 0, "last_flush_ms": 0.0
+        }
+
+    def add(self, driver_id: str, lat: float, lng: float, timestamp: Optional[float] = None):
+        """Cheap O(1) call on the ping path; a later ping for the same driver replaces this one"""
+        self._pending[driver_id] = (lat, lng, timestamp if timestamp is not None else time.time())
+
+    def _take_records(self) -> Tuple[List[Tuple[int, float, float, float]], Dict[int, str]]:
+        pending, self._pending = self._pending, {}
+        records, new_drivers = [], {}
+        for driver_id, (lat, lng, timestamp) in pending.items():
+            index, is_new = self.index.get(driver_id)
+            if is_new:
+                new_drivers[index] = driver_id
+            records.append((index, lat, lng, timestamp))
+        return records, new_drivers
+
+    async def flush(self) -> int:
+        """Send everything collected since the last flush; returns the number of records"""
+        if not self._pending:
+            return 0
+        started = time.perf_counter()
+        records, new_drivers = self._take_records()
+        if new_drivers:
+            await self.sio.emit(INDEX_EVENT, {"epoch": self.index.epoch, "drivers": new_drivers}, room=self.room)
+        for start in range(0, len(records), MAX_RECORDS_PER_FRAME):
+            frame = encode_frame(self.index.epoch, records[start:start + MAX_RECORDS_PER_FRAME])
+            await self.sio.emit(LOCATION_EVENT, frame, room=self.room)
+            self.stats["frames"] += 1
+            self.stats["bytes"] += len(frame)
+        self.stats["records"] += len(records)
+        self.stats["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        return len(records)
+
+    async def resend_index(self) -> bool:
+        """
+        Indexes of the drivers that moved since the last resend, for clients on other workers,
+        which never saw the earlier announcements. Expires idle drivers first; after an epoch
+        rotation the full table is sent, even when periodic resends are off
+        """
+        rotated = self.index.expire()
+        since, self._index_sent_at = self._index_sent_at, time.monotonic()
+        if rotated:
+            table = self.index.table()
+            self.stats["index_rotations"] += 1
+        elif self.index_resend_seconds:
+            table = self.index.table(since)
+            if not table["drivers"]:
+                return False
+        else:
+            return False
+        await self.sio.emit(INDEX_EVENT, table, room=self.room)
+        self.stats["index_resends"] += 1
+        return True
+
+    async def _run_forever(self):
+        # Without periodic resends idle drivers are still expired, once per idle window
+        resend_every = self.index_resend_seconds or self.index.idle_seconds
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                if time.monotonic() - self._index_sent_at >= resend_every:
+                    await self.resend_index()
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Location frame flush failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
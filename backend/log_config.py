@@ -0,0 +1,111 @@
+"""
+Logging Setup
+تنظیمات لاگ (ساخت‌یافته، نمونه‌برداری‌شده و خارج از event loop)
+
+Log records are put on a queue by the caller and formatted/written by a
+QueueListener thread, so the event loop never blocks on stdout or a log file.
+LOG_FORMAT=json writes one JSON object per line for log shippers. High-volume
+socket logs (connect/disconnect/join) go through a per-event sampling filter,
+and the very chatty python-socketio/engineio packet loggers get their own level.
+"""
+
+import json
+import logging
+import queue
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# LogRecord attributes that are not user-supplied `extra` fields
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record; `extra={...}` fields are included as keys"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    The stock prepare() formats the record in the caller (for pickling); the
+    queue here is in-process, so the record can be passed through untouched.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """Pass one record in `every` per event (the `event` extra, else the message template)"""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = max(1, every)
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.every == 1:
+            return True
+        key = getattr(record, "event", record.msg)
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        if count % self.every:
+            return False
+        record.sample_rate = self.every
+        return True
+
+
+def configure_logging(
+    level: str = "INFO",
+    fmt: str = "text",
+    use_queue: bool = True,
+    socketio_level: str = "WARNING",
+) -> Optional[QueueListener]:
+    """Configure the root logger; returns the started listener (stop it on shutdown) when queued"""
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+
+    root = logging.getLogger()
+    root.setLevel(level.upper())
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+
+    listener = None
+    if use_queue:
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        root.addHandler(DeferredQueueHandler(log_queue))
+        listener = QueueListener(log_queue, handler, respect_handler_level=True)
+        listener.start()
+    else:
+        root.addHandler(handler)
+
+    for name in ("socketio", "engineio"):
+        logging.getLogger(name).setLevel(socketio_level.upper())
+    return listener
+
+
+def sampled_logger(name: str, every: int) -> logging.Logger:
+    """Logger for high-frequency events that keeps one record in `every` per event"""
+    logger = logging.getLogger(name)
+    if not any(isinstance(f, SamplingFilter) for f in logger.filters):
+        logger.addFilter(SamplingFilter(every))
+    return logger
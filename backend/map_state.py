@@ -0,0 +1,196 @@
+"""
+Live Map State
+وضعیت زنده نقشه رانندگان
+
+Compact, versioned state of every online driver for the admin live map.
+Admins load a snapshot once ([id, lat, lng, status, version] rows) and then
+receive "map_delta" events with only the drivers that moved noticeably,
+changed status or went offline, so watching 10k+ drivers costs bandwidth in
+proportion to change, not fleet size.
+
+Each worker keeps its own state (fed by local pings and trip transitions, and
+by a periodic incremental sync from MongoDB for pings handled elsewhere) and
+pushes its deltas only to the admins connected to it. Versions are scoped by
+a per-worker epoch; a client that sees another epoch or a gap reloads.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MAP_ROOM = "live_map"
+STATUS_AVAILABLE = "available"
+STATUS_ON_TRIP = "on_trip"
+ON_TRIP_STATUSES = ["accepted", "in_progress"]
+COORD_DECIMALS = 5  # ~1 m
+
+# Entry fields: [lat, lng, status, version, last_seen (monotonic)]
+LAT, LNG, STATUS, VERSION, LAST_SEEN = range(5)
+
+
+class MapState:
+    def __init__(
+        self,
+        db,
+        sio,
+        namespace: str,
+        stale_seconds: float = 60,
+        interval_seconds: float = 1.0,
+        sync_seconds: float = 5.0,
+        min_move_deg: float = 0.0001,
+        max_tombstones: int = 10000
+    ):
+        self.db = db
+        self.sio = sio
+        self.namespace = namespace
+        self.stale_seconds = stale_seconds
+        self.interval_seconds = interval_seconds
+        self.sync_seconds = sync_seconds
+        self.min_move_deg = min_move_deg  # smaller moves only refresh last_seen
+        self.max_tombstones = max_tombstones
+        self.epoch = random.getrandbits(32)
+        self.version = 0
+        self.pushed_version = 0
+        self._drivers: Dict[str, List[Any]] = {}
+        self._removed: Dict[str, int] = {}  # driver_id -> version of removal
+        self._floor = 0  # deltas from older versions are no longer possible
+        self._last_sync: Optional[str] = None
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {"deltas": 0, "delta_rows": 0, "syncs": 0, "expired": 0}
+
+    def _bump(self) -> int:
+        self.version += 1
+        return self.version
+
+    # ----------- Changes -----------
+    def update_location(self, driver_id: str, lat: float, lng: float, status: Optional[str] = None):
+        now = time.monotonic()
+        lat, lng = round(lat, COORD_DECIMALS), round(lng, COORD_DECIMALS)
+        entry = self._drivers.get(driver_id)
+        if entry is None:
+            self._removed.pop(driver_id, None)
+            self._drivers[driver_id] = [lat, lng, status or STATUS_AVAILABLE, self._bump(), now]
+            return
+        entry[LAST_SEEN] = now
+        status = status or entry[STATUS]
+        if (abs(entry[LAT] - lat) >= self.min_move_deg or abs(entry[LNG] - lng) >= self.min_move_deg
+                or entry[STATUS] != status):
+            entry[LAT], entry[LNG], entry[STATUS], entry[VERSION] = lat, lng, status, self._bump()
+
+    def set_status(self, driver_id: str, status: str):
+        entry = self._drivers.get(driver_id)
+        if entry is not None and entry[STATUS] != status:
+            entry[STATUS], entry[VERSION] = status, self._bump()
+
+    def remove(self, driver_id: str):
+        if self._drivers.pop(driver_id, None) is None:
+            return
+        self._removed[driver_id] = self._bump()
+        if len(self._removed) > self.max_tombstones:
+            # Drop the older half; clients behind them have to reload the snapshot
+            ordered = sorted(self._removed.items(), key=lambda item: item[1])
+            cut = ordered[len(ordered) // 2]
+            self._floor = cut[1]
+            self._removed = dict(ordered[len(ordered) // 2 + 1:])
+
+    def expire_stale(self) -> int:
+        cutoff = time.monotonic() - self.stale_seconds
+        stale = [driver_id for driver_id, entry in self._drivers.items() if entry[LAST_SEEN] < cutoff]
+        for driver_id in stale:
+            self.remove(driver_id)
+        self.stats["expired"] += len(stale)
+        return len(stale)
+
+    # ----------- Reads -----------
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "epoch": self.epoch,
+            "version": self.version,
+            "drivers": [[driver_id, e[LAT], e[LNG], e[STATUS], e[VERSION]] for driver_id, e in self._drivers.items()],
+        }
+
+    def delta(self, since: int) -> Optional[Dict[str, Any]]:
+        """Changes after `since`, or None when the client must reload the snapshot"""
+        if since < self._floor or since > self.version:
+            return None
+        return {
+            "epoch": self.epoch,
+            "from": since,
+            "to": self.version,
+            "upserts": [
+                [driver_id, e[LAT], e[LNG], e[STATUS], e[VERSION]]
+                for driver_id, e in self._drivers.items() if e[VERSION] > since
+            ],
+            "removes": [driver_id for driver_id, version in self._removed.items() if version > since],
+        }
+
+    # ----------- Sync & push -----------
+    async def sync_from_db(self):
+        """Pick up pings and trip transitions handled by other workers"""
+        now = datetime.now(timezone.utc)
+        since = self._last_sync or (now - timedelta(seconds=self.stale_seconds)).isoformat()
+        drivers, on_trip = await asyncio.gather(
+            self.db.users.find(
+                {"role": "driver", "location_updated_at": {"$gt": since}},
+                {"_id": 0, "id": 1, "current_location": 1, "is_active": 1}
+            ).to_list(None),
+            self.db.trips.distinct("driver_id", {"status": {"$in": ON_TRIP_STATUSES}}),
+        )
+        self._last_sync = now.isoformat()
+        for driver in drivers:
+            location = driver.get("current_location") or {}
+            if not driver.get("is_active"):
+                self.remove(driver["id"])
+            elif location.get("lat") is not None and location.get("lng") is not None:
+                self.update_location(driver["id"], location["lat"], location["lng"])
+        on_trip = set(on_trip)
+        for driver_id in list(self._drivers):
+            self.set_status(driver_id, STATUS_ON_TRIP if driver_id in on_trip else STATUS_AVAILABLE)
+        self.stats["syncs"] += 1
+
+    async def push(self):
+        """Send the changes since the previous push to the admins on this worker"""
+        if self.version == self.pushed_version:
+            return
+        delta = self.delta(self.pushed_version)
+        self.pushed_version = self.version
+        if delta is None:
+            delta = {**self.snapshot(), "reload": True}
+        else:
+            self.stats["deltas"] += 1
+            self.stats["delta_rows"] += len(delta["upserts"]) + len(delta["removes"])
+        await self.sio.emit("map_delta", delta, room=MAP_ROOM, namespace=self.namespace, ignore_queue=True)
+
+    async def _push_forever(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                self.expire_stale()
+                await self.push()
+            except Exception as e:
+                logger.error(f"Live map push failed: {e}")
+
+    async def _sync_forever(self):
+        while True:
+            try:
+                await self.sync_from_db()
+            except Exception as e:
+                logger.error(f"Live map sync failed: {e}")
+            await asyncio.sleep(self.sync_seconds)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._sync_forever()),
+                asyncio.create_task(self._push_forever()),
+            ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
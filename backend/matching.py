@@ -0,0 +1,158 @@
+"""
+Driver–Trip Matching Engine
+موتور تخصیص سفر به راننده
+
+Collects pending trips and available drivers over a short window and solves
+the assignment on an ETA cost matrix instead of letting every driver race
+for every trip.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:  # SciPy is optional; the greedy solver is used without it
+    linear_sum_assignment = None
+
+logger = logging.getLogger(__name__)
+
+INFEASIBLE = np.inf
+
+
+def greedy_assignment(cost: np.ndarray) -> List[Tuple[int, int]]:
+    """Repeatedly take the cheapest remaining (row, col) pair; rows/cols are used once"""
+    if cost.size == 0:
+        return []
+    order = np.argsort(cost, axis=None)
+    rows, cols = np.unravel_index(order, cost.shape)
+    used_rows, used_cols = set(), set()
+    pairs = []
+    limit = min(cost.shape)
+    for r, c in zip(rows.tolist(), cols.tolist()):
+        if not np.isfinite(cost[r, c]):
+            break  # sorted ascending, everything after is infeasible too
+        if r in used_rows or c in used_cols:
+            continue
+        used_rows.add(r)
+        used_cols.add(c)
+        pairs.append((r, c))
+        if len(pairs) == limit:
+            break
+    return pairs
+
+
+def optimal_assignment(cost: np.ndarray) -> List[Tuple[int, int]]:
+    """Minimum total cost assignment (Hungarian); infeasible pairs are dropped"""
+    if cost.size == 0:
+        return []
+    finite = np.isfinite(cost)
+    if not finite.any():
+        return []
+    penalty = cost[finite].max() * 10 + 1e6
+    rows, cols = linear_sum_assignment(np.where(finite, cost, penalty))
+    return [(r, c) for r, c in zip(rows.tolist(), cols.tolist()) if finite[r, c]]
+
+
+class MatchingEngine:
+    """
+    Batched matcher. The caller supplies three coroutines:
+    - load_trips() -> [{"id", "origin": {lat, lng}, "rejected_driver_ids": [...]}]
+    - load_drivers() -> [{"id", "lat", "lng"}]
+    - make_offer(trip, driver, pickup_km, pickup_minutes) -> bool (False if the trip was taken meanwhile)
+    """
+
+    def __init__(
+        self,
+        routing_service,
+        load_trips: Callable[[], Awaitable[List[Dict[str, Any]]]],
+        load_drivers: Callable[[], Awaitable[List[Dict[str, Any]]]],
+        make_offer: Callable[..., Awaitable[bool]],
+        window_seconds: float = 2.0,
+        max_pickup_km: float = 5.0,
+        solver: str = "auto"
+    ):
+        self.routing_service = routing_service
+        self.load_trips = load_trips
+        self.load_drivers = load_drivers
+        self.make_offer = make_offer
+        self.window_seconds = window_seconds
+        self.max_pickup_km = max_pickup_km
+        self.use_hungarian = solver == "hungarian" or (solver == "auto" and linear_sum_assignment is not None)
+        if self.use_hungarian and linear_sum_assignment is None:
+            logger.warning("SciPy is not installed, falling back to greedy matching")
+            self.use_hungarian = False
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "rounds": 0,
+            "offers_sent": 0,
+            "last_round_ms": 0.0,
+            "avg_round_ms": 0.0,
+            "max_round_ms": 0.0,
+            "last_pending_trips": 0,
+            "last_available_drivers": 0,
+            "last_utilisation": 0.0,
+            "solver": "hungarian" if self.use_hungarian else "greedy",
+        }
+
+    def build_cost_matrix(self, drivers, trips, distances: np.ndarray, durations: np.ndarray) -> np.ndarray:
+        """Pickup ETA per (driver, trip); too far or previously rejected pairs are infeasible"""
+        cost = np.where(distances <= self.max_pickup_km, durations, INFEASIBLE)
+        for j, trip in enumerate(trips):
+            rejected = set(trip.get("rejected_driver_ids") or ())
+            if rejected:
+                for i, driver in enumerate(drivers):
+                    if driver["id"] in rejected:
+                        cost[i, j] = INFEASIBLE
+        return cost
+
+    async def run_once(self) -> int:
+        """Match one window of pending trips; returns the number of offers sent"""
+        started = time.perf_counter()
+        trips = await self.load_trips()
+        drivers = await self.load_drivers() if trips else []
+        offers = 0
+
+        if trips and drivers:
+            distances, durations = await self.routing_service.matrix(
+                [(d["lat"], d["lng"]) for d in drivers],
+                [(t["origin"]["lat"], t["origin"]["lng"]) for t in trips]
+            )
+            cost = self.build_cost_matrix(drivers, trips, distances, durations)
+            pairs = optimal_assignment(cost) if self.use_hungarian else greedy_assignment(cost)
+            for i, j in pairs:
+                if await self.make_offer(trips[j], drivers[i], float(distances[i, j]), float(durations[i, j])):
+                    offers += 1
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        stats = self.stats
+        stats["rounds"] += 1
+        stats["offers_sent"] += offers
+        stats["last_round_ms"] = round(elapsed_ms, 2)
+        stats["avg_round_ms"] = round(stats["avg_round_ms"] + (elapsed_ms - stats["avg_round_ms"]) / stats["rounds"], 2)
+        stats["max_round_ms"] = round(max(stats["max_round_ms"], elapsed_ms), 2)
+        stats["last_pending_trips"] = len(trips)
+        stats["last_available_drivers"] = len(drivers)
+        stats["last_utilisation"] = round(offers / len(drivers), 3) if drivers else 0.0
+        return offers
+
+    async def _run_forever(self):
+        while True:
+            await asyncio.sleep(self.window_seconds)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Matching round failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
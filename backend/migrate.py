@@ -0,0 +1,208 @@
+"""
+One-off Data Migrations
+مهاجرت‌های یک‌باره داده
+
+Cleanups that older data needs before a unique index can be built. They are
+run by an operator, never at startup. Every command only reports what it
+would change unless --apply is given.
+
+    python migrate.py active-trips            # dry run
+    python migrate.py active-trips --apply
+    python migrate.py users
+    python migrate.py read-cursors
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure
+
+from archive import ARCHIVE_COLLECTION
+
+logger = logging.getLogger("migrate")
+
+ACTIVE_TRIP_STATUSES = ["pending", "accepted", "in_progress"]
+# Most advanced first: the trip a passenger keeps when they have several active ones
+ACTIVE_TRIP_PRIORITY = {"in_progress": 0, "accepted": 1, "pending": 2}
+
+
+async def create_active_trip_index(db):
+    await db.trips.create_index(
+        [("passenger_id", 1)],
+        name="one_active_trip_per_passenger",
+        unique=True,
+        partialFilterExpression={"status": {"$in": ACTIVE_TRIP_STATUSES}}
+    )
+
+
+async def migrate_active_trips(db, apply: bool = False) -> List[Dict]:
+    """
+    Keep one active trip per passenger (the most advanced, then the newest), cancel the
+    others with cancel_reason "duplicate" and tell the passenger, then build the unique index
+    """
+    duplicates = await db.trips.aggregate([
+        {"$match": {"status": {"$in": ACTIVE_TRIP_STATUSES}}},
+        {"$group": {
+            "_id": "$passenger_id",
+            "trips": {"$push": {"id": "$id", "status": "$status", "created_at": "$created_at"}},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ]).to_list(None)
+
+    plan = []
+    for group in duplicates:
+        trips = sorted(group["trips"], key=lambda t: t.get("created_at") or "", reverse=True)
+        trips.sort(key=lambda t: ACTIVE_TRIP_PRIORITY[t["status"]])
+        plan.append({"passenger_id": group["_id"], "keep": trips[0]["id"], "cancel": [t["id"] for t in trips[1:]]})
+        logger.info(f"Passenger {group['_id']}: keep {trips[0]['id']}, cancel {[t['id'] for t in trips[1:]]}")
+
+    if not apply:
+        logger.info(f"Dry run: {sum(len(p['cancel']) for p in plan)} trips of {len(plan)} passengers would be cancelled")
+        return plan
+
+    now = datetime.now(timezone.utc).isoformat()
+    cancel_ids = [trip_id for p in plan for trip_id in p["cancel"]]
+    if cancel_ids:
+        result = await db.trips.update_many(
+            {"id": {"$in": cancel_ids}, "status": {"$in": ACTIVE_TRIP_STATUSES}},
+            {"$set": {"status": "cancelled", "cancelled_at": now, "cancel_reason": "duplicate"}}
+        )
+        await db.notifications.insert_many([
+            {
+                "id": str(uuid.uuid4()),
+                "user_id": p["passenger_id"],
+                "role": "passenger",
+                "message": "سفرهای تکراری شما لغو شد؛ فقط یک سفر فعال باقی مانده است",
+                "created_at": now,
+                "is_read": False,
+            }
+            for p in plan
+        ])
+        logger.info(f"Cancelled {result.modified_count} duplicate active trips")
+    await create_active_trip_index(db)
+    logger.info("Created the one_active_trip_per_passenger index")
+    return plan
+
+
+async def create_user_phone_index(db):
+    await db.users.create_index([("phone", 1), ("role", 1)], unique=True)
+
+
+async def migrate_users(db, apply: bool = False) -> List[Dict]:
+    """
+    Delete duplicate users (same phone and role) that no trip or finance record refers to,
+    keeping the oldest, then replace the phone/role index with a unique one. Duplicates with
+    history are only reported; they must be merged by hand before the index can be built
+    """
+    duplicates = await db.users.aggregate([
+        {"$group": {
+            "_id": {"phone": "$phone", "role": "$role"},
+            "users": {"$push": {"id": "$id", "created_at": "$created_at"}},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ]).to_list(None)
+
+    extra_ids = [
+        user["id"]
+        for group in duplicates
+        for user in sorted(group["users"], key=lambda u: u.get("created_at") or "")[1:]
+    ]
+    # One lookup per collection for every duplicate at once
+    in_use = set()
+    for collection in (db.trips, db[ARCHIVE_COLLECTION]):
+        in_use.update(await collection.distinct("passenger_id", {"passenger_id": {"$in": extra_ids}}))
+        in_use.update(await collection.distinct("driver_id", {"driver_id": {"$in": extra_ids}}))
+    in_use.update(await db.driver_finances.distinct("driver_id", {"driver_id": {"$in": extra_ids}}))
+
+    plan = []
+    for group in duplicates:
+        users = sorted(group["users"], key=lambda u: u.get("created_at") or "")
+        extras = [user["id"] for user in users[1:]]
+        plan.append({
+            **group["_id"],
+            "keep": users[0]["id"],
+            "delete": [user_id for user_id in extras if user_id not in in_use],
+            "merge": [user_id for user_id in extras if user_id in in_use],
+        })
+        logger.info(f"{group['_id']}: keep {users[0]['id']}, delete {plan[-1]['delete']}, merge by hand {plan[-1]['merge']}")
+
+    delete_ids = [user_id for p in plan for user_id in p["delete"]]
+    merge_count = sum(len(p["merge"]) for p in plan)
+    if not apply:
+        logger.info(f"Dry run: {len(delete_ids)} unused duplicate users would be deleted, {merge_count} have history")
+        return plan
+
+    if delete_ids:
+        result = await db.users.delete_many({"id": {"$in": delete_ids}})
+        logger.info(f"Deleted {result.deleted_count} unused duplicate users")
+    if merge_count:
+        logger.error(f"{merge_count} duplicate users have history; merge them by hand, then run this again")
+        return plan
+    indexes = await db.users.index_information()
+    if "phone_1_role_1" in indexes and not indexes["phone_1_role_1"].get("unique"):
+        await db.users.drop_index("phone_1_role_1")  # the earlier non-unique version
+    await create_user_phone_index(db)
+    logger.info("Created the unique phone/role index on users")
+    return plan
+
+
+async def migrate_read_cursors(db, apply: bool = False) -> List[Dict]:
+    """
+    Reset notification read cursors stored before up_to was validated. A value after now
+    (e.g. "z" sorts after every timestamp) would hide every future notification as read
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    bad = await db.notification_reads.find(
+        {"last_read_at": {"$gt": now}}, {"_id": 0, "user_id": 1, "last_read_at": 1}
+    ).to_list(None)
+    for cursor in bad:
+        logger.info(f"User {cursor['user_id']}: last_read_at {cursor['last_read_at']!r} -> {now}")
+
+    if not apply:
+        logger.info(f"Dry run: {len(bad)} read cursors would be reset")
+        return bad
+
+    result = await db.notification_reads.update_many({"last_read_at": {"$gt": now}}, {"$set": {"last_read_at": now}})
+    logger.info(f"Reset {result.modified_count} read cursors")
+    return bad
+
+
+MIGRATIONS = {
+    "active-trips": migrate_active_trips,
+    "users": migrate_users,
+    "read-cursors": migrate_read_cursors,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run a one-off data migration")
+    parser.add_argument("migration", choices=sorted(MIGRATIONS))
+    parser.add_argument("--apply", action="store_true", help="write the changes (default: dry run)")
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    load_dotenv()
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+    try:
+        await MIGRATIONS[args.migration](client[os.environ["DB_NAME"]], apply=args.apply)
+    except OperationFailure as e:
+        logger.error(f"Migration {args.migration} failed: {e}")
+        raise SystemExit(1)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,200 @@
+"""
+Query Profiler (development / staging)
+پروفایلر کوئری‌ها و تشخیص N+1
+
+Opt-in, request-scoped profiling of MongoDB commands. Every command issued
+while handling a request is recorded with its filter shape (values replaced by
+"?"), so a route that exceeds its query budget or repeats the same shape more
+than K times - the usual N+1 loop - is reported. In "raise" mode the request
+fails instead, which makes the check usable from tests. Sending the debug
+header logs the full per-request timeline.
+
+Like the metrics listener, profiles are attached through a context variable
+that Motor copies into its executor threads.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+from instrumentation import IGNORED_COMMANDS, route_label
+
+logger = logging.getLogger(__name__)
+
+PROFILER_MODES = ("off", "warn", "raise")
+DEBUG_HEADER = "x-debug-queries"
+
+# Where each command keeps its filter
+_FILTER_FIELDS = {
+    "find": "filter",
+    "count": "query",
+    "distinct": "query",
+    "findAndModify": "query",
+}
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised in "raise" mode when a request breaks its query budget or repeat limit"""
+
+
+def query_shape(value: Any) -> Any:
+    """Filter with every literal replaced by "?" (operators and field names are kept)"""
+    if isinstance(value, dict):
+        return {key: query_shape(value[key]) for key in sorted(value)}
+    if isinstance(value, (list, tuple)):
+        # $in lists of any length have the same shape
+        shapes = []
+        for item in value:
+            shape = query_shape(item)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return "?"
+
+
+def command_shape(command_name: str, command: Dict[str, Any]) -> str:
+    if command_name in _FILTER_FIELDS:
+        shape = query_shape(command.get(_FILTER_FIELDS[command_name]) or {})
+    elif command_name == "aggregate":
+        shape = [query_shape(stage) for stage in command.get("pipeline", [])]
+    elif command_name == "update":
+        shape = query_shape([u.get("q", {}) for u in command.get("updates", [])])
+    elif command_name == "delete":
+        shape = query_shape([d.get("q", {}) for d in command.get("deletes", [])])
+    else:
+        shape = ""
+    return repr(shape)
+
+
+class QueryProfile:
+    """Mongo commands issued on behalf of one request (or one test block)"""
+
+    def __init__(self, label: str, budget: int, repeat_limit: int):
+        self.label = label
+        self.budget = budget
+        self.repeat_limit = repeat_limit
+        self.started = time.perf_counter()
+        self.timeline: List[Dict[str, Any]] = []
+        self.shape_counts: Dict[Tuple[str, str, str], int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, command: str, collection: str, shape: str, offset: float, seconds: float, failed: bool):
+        key = (command, collection, shape)
+        with self._lock:
+            self.timeline.append({
+                "offset_ms": round(offset * 1000, 2),
+                "duration_ms": round(seconds * 1000, 2),
+                "command": command,
+                "collection": collection,
+                "shape": shape,
+                "failed": failed,
+            })
+            self.shape_counts[key] = self.shape_counts.get(key, 0) + 1
+
+    @property
+    def query_count(self) -> int:
+        return len(self.timeline)
+
+    def problems(self) -> List[str]:
+        problems = []
+        if self.budget and self.query_count > self.budget:
+            problems.append(f"{self.query_count} Mongo commands (budget {self.budget})")
+        for (command, collection, shape), count in self.shape_counts.items():
+            if self.repeat_limit and count > self.repeat_limit:
+                problems.append(f"{command} on {collection} repeated {count} times with shape {shape} (possible N+1)")
+        return problems
+
+    def check(self, mode: str = "raise"):
+        problems = self.problems()
+        if not problems:
+            return
+        message = f"{self.label}: " + "; ".join(problems)
+        if mode == "raise":
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+    def format_timeline(self) -> str:
+        lines = [f"{self.label}: {self.query_count} Mongo commands"]
+        for entry in sorted(self.timeline, key=lambda e: e["offset_ms"]):
+            lines.append(
+                f"  +{entry['offset_ms']:>8.2f}ms {entry['duration_ms']:>7.2f}ms "
+                f"{entry['command']} {entry['collection']} {entry['shape']}"
+                + (" FAILED" if entry["failed"] else "")
+            )
+        return "\n".join(lines)
+
+
+current_profile: ContextVar[Optional[QueryProfile]] = ContextVar("current_profile", default=None)
+
+
+class QueryProfilerListener(monitoring.CommandListener):
+    """Adds each command to the profile of the request that issued it"""
+
+    def __init__(self):
+        self._pending: Dict[Tuple[int, object], Tuple[QueryProfile, str, str, str, float]] = {}
+
+    def started(self, event):
+        profile = current_profile.get()
+        if profile is None or event.command_name in IGNORED_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        if not isinstance(collection, str):
+            collection = ""
+        self._pending[(event.request_id, event.connection_id)] = (
+            profile, event.command_name, collection,
+            command_shape(event.command_name, event.command),
+            time.perf_counter() - profile.started,
+        )
+
+    def _finish(self, event, failed: bool):
+        pending = self._pending.pop((event.request_id, event.connection_id), None)
+        if pending is None:
+            return
+        profile, command, collection, shape, offset = pending
+        profile.record(command, collection, shape, offset, event.duration_micros / 1_000_000, failed)
+
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+
+    def failed(self, event):
+        self._finish(event, failed=True)
+
+
+@contextmanager
+def profile_queries(label: str = "block", budget: int = 0, repeat_limit: int = 0):
+    """Profile the commands issued inside the block, e.g. in a test:
+
+        with profile_queries("driver analytics", budget=5, repeat_limit=2) as profile:
+            await client.get("/api/admin/analytics/drivers")
+        profile.check()
+    """
+    profile = QueryProfile(label, budget, repeat_limit)
+    token = current_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        current_profile.reset(token)
+
+
+async def profile_request(request, call_next, mode: str, budget: int, repeat_limit: int):
+    """HTTP middleware body: profile the request, then warn/raise and dump the timeline on demand"""
+    profile = QueryProfile(f"{request.method} {request.url.path}", budget, repeat_limit)
+    token = current_profile.set(profile)
+    try:
+        response = await call_next(request)
+    finally:
+        current_profile.reset(token)
+
+    profile.label = f"{request.method} {route_label(request.scope)}"
+    if request.headers.get(DEBUG_HEADER):
+        logger.info(profile.format_timeline())
+        response.headers["X-Query-Count"] = str(profile.query_count)
+    profile.check(mode)
+    return response
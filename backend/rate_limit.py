@@ -0,0 +1,188 @@
+"""
+Rate Limiting & Admission Control
+محدودسازی نرخ درخواست‌ها و کنترل پذیرش
+
+Token buckets per client (user id and IP) for the hot public endpoints, kept in
+worker memory or, with RATE_LIMIT_REDIS_URL, in Redis so every worker shares
+them. Checks run as route dependencies, before any MongoDB work, and reject
+with a cheap 429 + Retry-After.
+
+AdmissionController is a global guard in front of every route: it sheds
+requests with 503 when too many are in flight or the event loop lags, so a
+saturated worker fails fast instead of queueing.
+"""
+
+import logging
+import math
+import time
+from typing import Callable, Optional
+
+from cachetools import TTLCache
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:  # optional: only needed for a shared limiter
+    redis_asyncio = None
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimit:
+    def __init__(self, burst: int, per_second: float):
+        self.burst = burst            # bucket capacity
+        self.per_second = per_second  # refill rate
+
+    @classmethod
+    def parse(cls, spec: str) -> Optional["RateLimit"]:
+        """"10/60" = 10 requests per 60 seconds (bursts up to 10); "0" or "" disables"""
+        if not spec or spec.strip() == "0":
+            return None
+        count, _, seconds = spec.partition("/")
+        count, seconds = int(count), float(seconds or 1)
+        return cls(burst=count, per_second=count / seconds)
+
+    def scaled(self, factor: float) -> "RateLimit":
+        return RateLimit(burst=max(1, int(self.burst * factor)), per_second=self.per_second * factor)
+
+
+class MemoryBackend:
+    """Per-worker buckets; idle buckets expire once they would be full again"""
+
+    def __init__(self, max_keys: int = 100_000, ttl_seconds: float = 3600):
+        self._buckets = TTLCache(maxsize=max_keys, ttl=ttl_seconds)
+
+    async def take(self, key: str, limit: RateLimit) -> float:
+        """Take one token; returns 0 when allowed, else seconds until a token is available"""
+        now = time.monotonic()
+        tokens, last = self._buckets.get(key, (limit.burst, now))
+        tokens = min(limit.burst, tokens + (now - last) * limit.per_second)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / limit.per_second
+        self._buckets[key] = (tokens - 1, now)
+        return 0.0
+
+
+# Same refill logic as MemoryBackend, atomically in Redis
+_REDIS_TAKE = """
+local burst = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+local tokens = tonumber(bucket[1]) or burst
+local last = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - last) * rate)
+local wait = 0
+if tokens < 1 then
+  wait = (1 - tokens) / rate
+else
+  tokens = tokens - 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'last', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisBackend:
+    """Buckets shared by all workers; fails open if Redis is unavailable"""
+
+    def __init__(self, url: str, prefix: str = "ratelimit:"):
+        if redis_asyncio is None:
+            raise RuntimeError("RATE_LIMIT_REDIS_URL requires the redis package (pip install redis)")
+        self._redis = redis_asyncio.from_url(url)
+        self._script = self._redis.register_script(_REDIS_TAKE)
+        self.prefix = prefix
+
+    async def take(self, key: str, limit: RateLimit) -> float:
+        try:
+            wait = await self._script(keys=[self.prefix + key], args=[limit.burst, limit.per_second, time.time()])
+        except Exception as e:
+            logger.warning(f"Rate limit backend unavailable, allowing request: {e}")
+            return 0.0
+        return float(wait)
+
+
+class RateLimiter:
+    def __init__(self, backend, ip_multiplier: float = 10, trust_forwarded: bool = False):
+        self.backend = backend
+        # Many users can share one IP (mobile carrier NAT), so IP buckets next to a user bucket are looser
+        self.ip_multiplier = ip_multiplier
+        self.trust_forwarded = trust_forwarded
+        self.stats = {"allowed": 0, "limited": 0}
+
+    def client_ip(self, request: Request) -> str:
+        if self.trust_forwarded:
+            forwarded = request.headers.get("x-forwarded-for")
+            if forwarded:
+                return forwarded.split(",")[0].strip()
+        return request.client.host if request.client else "unknown"
+
+    async def retry_after(self, name: str, limit: RateLimit, ip: Optional[str] = None, user: Optional[str] = None) -> float:
+        """0 when the call is allowed, else seconds to wait; checks the user and the IP bucket"""
+        wait = 0.0
+        if user:
+            wait = await self.backend.take(f"{name}:user:{user}", limit)
+        if not wait and ip:
+            # Next to a user bucket the IP bucket only catches clients rotating user ids
+            ip_limit = limit.scaled(self.ip_multiplier) if user else limit
+            wait = await self.backend.take(f"{name}:ip:{ip}", ip_limit)
+        self.stats["limited" if wait else "allowed"] += 1
+        return wait
+
+    def dependency(self, name: str, limit: Optional[RateLimit], user_param: Optional[str] = None) -> Callable:
+        """Route dependency; `user_param` names the path parameter holding the user id"""
+
+        async def check_rate_limit(request: Request):
+            if limit is None:
+                return
+            user = request.path_params.get(user_param) if user_param else None
+            wait = await self.retry_after(name, limit, self.client_ip(request), user)
+            if wait:
+                raise HTTPException(
+                    status_code=429,
+                    detail="تعداد درخواست‌ها بیش از حد مجاز است. لطفاً کمی بعد دوباره تلاش کنید",
+                    headers={"Retry-After": str(math.ceil(wait))}
+                )
+
+        return check_rate_limit
+
+
+class AdmissionController:
+    """Global load shedding by in-flight requests and event-loop lag"""
+
+    def __init__(self, max_in_flight: int, max_loop_lag_ms: float, loop_lag: Callable[[], float], exempt_prefixes=()):
+        self.max_in_flight = max_in_flight
+        self.max_loop_lag_ms = max_loop_lag_ms
+        self.loop_lag = loop_lag
+        self.exempt_prefixes = tuple(exempt_prefixes)
+        self.in_flight = 0
+        self.stats = {"admitted": 0, "shed_in_flight": 0, "shed_loop_lag": 0}
+
+    def _shed_reason(self) -> Optional[str]:
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return "shed_in_flight"
+        if self.max_loop_lag_ms and self.loop_lag() > self.max_loop_lag_ms:
+            return "shed_loop_lag"
+        return None
+
+    async def dispatch(self, request: Request, call_next):
+        """HTTP middleware body"""
+        if request.url.path.startswith(self.exempt_prefixes):
+            return await call_next(request)
+        reason = self._shed_reason()
+        if reason:
+            self.stats[reason] += 1
+            return JSONResponse(
+                status_code=503,
+                content={"detail": "سرور در حال حاضر شلوغ است. لطفاً دوباره تلاش کنید"},
+                headers={"Retry-After": "1"}
+            )
+        self.stats["admitted"] += 1
+        self.in_flight += 1
+        try:
+            return await call_next(request)
+        finally:
+            self.in_flight -= 1
@@ -0,0 +1,337 @@
+"""
+Distance & ETA Service
+سرویس محاسبه مسافت و زمان سفر
+
+Haversine baseline (with a road detour factor) and an optional graph router
+over an offline road network loaded from a local OSM extract.
+"""
+
+import asyncio
+import heapq
+import json
+import logging
+import math
+import os
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from cachetools import LRUCache
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Default speeds (km/h) per OSM highway type when a way has no usable maxspeed tag
+HIGHWAY_SPEEDS_KMH = {
+    "motorway": 80, "motorway_link": 50,
+    "trunk": 60, "trunk_link": 40,
+    "primary": 45, "primary_link": 35,
+    "secondary": 35, "secondary_link": 30,
+    "tertiary": 30, "tertiary_link": 25,
+    "unclassified": 25, "residential": 20,
+    "living_street": 10, "service": 15,
+}
+
+
+class RouteEstimate(NamedTuple):
+    distance_km: float
+    duration_minutes: float
+    source: str  # "haversine" or "graph"
+
+
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance between two points in kilometers"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def haversine_matrix_km(origins: Sequence[Tuple[float, float]], destinations: Sequence[Tuple[float, float]]) -> np.ndarray:
+    """Vectorised great-circle distances: result[i, j] is origins[i] -> destinations[j] in km"""
+    o = np.radians(np.asarray(origins, dtype=np.float64).reshape(-1, 2))
+    d = np.radians(np.asarray(destinations, dtype=np.float64).reshape(-1, 2))
+    lat1, lng1 = o[:, 0:1], o[:, 1:2]
+    lat2, lng2 = d[:, 0][np.newaxis, :], d[:, 1][np.newaxis, :]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def cell_key(lat: float, lng: float, cell_size_deg: float) -> Tuple[int, int]:
+    """Quantise a coordinate to a grid cell (0.001 deg is roughly 100 m)"""
+    return (int(math.floor(lat / cell_size_deg)), int(math.floor(lng / cell_size_deg)))
+
+
+def _parse_maxspeed(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        speed = float(value.split()[0])
+    except ValueError:
+        return None
+    return speed * 1.609 if "mph" in value else speed
+
+
+class RoadGraph:
+    """
+    Directed road network with travel-time weighted edges.
+
+    Supported inputs:
+    - OSM XML extract (.osm), e.g. cut from a regional .pbf with `osmium cat`
+    - Preprocessed JSON: {"nodes": [[id, lat, lng], ...],
+                          "edges": [[from_id, to_id, length_m, speed_kmh], ...]}
+    """
+
+    SNAP_CELL_DEG = 0.01
+
+    def __init__(self, coords: np.ndarray, adjacency: List[List[Tuple[int, float, float]]]):
+        self.coords = coords  # (n, 2) lat/lng
+        self.adjacency = adjacency  # node -> [(neighbor, length_m, time_s)]
+        self.max_speed_ms = max(
+            (length / time for edges in adjacency for _, length, time in edges if time > 0),
+            default=1.0
+        )
+        self._snap_grid: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+        for index, (lat, lng) in enumerate(coords):
+            self._snap_grid[cell_key(lat, lng, self.SNAP_CELL_DEG)].append(index)
+
+    @property
+    def node_count(self) -> int:
+        return len(self.adjacency)
+
+    @classmethod
+    def load(cls, path: str) -> "RoadGraph":
+        if path.endswith(".json"):
+            return cls._load_json(path)
+        return cls._load_osm_xml(path)
+
+    @classmethod
+    def _build(cls, node_ids: Dict[int, int], coords: List[Tuple[float, float]], edges) -> "RoadGraph":
+        adjacency: List[List[Tuple[int, float, float]]] = [[] for _ in coords]
+        for u, v, length_m, speed_kmh in edges:
+            if u in node_ids and v in node_ids and speed_kmh > 0:
+                adjacency[node_ids[u]].append((node_ids[v], length_m, length_m / (speed_kmh / 3.6)))
+        return cls(np.asarray(coords, dtype=np.float64).reshape(-1, 2), adjacency)
+
+    @classmethod
+    def _load_json(cls, path: str) -> "RoadGraph":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        node_ids = {}
+        coords = []
+        for node_id, lat, lng in data["nodes"]:
+            node_ids[node_id] = len(coords)
+            coords.append((lat, lng))
+        return cls._build(node_ids, coords, data["edges"])
+
+    @classmethod
+    def _load_osm_xml(cls, path: str) -> "RoadGraph":
+        # OSM extracts list nodes before ways, so a single streaming pass is enough
+        all_nodes: Dict[int, Tuple[float, float]] = {}
+        ways = []
+        for _, elem in ET.iterparse(path, events=("end",)):
+            if elem.tag == "node":
+                all_nodes[int(elem.get("id"))] = (float(elem.get("lat")), float(elem.get("lon")))
+                elem.clear()
+            elif elem.tag == "way":
+                tags = {t.get("k"): t.get("v") for t in elem.iter("tag")}
+                highway = tags.get("highway")
+                if highway in HIGHWAY_SPEEDS_KMH:
+                    refs = [int(nd.get("ref")) for nd in elem.iter("nd")]
+                    speed = _parse_maxspeed(tags.get("maxspeed")) or HIGHWAY_SPEEDS_KMH[highway]
+                    oneway = tags.get("oneway") in ("yes", "true", "1") or highway.startswith("motorway")
+                    ways.append((refs, speed, oneway))
+                elem.clear()
+
+        node_ids: Dict[int, int] = {}
+        coords: List[Tuple[float, float]] = []
+        edges = []
+        for refs, speed, oneway in ways:
+            for u, v in zip(refs, refs[1:]):
+                if u not in all_nodes or v not in all_nodes:
+                    continue
+                for ref in (u, v):
+                    if ref not in node_ids:
+                        node_ids[ref] = len(coords)
+                        coords.append(all_nodes[ref])
+                length_m = haversine_km(*all_nodes[u], *all_nodes[v]) * 1000
+                edges.append((u, v, length_m, speed))
+                if not oneway:
+                    edges.append((v, u, length_m, speed))
+        return cls._build(node_ids, coords, edges)
+
+    def nearest_node(self, lat: float, lng: float, max_rings: int = 3) -> int:
+        """Snap a coordinate to the closest graph node"""
+        row, col = cell_key(lat, lng, self.SNAP_CELL_DEG)
+        for ring in range(max_rings + 1):
+            candidates = [
+                index
+                for r in range(row - ring, row + ring + 1)
+                for c in range(col - ring, col + ring + 1)
+                for index in self._snap_grid.get((r, c), ())
+            ]
+            if candidates:
+                points = self.coords[candidates]
+                squared = (points[:, 0] - lat) ** 2 + ((points[:, 1] - lng) * math.cos(math.radians(lat))) ** 2
+                return candidates[int(np.argmin(squared))]
+        # Far outside the network: fall back to a full scan
+        squared = (self.coords[:, 0] - lat) ** 2 + (self.coords[:, 1] - lng) ** 2
+        return int(np.argmin(squared))
+
+    def shortest_path(self, source: int, target: int) -> Optional[Tuple[float, float]]:
+        """A* on travel time; returns (length_m, time_s) or None when unreachable"""
+        if source == target:
+            return (0.0, 0.0)
+        target_lat, target_lng = self.coords[target]
+
+        def heuristic(node: int) -> float:
+            lat, lng = self.coords[node]
+            return haversine_km(lat, lng, target_lat, target_lng) * 1000 / self.max_speed_ms
+
+        best_time = {source: 0.0}
+        best_length = {source: 0.0}
+        heap = [(heuristic(source), 0.0, source)]
+        while heap:
+            _, time_s, node = heapq.heappop(heap)
+            if node == target:
+                return (best_length[node], time_s)
+            if time_s > best_time.get(node, math.inf):
+                continue
+            for neighbor, length_m, edge_time in self.adjacency[node]:
+                new_time = time_s + edge_time
+                if new_time < best_time.get(neighbor, math.inf):
+                    best_time[neighbor] = new_time
+                    best_length[neighbor] = best_length[node] + length_m
+                    heapq.heappush(heap, (new_time + heuristic(neighbor), new_time, neighbor))
+        return None
+
+    def one_to_many(self, source: int, targets: Sequence[int]) -> Dict[int, Tuple[float, float]]:
+        """Dijkstra from one node until every target is settled"""
+        remaining = set(targets)
+        best_time = {source: 0.0}
+        best_length = {source: 0.0}
+        settled: Dict[int, Tuple[float, float]] = {}
+        heap = [(0.0, source)]
+        while heap and remaining:
+            time_s, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            settled[node] = (best_length[node], time_s)
+            remaining.discard(node)
+            for neighbor, length_m, edge_time in self.adjacency[node]:
+                new_time = time_s + edge_time
+                if new_time < best_time.get(neighbor, math.inf):
+                    best_time[neighbor] = new_time
+                    best_length[neighbor] = best_length[node] + length_m
+                    heapq.heappush(heap, (new_time, neighbor))
+        return {target: settled[target] for target in targets if target in settled}
+
+
+class RoutingService:
+    """
+    Distance/ETA lookups with an LRU cache keyed by origin/destination grid cells.
+    Graph searches run in a worker thread so they never block the event loop.
+    """
+
+    def __init__(
+        self,
+        graph: Optional[RoadGraph] = None,
+        cache_size: int = 100000,
+        cell_size_deg: float = 0.001,
+        detour_factor: float = 1.3,
+        avg_speed_kmh: float = 25.0
+    ):
+        self.graph = graph
+        self.cell_size_deg = cell_size_deg
+        self.detour_factor = detour_factor
+        self.avg_speed_kmh = avg_speed_kmh
+        self._cache: LRUCache = LRUCache(maxsize=cache_size)
+
+    def set_graph(self, graph: RoadGraph):
+        """Switch to graph routing; cached haversine estimates would otherwise outlive the switch"""
+        self.graph = graph
+        self._cache.clear()
+
+    def _haversine_estimate(self, origin: Tuple[float, float], destination: Tuple[float, float]) -> RouteEstimate:
+        distance_km = haversine_km(*origin, *destination) * self.detour_factor
+        return RouteEstimate(distance_km, distance_km / self.avg_speed_kmh * 60, "haversine")
+
+    def _graph_estimate(self, origin: Tuple[float, float], destination: Tuple[float, float]) -> RouteEstimate:
+        result = self.graph.shortest_path(self.graph.nearest_node(*origin), self.graph.nearest_node(*destination))
+        if result is None:
+            return self._haversine_estimate(origin, destination)
+        length_m, time_s = result
+        return RouteEstimate(length_m / 1000, time_s / 60, "graph")
+
+    async def route(self, origin: Tuple[float, float], destination: Tuple[float, float]) -> RouteEstimate:
+        """Distance and duration for a single origin/destination pair"""
+        key = (cell_key(*origin, self.cell_size_deg), cell_key(*destination, self.cell_size_deg))
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+
+        if self.graph is None:
+            estimate = self._haversine_estimate(origin, destination)
+        else:
+            loop = asyncio.get_running_loop()
+            estimate = await loop.run_in_executor(None, self._graph_estimate, origin, destination)
+
+        self._cache[key] = estimate
+        return estimate
+
+    def _graph_matrix(self, origins, destinations) -> Tuple[np.ndarray, np.ndarray]:
+        distances = haversine_matrix_km(origins, destinations) * self.detour_factor
+        durations = distances / self.avg_speed_kmh * 60
+        target_nodes = [self.graph.nearest_node(*d) for d in destinations]
+        for i, origin in enumerate(origins):
+            reached = self.graph.one_to_many(self.graph.nearest_node(*origin), target_nodes)
+            for j, node in enumerate(target_nodes):
+                if node in reached:
+                    length_m, time_s = reached[node]
+                    distances[i, j] = length_m / 1000
+                    durations[i, j] = time_s / 60
+        return distances, durations
+
+    async def matrix(
+        self,
+        origins: Sequence[Tuple[float, float]],
+        destinations: Sequence[Tuple[float, float]]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Distance (km) and duration (minutes) matrices for every origin/destination pair"""
+        if not origins or not destinations:
+            return np.zeros((len(origins), len(destinations))), np.zeros((len(origins), len(destinations)))
+
+        if self.graph is None:
+            distances = haversine_matrix_km(origins, destinations) * self.detour_factor
+            return distances, distances / self.avg_speed_kmh * 60
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._graph_matrix, list(origins), list(destinations))
+
+
+def create_routing_service() -> RoutingService:
+    """Build the routing service from environment settings (graph is loaded separately)"""
+    return RoutingService(
+        cache_size=int(os.environ.get("ROUTING_CACHE_SIZE", 100000)),
+        cell_size_deg=float(os.environ.get("ROUTING_CELL_SIZE_DEG", 0.001)),
+        detour_factor=float(os.environ.get("ROUTING_DETOUR_FACTOR", 1.3)),
+        avg_speed_kmh=float(os.environ.get("ROUTING_AVG_SPEED_KMH", 25))
+    )
+
+
+async def load_road_graph(service: RoutingService, path: Optional[str]):
+    """Load the offline road network (if configured) without blocking the event loop"""
+    if not path:
+        return
+    if not os.path.exists(path):
+        logger.warning(f"Road network file not found, using haversine distances: {path}")
+        return
+    loop = asyncio.get_running_loop()
+    try:
+        service.set_graph(await loop.run_in_executor(None, RoadGraph.load, path))
+        logger.info(f"Loaded road network with {service.graph.node_count} nodes from {path}")
+    except Exception as e:
+        logger.warning(f"Could not load road network {path}, using haversine distances: {e}")
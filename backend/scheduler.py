@@ -0,0 +1,97 @@
+"""
+In-process Timeout Scheduler
+زمان‌بند داخلی برای انقضای سفرها و پیشنهادها
+
+A heap of keyed deadlines served by a single asyncio task. Re-scheduling a key
+replaces its timer; cancelled timers are dropped lazily when they reach the top.
+Timers live in memory only, so callers rehydrate them from the database on startup.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+TimerCallback = Callable[[], Awaitable[None]]
+
+
+class TimeoutScheduler:
+    def __init__(self):
+        self._heap: List[Tuple[float, int, str]] = []
+        self._timers: Dict[str, Tuple[int, TimerCallback]] = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def schedule(self, key: str, deadline: float, callback: TimerCallback):
+        """Run callback at `deadline` (epoch seconds); replaces any timer with the same key"""
+        token = next(self._counter)
+        self._timers[key] = (token, callback)
+        heapq.heappush(self._heap, (deadline, token, key))
+        # Only wake the loop if this timer is now the earliest one
+        if self._heap[0][1] == token:
+            self._wakeup.set()
+
+    def cancel(self, key: str):
+        self._timers.pop(key, None)
+
+    def overdue(self, grace_seconds: float = 5.0) -> int:
+        """Live timers more than grace_seconds past their deadline: a backlog, unlike the timer count"""
+        cutoff = time.time() - grace_seconds
+        count = 0
+        stack = [0] if self._heap else []
+        while stack:
+            # Heap order: once an entry is not overdue, neither is anything below it
+            index = stack.pop()
+            deadline, token, key = self._heap[index]
+            if deadline > cutoff:
+                continue
+            timer = self._timers.get(key)
+            if timer and timer[0] == token:
+                count += 1
+            stack.extend(child for child in (2 * index + 1, 2 * index + 2) if child < len(self._heap))
+        return count
+
+    def _pop_due(self, now: float) -> List[TimerCallback]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, token, key = heapq.heappop(self._heap)
+            timer = self._timers.get(key)
+            if timer and timer[0] == token:
+                del self._timers[key]
+                due.append(timer[1])
+        # Discard cancelled or replaced entries sitting at the top
+        while self._heap and self._timers.get(self._heap[0][2], (None,))[0] != self._heap[0][1]:
+            heapq.heappop(self._heap)
+        return due
+
+    async def _run(self):
+        while True:
+            for callback in self._pop_due(time.time()):
+                try:
+                    await callback()
+                except Exception as e:
+                    logger.error(f"Scheduled callback failed: {e}")
+
+            self._wakeup.clear()
+            timeout = max(0.0, self._heap[0][0] - time.time()) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -3,60 +3,249 @@ Snabb Taxi System - Backend API
 FastAPI backend with WebSocket support for real-time location tracking
 """
 
-from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Depends, Header
+from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Depends, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Dict, Any
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.read_preferences import SecondaryPreferred
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from cachetools import TTLCache
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
+from typing import List, Optional, Dict, Any, Tuple
 from datetime import datetime, timezone, timedelta
 from dotenv import load_dotenv
 from pathlib import Path
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+from routing import create_routing_service, load_road_graph, cell_key
+from matching import MatchingEngine
+from scheduler import TimeoutScheduler
+from admin_feed import AdminFeed, ADMIN_NAMESPACE
+from archive import ARCHIVE_COLLECTION, TripArchiver, chain_cursors, count_trips, find_trips
+from text_search import build_search_query, user_search_fields
+from bulk_import import BulkReport, detect_format, iter_row_chunks
+from instrumentation import PROMETHEUS_CONTENT_TYPE, Metrics, MongoCommandMetrics, instrument_socketio, time_request
+from query_profiler import PROFILER_MODES, QueryProfilerListener, profile_request
+from log_config import configure_logging, sampled_logger
+from health import LoopLagMonitor, PoolMonitor, evaluate, mongo_ping_ms
+from rate_limit import AdmissionController, MemoryBackend, RateLimit, RateLimiter, RedisBackend
+from location_frames import BINARY_ROOM, LocationBatcher
+from map_state import MAP_ROOM, STATUS_AVAILABLE, STATUS_ON_TRIP, MapState
+from migrate import create_active_trip_index, create_user_phone_index
+from gps_traces import TraceWriter, ensure_trace_collection, measure_trip, parse_time, simplified_trace, trip_window
+from exporter import (
+    COMMISSION_PAYMENT_EXPORT_COLUMNS, DRIVER_FINANCE_EXPORT_COLUMNS, EXPORT_MEDIA_TYPES, TRIP_EXPORT_COLUMNS,
+    export_projection, parquet_available, stream_export
+)
 import socketio
 import logging
+import asyncio
+import hmac
 import os
 import uuid
-import random
 
 # ===================== Configuration =====================
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Records are formatted and written by a listener thread, not on the event loop
+log_listener = configure_logging(
+    level=os.environ.get("LOG_LEVEL", "INFO"),
+    fmt=os.environ.get("LOG_FORMAT", "text"),  # text, json
+    use_queue=os.environ.get("LOG_QUEUE", "true").lower() == "true",
+    socketio_level=os.environ.get("SOCKETIO_LOG_LEVEL", "WARNING")  # per-packet logs at INFO/DEBUG
 )
 logger = logging.getLogger(__name__)
+# Connect/disconnect/join logs: one in SOCKET_LOG_SAMPLE_EVERY per event (1 keeps all; raise it under heavy load)
+socket_logger = sampled_logger("server.socket", int(os.environ.get("SOCKET_LOG_SAMPLE_EVERY", 1)))
+
+# Per-worker Prometheus metrics (route latency, Mongo commands per request, Socket.IO emits)
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "false").lower() == "true"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")  # scrapers send "Authorization: Bearer <token>"
+metrics = Metrics(dynamic_event_prefixes=("driver_location_", "trip_accepted_", "trip_status_"))
+
+# Query profiler for development/staging: off, warn (log) or raise (fail the request)
+QUERY_PROFILER = os.environ.get("QUERY_PROFILER", "off").lower()
+if QUERY_PROFILER not in PROFILER_MODES:
+    raise ValueError(f"QUERY_PROFILER must be one of {PROFILER_MODES}")
+QUERY_BUDGET = int(os.environ.get("QUERY_BUDGET", 50))  # Mongo commands per request
+QUERY_REPEAT_LIMIT = int(os.environ.get("QUERY_REPEAT_LIMIT", 5))  # same filter shape per request
+
+# MongoDB connection pool (timeouts left unset or 0 keep the driver defaults)
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+MONGO_TIMEOUTS_MS = {
+    option: int(os.environ.get(env_name, 0)) or None
+    for option, env_name in (
+        ("maxIdleTimeMS", "MONGO_MAX_IDLE_TIME_MS"),
+        ("waitQueueTimeoutMS", "MONGO_WAIT_QUEUE_TIMEOUT_MS"),  # wait for a free pooled connection
+        ("connectTimeoutMS", "MONGO_CONNECT_TIMEOUT_MS"),
+        ("socketTimeoutMS", "MONGO_SOCKET_TIMEOUT_MS"),
+        ("serverSelectionTimeoutMS", "MONGO_SERVER_SELECTION_TIMEOUT_MS"),
+    )
+}
+MONGO_TIMEOUTS_MS = {option: value for option, value in MONGO_TIMEOUTS_MS.items() if value}
+
+# Reporting reads use their own small pool and prefer secondaries, so they never
+# take connections (or primary capacity) from the ride flow
+ANALYTICS_MONGO_URL = os.environ.get("ANALYTICS_MONGO_URL")  # defaults to MONGO_URL
+ANALYTICS_MAX_POOL_SIZE = int(os.environ.get("ANALYTICS_MAX_POOL_SIZE", 10))
+ANALYTICS_MAX_STALENESS_SECONDS = int(os.environ.get("ANALYTICS_MAX_STALENESS_SECONDS", 120))  # MongoDB minimum is 90
 
-# MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+pool_monitor = PoolMonitor()
+command_listeners = []
+if METRICS_ENABLED:
+    command_listeners.append(MongoCommandMetrics(metrics))
+if QUERY_PROFILER != "off":
+    command_listeners.append(QueryProfilerListener())
+client = AsyncIOMotorClient(
+    mongo_url,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    event_listeners=[pool_monitor, *command_listeners],
+    **MONGO_TIMEOUTS_MS
+)
 db = client[os.environ['DB_NAME']]
 
+analytics_client = AsyncIOMotorClient(
+    ANALYTICS_MONGO_URL or mongo_url,
+    maxPoolSize=ANALYTICS_MAX_POOL_SIZE,
+    event_listeners=command_listeners,
+    **MONGO_TIMEOUTS_MS
+)
+analytics_db = analytics_client.get_database(
+    os.environ['DB_NAME'],
+    read_preference=SecondaryPreferred(max_staleness=ANALYTICS_MAX_STALENESS_SECONDS)
+)
+
 # FastAPI app
 app = FastAPI(title="Snabb Taxi System API", version="1.0.0")
 api_router = APIRouter(prefix="/api")
 
 # Socket.IO for WebSocket
+# With several workers, set SOCKETIO_REDIS_URL so room emits reach clients on every worker
+socketio_redis_url = os.environ.get("SOCKETIO_REDIS_URL")
 sio = socketio.AsyncServer(
     async_mode='asgi',
     cors_allowed_origins='*',
-    logger=True,
-    engineio_logger=True
+    client_manager=socketio.AsyncRedisManager(socketio_redis_url) if socketio_redis_url else None,
+    logger=logging.getLogger("socketio.server"),
+    engineio_logger=logging.getLogger("engineio.server")
 )
+if METRICS_ENABLED:
+    instrument_socketio(sio, metrics)
 socket_app = socketio.ASGIApp(sio, app)
 
+# Live admin dashboard deltas on the /admin namespace (one change-stream consumer per worker)
+admin_feed = AdminFeed(db, sio)
+
 # Store active WebSocket connections
 active_connections: Dict[str, WebSocket] = {}
 driver_locations: Dict[str, Dict] = {}  # driver_id: {lat, lng, timestamp}
 
+# Driver positions for map views: batched binary frames for clients that opt in, and
+# (unless disabled) the legacy JSON driver_location_<id> event per ping
+LOCATION_FRAME_INTERVAL_MS = int(os.environ.get("LOCATION_FRAME_INTERVAL_MS", 250))
+LEGACY_LOCATION_EVENTS = os.environ.get("LEGACY_LOCATION_EVENTS", "true").lower() == "true"
+LOCATION_INDEX_RESEND_SECONDS = float(os.environ.get("LOCATION_INDEX_RESEND_SECONDS", 30))
+LOCATION_INDEX_IDLE_SECONDS = float(os.environ.get("LOCATION_INDEX_IDLE_SECONDS", 300))
+location_batcher = LocationBatcher(
+    sio,
+    LOCATION_FRAME_INTERVAL_MS / 1000,
+    index_resend_seconds=LOCATION_INDEX_RESEND_SECONDS,
+    index_idle_seconds=LOCATION_INDEX_IDLE_SECONDS
+)
+
+# Distance / ETA service (offline road network loaded from ROAD_NETWORK_PATH if set)
+routing_service = create_routing_service()
+
+# Batched driver-trip matching (run it on a single worker)
+MATCHING_ENABLED = os.environ.get("MATCHING_ENABLED", "false").lower() == "true"
+MATCHING_WINDOW_SECONDS = float(os.environ.get("MATCHING_WINDOW_SECONDS", 2))
+MATCHING_MAX_PICKUP_KM = float(os.environ.get("MATCHING_MAX_PICKUP_KM", 5))
+MATCHING_SOLVER = os.environ.get("MATCHING_SOLVER", "auto")  # auto, greedy, hungarian
+OFFER_TIMEOUT_SECONDS = int(os.environ.get("OFFER_TIMEOUT_SECONDS", 15))
+DRIVER_LOCATION_STALE_SECONDS = int(os.environ.get("DRIVER_LOCATION_STALE_SECONDS", 60))
+
+# Driver GPS breadcrumbs in the gps_traces time-series collection (written in batches off the ping path)
+GPS_TRACES_ENABLED = os.environ.get("GPS_TRACES_ENABLED", "true").lower() == "true"
+GPS_TRACE_RETENTION_DAYS = int(os.environ.get("GPS_TRACE_RETENTION_DAYS", 90))  # 0 keeps traces forever
+GPS_TRACE_FLUSH_MS = int(os.environ.get("GPS_TRACE_FLUSH_MS", 1000))
+trace_writer = TraceWriter(db, GPS_TRACE_FLUSH_MS / 1000)
+
+# Final fare from the recorded trace - کرایه نهایی بر اساس مسیر ثبت‌شده
+FARE_FROM_TRACE = GPS_TRACES_ENABLED and os.environ.get("FARE_FROM_TRACE", "true").lower() == "true"
+FARE_TRACE_TIMEOUT_SECONDS = float(os.environ.get("FARE_TRACE_TIMEOUT_SECONDS", 2))
+FARE_TRACE_MIN_COVERAGE = float(os.environ.get("FARE_TRACE_MIN_COVERAGE", 0.5))  # share of the ride the trace must span
+FARE_TRACE_MAX_SPEED_KMH = float(os.environ.get("FARE_TRACE_MAX_SPEED_KMH", 200))  # faster jumps are GPS spikes
+
+# Admin live map: snapshot + versioned deltas of online drivers, pushed to the admins on each worker
+MAP_DELTA_INTERVAL_MS = int(os.environ.get("MAP_DELTA_INTERVAL_MS", 1000))
+MAP_SYNC_SECONDS = float(os.environ.get("MAP_SYNC_SECONDS", 5))
+MAP_MIN_MOVE_DEG = float(os.environ.get("MAP_MIN_MOVE_DEG", 0.0001))  # ~10 m
+map_state = MapState(
+    db, sio, ADMIN_NAMESPACE,
+    stale_seconds=DRIVER_LOCATION_STALE_SECONDS,
+    interval_seconds=MAP_DELTA_INTERVAL_MS / 1000,
+    sync_seconds=MAP_SYNC_SECONDS,
+    min_move_deg=MAP_MIN_MOVE_DEG
+)
+
+# Drivers subscribed to the trip feed get events for pending trips in the surrounding 3x3 cells
+TRIP_FEED_CELL_DEG = float(os.environ.get("TRIP_FEED_CELL_DEG", 0.05))  # ~5 km
+
+# Pending trips are cancelled automatically after this long without a driver
+PENDING_TRIP_TIMEOUT_SECONDS = int(os.environ.get("PENDING_TRIP_TIMEOUT_SECONDS", 300))
+
+# Trip expiry and offer timeout timers (rehydrated from MongoDB on startup)
+trip_scheduler = TimeoutScheduler()
+
+# Finished trips older than this move to trips_archive (0 disables archiving)
+TRIP_ARCHIVE_AFTER_DAYS = int(os.environ.get("TRIP_ARCHIVE_AFTER_DAYS", 90))
+TRIP_ARCHIVE_INTERVAL_SECONDS = float(os.environ.get("TRIP_ARCHIVE_INTERVAL_SECONDS", 3600))
+trip_archiver = TripArchiver(db, TRIP_ARCHIVE_AFTER_DAYS, TRIP_ARCHIVE_INTERVAL_SECONDS)
+
+# Readiness thresholds: /api/health/ready returns 503 past any of them
+READY_MAX_LOOP_LAG_MS = float(os.environ.get("READY_MAX_LOOP_LAG_MS", 250))
+READY_MAX_MONGO_PING_MS = float(os.environ.get("READY_MAX_MONGO_PING_MS", 500))
+READY_MAX_POOL_USAGE = float(os.environ.get("READY_MAX_POOL_USAGE", 0.9))  # share of maxPoolSize checked out
+READY_MAX_QUEUE_DEPTH = int(os.environ.get("READY_MAX_QUEUE_DEPTH", 10000))
+READY_LOOP_LAG_WINDOW_SECONDS = float(os.environ.get("READY_LOOP_LAG_WINDOW_SECONDS", 10))
+loop_lag_monitor = LoopLagMonitor(window_seconds=READY_LOOP_LAG_WINDOW_SECONDS)
+
+# Per-client token buckets ("count/seconds", "0" disables); routes keyed by user also get an IP bucket RATE_LIMIT_IP_MULTIPLIER times larger
+RATE_LIMIT_LOGIN = RateLimit.parse(os.environ.get("RATE_LIMIT_LOGIN", "30/60"))
+RATE_LIMIT_ESTIMATE = RateLimit.parse(os.environ.get("RATE_LIMIT_ESTIMATE", "60/60"))
+RATE_LIMIT_REQUEST_RIDE = RateLimit.parse(os.environ.get("RATE_LIMIT_REQUEST_RIDE", "10/60"))
+RATE_LIMIT_LOCATION = RateLimit.parse(os.environ.get("RATE_LIMIT_LOCATION", "120/60"))
+rate_limit_redis_url = os.environ.get("RATE_LIMIT_REDIS_URL")
+rate_limiter = RateLimiter(
+    RedisBackend(rate_limit_redis_url) if rate_limit_redis_url else MemoryBackend(),
+    ip_multiplier=float(os.environ.get("RATE_LIMIT_IP_MULTIPLIER", 10)),
+    trust_forwarded=os.environ.get("RATE_LIMIT_TRUST_FORWARDED", "false").lower() == "true"  # behind a proxy
+)
+
+# Global admission control: shed with 503 past these (0 disables)
+MAX_IN_FLIGHT_REQUESTS = int(os.environ.get("MAX_IN_FLIGHT_REQUESTS", 0))
+SHED_LOOP_LAG_MS = float(os.environ.get("SHED_LOOP_LAG_MS", 500))
+admission_controller = AdmissionController(
+    MAX_IN_FLIGHT_REQUESTS, SHED_LOOP_LAG_MS, lambda: loop_lag_monitor.lag_ms,
+    exempt_prefixes=("/api/health", "/metrics")
+)
+
 # JWT Configuration
 SECRET_KEY = os.environ.get("SECRET_KEY", "snabb_secret_key_2025_secure_random_string")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
 
+# Idempotency keys: replays of the same key within this window return the original response
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 60 * 60 * 24))
+idempotency_cache: TTLCache = TTLCache(maxsize=10000, ttl=IDEMPOTENCY_TTL_SECONDS)
+
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
@@ -96,6 +285,9 @@ class UserUpdate(BaseModel):
     car_plate: Optional[str] = None
     current_location: Optional[Dict[str, float]] = None
 
+class BulkUserUpdate(UserUpdate):
+    id: str
+
 # ----------- Authentication Models -----------
 class LoginRequest(BaseModel):
     phone: str
@@ -119,6 +311,26 @@ class TripStatus:
     COMPLETED = "completed"
     CANCELLED = "cancelled"
 
+# Legal trip status transitions: current status -> allowed next statuses
+TRIP_TRANSITIONS: Dict[str, List[str]] = {
+    TripStatus.PENDING: [TripStatus.ACCEPTED, TripStatus.CANCELLED],
+    TripStatus.ACCEPTED: [TripStatus.IN_PROGRESS, TripStatus.CANCELLED],
+    TripStatus.IN_PROGRESS: [TripStatus.COMPLETED, TripStatus.CANCELLED],
+    TripStatus.COMPLETED: [],
+    TripStatus.CANCELLED: [],
+}
+
+# Statuses in which a trip still occupies its passenger (and driver)
+ACTIVE_TRIP_STATUSES = [TripStatus.PENDING, TripStatus.ACCEPTED, TripStatus.IN_PROGRESS]
+
+# Timestamp field stamped when a trip enters each status
+TRIP_STATUS_TIMESTAMPS = {
+    TripStatus.ACCEPTED: "accepted_at",
+    TripStatus.IN_PROGRESS: "started_at",
+    TripStatus.COMPLETED: "completed_at",
+    TripStatus.CANCELLED: "cancelled_at",
+}
+
 class Trip(BaseModel):
     model_config = ConfigDict(extra="ignore")
     
@@ -140,6 +352,10 @@ class Trip(BaseModel):
     accepted_at: Optional[datetime] = None
     started_at: Optional[datetime] = None
     completed_at: Optional[datetime] = None
+    cancelled_at: Optional[datetime] = None
+    cancel_reason: Optional[str] = None  # "expired" when nobody accepted in time, "duplicate" when cleaned up by migrate.py
+    quoted_price: Optional[float] = None  # price at request time when the final fare came from the GPS trace
+    fare_source: Optional[str] = None  # "trace" or "quote", set at completion
 
 class TripCreate(BaseModel):
     passenger_id: str
@@ -159,13 +375,16 @@ class Notification(BaseModel):
     role: Optional[str] = None  # None means all roles
     message: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    is_read: bool = False
+    is_read: bool = False  # Per reader: derived from the reader's last-read cursor when listed
 
 class NotificationCreate(BaseModel):
     user_id: Optional[str] = None
     role: Optional[str] = None
     message: str
 
+class NotificationReadRequest(BaseModel):
+    up_to: Optional[str] = None  # ISO timestamp; defaults to now
+
 # ----------- Admin Role Models -----------
 class AdminRole:
     SUPER_ADMIN = "super_admin"
@@ -210,12 +429,14 @@ class PricingConfig(BaseModel):
     id: str = Field(default_factory=lambda: "pricing_config")
     base_fare: float = 20  # افغانی - کرایه پایه
     per_km: float = 10     # افغانی per km - هر کیلومتر
+    per_minute: float = 0  # افغانی per minute of the ride - هر دقیقه (final fares from the GPS trace only)
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_by: Optional[str] = None
 
 class PricingUpdate(BaseModel):
     base_fare: float
     per_km: float
+    per_minute: Optional[float] = None
 
 # ----------- Fare Range Models (جدول نرخ کرایه پویا) -----------
 class FareRange(BaseModel):
@@ -318,8 +539,8 @@ class StatsResponse(BaseModel):
 
 class LocationUpdate(BaseModel):
     user_id: str
-    lat: float
-    lng: float
+    lat: float = Field(ge=-90, le=90, allow_inf_nan=False)
+    lng: float = Field(ge=-180, le=180, allow_inf_nan=False)
 
 
 # ===================== JWT & Security Functions =====================
@@ -390,25 +611,183 @@ def deserialize_doc(doc):
         doc['started_at'] = datetime.fromisoformat(doc['started_at'])
     if doc and 'completed_at' in doc and isinstance(doc['completed_at'], str):
         doc['completed_at'] = datetime.fromisoformat(doc['completed_at'])
+    if doc and 'cancelled_at' in doc and isinstance(doc['cancelled_at'], str):
+        doc['cancelled_at'] = datetime.fromisoformat(doc['cancelled_at'])
     return doc
 
-async def calculate_trip_price(distance_km: float) -> float:
+def allowed_prior_statuses(new_status: str) -> List[str]:
+    """Statuses from which a trip may move to new_status"""
+    return [status for status, next_statuses in TRIP_TRANSITIONS.items() if new_status in next_statuses]
+
+async def transition_trip(
+    trip_id: str,
+    new_status: str,
+    match: Optional[Dict] = None,
+    extra_set: Optional[Dict] = None,
+    allowed_from: Optional[List[str]] = None
+) -> Optional[Dict]:
+    """
+    Atomically move a trip to new_status in a single round trip.
+    The legal prior statuses are part of the filter, so a concurrent or repeated
+    transition matches nothing and returns None instead of applying twice.
+    """
+    if new_status not in TRIP_TRANSITIONS:
+        raise HTTPException(status_code=400, detail="وضعیت سفر نامعتبر است")
+    
+    query = {"id": trip_id, "status": {"$in": allowed_from or allowed_prior_statuses(new_status)}}
+    if match:
+        query.update(match)
+    
+    update_data = {"status": new_status}
+    if new_status in TRIP_STATUS_TIMESTAMPS:
+        update_data[TRIP_STATUS_TIMESTAMPS[new_status]] = datetime.now(timezone.utc).isoformat()
+    if extra_set:
+        update_data.update(extra_set)
+    
+    trip = await db.trips.find_one_and_update(
+        query,
+        {"$set": update_data},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    
+    if trip and trip.get('driver_id'):
+        map_state.set_status(trip['driver_id'], STATUS_ON_TRIP if new_status in (TripStatus.ACCEPTED, TripStatus.IN_PROGRESS) else STATUS_AVAILABLE)
+    
+    # Once a trip leaves pending its expiry and offer timers are no longer needed
+    if trip and new_status != TripStatus.PENDING:
+        trip_scheduler.cancel(f"expire:{trip_id}")
+        trip_scheduler.cancel(f"offer:{trip_id}")
+    
+    # Without change streams the admin dashboard is fed in-process
+    if trip and not admin_feed.change_stream_active:
+        await admin_feed.publish_trip_change(trip)
+    
+    # Accepted trips, and trips cancelled before acceptance, drop out of drivers' feeds
+    if trip and (new_status == TripStatus.ACCEPTED or (new_status == TripStatus.CANCELLED and not trip.get('accepted_at'))):
+        await publish_trip_feed_remove(trip)
+    
+    return trip
+
+async def raise_transition_error(trip_id: str, new_status: str, match: Optional[Dict] = None):
+    """Explain why transition_trip matched nothing (only runs on the failure path)"""
+    query = {"id": trip_id}
+    if match:
+        query.update(match)
+    
+    trip = await db.trips.find_one(query, {"_id": 0, "status": 1})
+    if not trip:
+        raise HTTPException(status_code=404, detail="سفر یافت نشد")
+    
+    raise HTTPException(
+        status_code=400,
+        detail=f"تغییر وضعیت سفر از {trip.get('status')} به {new_status} مجاز نیست"
+    )
+
+async def get_idempotent_response(scope: str, key: Optional[str]) -> Optional[Any]:
+    """Return the stored response for a replayed Idempotency-Key, if any"""
+    if not key:
+        return None
+    
+    record_id = f"{scope}:{key}"
+    if record_id in idempotency_cache:
+        return idempotency_cache[record_id]
+    
+    # Other workers may have served the original request
+    record = await db.idempotency_keys.find_one({"_id": record_id}, {"response": 1})
+    if not record:
+        return None
+    
+    idempotency_cache[record_id] = record["response"]
+    return record["response"]
+
+async def store_idempotent_response(scope: str, key: Optional[str], response: Any):
+    """Remember the response for an Idempotency-Key so replays return it unchanged"""
+    if not key:
+        return
+    
+    record_id = f"{scope}:{key}"
+    body = jsonable_encoder(response)
+    idempotency_cache[record_id] = body
+    
+    # created_at is stored as a real datetime so the TTL index can expire it
+    await db.idempotency_keys.update_one(
+        {"_id": record_id},
+        {"$setOnInsert": {"response": body, "created_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+def user_room(user_id: str) -> str:
+    """Socket.IO room for events addressed to a single user"""
+    return f"user_{user_id}"
+
+def role_room(role: str) -> str:
+    """Socket.IO room for events addressed to every user with a role"""
+    return f"role_{role}"
+
+def offer_visible_filter(driver_id: str) -> Dict:
+    """Pending trips this driver may take: not offered to anyone else, or the offer has expired"""
+    return {"$or": [
+        {"offered_driver_id": None},
+        {"offered_driver_id": driver_id},
+        {"offer_expires_at": {"$lt": datetime.now(timezone.utc).isoformat()}}
+    ]}
+
+def trip_feed_room(lat: float, lng: float) -> str:
+    """Socket.IO room for pending trips whose origin lies in this grid cell"""
+    row, col = cell_key(lat, lng, TRIP_FEED_CELL_DEG)
+    return f"trip_cell_{row}_{col}"
+
+TRIP_FEED_PROJECTION = {
+    "_id": 0, "id": 1, "passenger_name": 1, "origin": 1, "destination": 1,
+    "price": 1, "distance_km": 1, "duration_minutes": 1, "created_at": 1
+}
+
+async def publish_trip_feed_add(trip: Dict):
+    """Push a new pending trip to drivers subscribed around its origin"""
+    origin = trip.get('origin') or {}
+    if 'lat' not in origin or 'lng' not in origin:
+        return
+    payload = {key: trip.get(key) for key in TRIP_FEED_PROJECTION if key != "_id"}
+    await sio.emit('trip_feed_add', jsonable_encoder(payload), room=trip_feed_room(origin['lat'], origin['lng']))
+
+async def publish_trip_feed_remove(trip: Dict):
+    """Tell subscribed drivers a trip is no longer available"""
+    origin = trip.get('origin') or {}
+    if 'lat' not in origin or 'lng' not in origin:
+        return
+    await sio.emit('trip_feed_remove', {"trip_id": trip['id']}, room=trip_feed_room(origin['lat'], origin['lng']))
+
+def location_point(location: Dict[str, Any]) -> Tuple[float, float]:
+    """Extract (lat, lng) from a location dict"""
+    try:
+        return (float(location['lat']), float(location['lng']))
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="مختصات مبدأ یا مقصد نامعتبر است")
+
+async def calculate_trip_price(distance_km: float, duration_minutes: float = 0) -> float:
     """
     Calculate trip price based on dynamic fare range table
     محاسبه قیمت سفر بر اساس جدول نرخ کرایه پویا
+    duration_minutes (final fares from the GPS trace) adds the per-minute rate of the pricing config
     """
     # First check if fare ranges exist
     fare_ranges = await db.fare_ranges.find({}, {"_id": 0}).sort("min_km", 1).to_list(100)
     
+    distance_fare = None
     if fare_ranges:
         # Use fare range table
         for fare_range in fare_ranges:
             if fare_range['min_km'] <= distance_km <= fare_range['max_km']:
-                return distance_km * fare_range['rate_per_km']
+                distance_fare = distance_km * fare_range['rate_per_km']
+                break
         
         # If distance exceeds all ranges, use the last range's rate
-        if fare_ranges and distance_km > fare_ranges[-1]['max_km']:
-            return distance_km * fare_ranges[-1]['rate_per_km']
+        if distance_fare is None and distance_km > fare_ranges[-1]['max_km']:
+            distance_fare = distance_km * fare_ranges[-1]['rate_per_km']
+    
+    if distance_fare is not None and not duration_minutes:
+        return distance_fare
     
     # Fallback to old pricing config if no fare ranges exist
     config = await db.pricing_config.find_one({"id": "pricing_config"}, {"_id": 0})
@@ -418,13 +797,55 @@ async def calculate_trip_price(distance_km: float) -> float:
         doc = default_config.model_dump()
         doc['updated_at'] = doc['updated_at'].isoformat()
         await db.pricing_config.insert_one(doc)
-        base_fare = default_config.base_fare
-        per_km = default_config.per_km
-    else:
-        base_fare = config.get('base_fare', 20)
-        per_km = config.get('per_km', 10)
+        config = doc
+    
+    if distance_fare is None:
+        distance_fare = config.get('base_fare', 20) + (distance_km * config.get('per_km', 10))
     
-    return base_fare + (distance_km * per_km)
+    return distance_fare + duration_minutes * config.get('per_minute', 0)
+
+async def trace_fare_fields(trip: Dict) -> Optional[Dict]:
+    """Final price fields from the trip's trace, or None when the trace covers too little of the ride"""
+    # This worker's unwritten pings are read from the buffer instead of flushing it in the request
+    measure = await measure_trip(db, trip, FARE_TRACE_MAX_SPEED_KMH, trace_writer.pending(trip['driver_id']))
+    start, end = trip_window(trip)
+    window_seconds = (end - start).total_seconds()
+    if (measure.points < 2 or window_seconds <= 0
+            or measure.elapsed_seconds < window_seconds * FARE_TRACE_MIN_COVERAGE):
+        return None
+    duration_minutes = window_seconds / 60
+    return {
+        "price": round(await calculate_trip_price(measure.distance_km, duration_minutes), 2),
+        "quoted_price": trip.get('price'),
+        "distance_km": round(measure.distance_km, 3),
+        "duration_minutes": round(duration_minutes),
+        "fare_source": "trace",
+    }
+
+async def finalize_trip_fare(trip: Dict) -> Dict:
+    """
+    Re-price a just-completed trip from its recorded GPS trace (distance and ride time).
+    Runs after the trip is already completed, so it never fails the request: past
+    FARE_TRACE_TIMEOUT_SECONDS, on any error, or without enough trace coverage the quoted price stands.
+    Returns the trip with its final price fields.
+    """
+    fare_fields = None
+    # Only the ride itself is charged, so trips without a pickup time keep their quote
+    if FARE_FROM_TRACE and trip.get('driver_id') and trip.get('started_at'):
+        try:
+            fare_fields = await asyncio.wait_for(trace_fare_fields(trip), FARE_TRACE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning(f"Trace fare for trip {trip['id']} timed out; keeping the quoted price")
+        except Exception as e:
+            logger.error(f"Trace fare for trip {trip['id']} failed; keeping the quoted price: {e!r}")
+    fare_fields = fare_fields or {"fare_source": "quote"}
+    
+    await db.trips.update_one({"id": trip['id']}, {"$set": fare_fields})
+    trip = {**trip, **fare_fields}
+    # The completion event carried no revenue; it is counted once the fare is final
+    if not admin_feed.change_stream_active:
+        await admin_feed.publish_trip_fare(trip)
+    return trip
 
 async def get_or_create_driver_finance(driver_id: str) -> Dict:
     """Get driver's financial record or create if doesn't exist"""
@@ -485,12 +906,16 @@ async def update_driver_finances_on_trip_completion(driver_id: str, trip_price:
         }
     )
     
-    # If account is locked, also lock the user account
+    # If account is locked, also lock the user account and cache the lock state
+    # on the user document so accept-trip can check it without a finance read
     if account_locked:
         await db.users.update_one(
             {"id": driver_id},
-            {"$set": {"is_active": False}}
+            {"$set": {"is_active": False, "account_locked": True}}
         )
+        map_state.remove(driver_id)
+        if not admin_feed.change_stream_active:
+            await admin_feed.publish_driver_change({"id": driver_id, "is_active": False})
     
     return {
         "commission_amount": commission_amount,
@@ -500,7 +925,8 @@ async def update_driver_finances_on_trip_completion(driver_id: str, trip_price:
 
 # ===================== Authentication Routes =====================
 
-@api_router.post("/auth/login", response_model=AuthResponse)
+@api_router.post("/auth/login", response_model=AuthResponse,
+                 dependencies=[Depends(rate_limiter.dependency("login", RATE_LIMIT_LOGIN))])
 async def login(request: LoginRequest):
     """
     Mock OTP Login - accepts any phone number
@@ -518,8 +944,11 @@ async def login(request: LoginRequest):
         )
         doc = new_user.model_dump()
         doc['created_at'] = doc['created_at'].isoformat()
-        await db.users.insert_one(doc)
-        user_doc = doc
+        doc.update(user_search_fields(new_user.name, new_user.phone))
+        try:
+            await db.users.insert_one(doc)
+        except DuplicateKeyError:
+            pass  # a concurrent login or import created the user first (unique phone + role)
     
     # Generate mock OTP
     mock_otp = "1234"  # Always use 1234 for testing
@@ -629,7 +1058,7 @@ async def get_admin_stats():
     total_drivers = await db.users.count_documents({"role": UserRole.DRIVER})
     total_passengers = await db.users.count_documents({"role": UserRole.PASSENGER})
     active_drivers = await db.users.count_documents({"role": UserRole.DRIVER, "is_active": True})
-    ongoing_trips = await db.trips.count_documents({"status": {"$in": [TripStatus.PENDING, TripStatus.ACCEPTED, TripStatus.IN_PROGRESS]}})
+    ongoing_trips = await db.trips.count_documents({"status": {"$in": ACTIVE_TRIP_STATUSES}})
     
     # Today's completed trips
     today_start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
@@ -676,7 +1105,11 @@ async def create_user(user: UserCreate):
     new_user = User(**user.model_dump())
     doc = new_user.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
-    await db.users.insert_one(doc)
+    doc.update(user_search_fields(new_user.name, new_user.phone))
+    try:
+        await db.users.insert_one(doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="کاربری با این شماره تلفن و نقش وجود دارد")
     return new_user
 
 @api_router.put("/admin/users/{user_id}", response_model=User)
@@ -689,14 +1122,190 @@ async def update_user(user_id: str, update: UserUpdate):
     if not update_data:
         raise HTTPException(status_code=400, detail="هیچ داده‌ای برای به‌روزرسانی ارسال نشده")
     
-    result = await db.users.update_one({"id": user_id}, {"$set": update_data})
+    user_doc = await db.users.find_one_and_update(
+        {"id": user_id},
+        {"$set": {**update_data, **user_search_fields(update_data.get('name'))}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
     
-    if result.matched_count == 0:
+    if not user_doc:
         raise HTTPException(status_code=404, detail="کاربر یافت نشد")
     
-    user_doc = await db.users.find_one({"id": user_id}, {"_id": 0})
+    if 'is_active' in update_data and user_doc.get('role') == UserRole.DRIVER and not admin_feed.change_stream_active:
+        await admin_feed.publish_driver_change(user_doc)
+    
     return User(**deserialize_doc(user_doc))
 
+# Rows validated and written per round trip in bulk user import/update
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', '500'))
+
+def validation_error_message(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in e['loc'])}: {e['msg']}" for e in error.errors()
+    )
+
+def record_bulk_write_errors(report: BulkReport, error: BulkWriteError, lines: List[int]):
+    """Map unordered bulk write errors back to input lines"""
+    for write_error in error.details.get('writeErrors', []):
+        if write_error.get('code') == 11000:
+            message = "کاربری با این شماره تلفن و نقش وجود دارد"
+        else:
+            message = f"ذخیره ناموفق بود: {write_error.get('errmsg', '')}"
+        report.add_error(lines[write_error['index']], message)
+
+async def import_user_chunk(rows, report: BulkReport):
+    """Validate one chunk of new users and insert the valid ones unordered"""
+    docs, lines = [], []
+    seen = set()
+    candidates = []
+    for line, data, error in rows:
+        if error:
+            report.add_error(line, error)
+            continue
+        try:
+            user = UserCreate(**data)
+        except ValidationError as e:
+            report.add_error(line, validation_error_message(e))
+            continue
+        if user.role not in (UserRole.DRIVER, UserRole.PASSENGER):
+            report.add_error(line, "نقش باید driver یا passenger باشد")
+            continue
+        if (user.phone, user.role) in seen:
+            report.add_error(line, "شماره تلفن در فایل تکراری است")
+            continue
+        seen.add((user.phone, user.role))
+        candidates.append((line, user))
+
+    if not candidates:
+        return
+
+    # One lookup per chunk instead of one per row
+    existing = await db.users.find(
+        {"phone": {"$in": [user.phone for _, user in candidates]}},
+        {"_id": 0, "phone": 1, "role": 1}
+    ).to_list(None)
+    existing_keys = {(u['phone'], u['role']) for u in existing}
+
+    for line, user in candidates:
+        if (user.phone, user.role) in existing_keys:
+            report.add_error(line, "کاربری با این شماره تلفن و نقش وجود دارد")
+            continue
+        doc = User(**user.model_dump()).model_dump()
+        doc['created_at'] = doc['created_at'].isoformat()
+        doc.update(user_search_fields(user.name, user.phone))
+        docs.append(doc)
+        lines.append(line)
+
+    if not docs:
+        return
+    try:
+        result = await db.users.insert_many(docs, ordered=False)
+        report.applied += len(result.inserted_ids)
+    except BulkWriteError as e:
+        report.applied += e.details.get('nInserted', 0)
+        record_bulk_write_errors(report, e, lines)
+
+async def update_user_chunk(rows, report: BulkReport):
+    """Validate one chunk of user updates and apply them with a single unordered bulk_write"""
+    updates = []
+    for line, data, error in rows:
+        if error:
+            report.add_error(line, error)
+            continue
+        try:
+            update = BulkUserUpdate(**data)
+        except ValidationError as e:
+            report.add_error(line, validation_error_message(e))
+            continue
+        update_data = {k: v for k, v in update.model_dump().items() if v is not None and k != 'id'}
+        if not update_data:
+            report.add_error(line, "هیچ داده‌ای برای به‌روزرسانی ارسال نشده")
+            continue
+        updates.append((line, update.id, update_data))
+
+    if not updates:
+        return
+
+    existing = await db.users.find(
+        {"id": {"$in": [user_id for _, user_id, _ in updates]}},
+        {"_id": 0, "id": 1, "role": 1, "name": 1}
+    ).to_list(None)
+    users_by_id = {u['id']: u for u in existing}
+
+    operations, lines, driver_changes = [], [], []
+    for line, user_id, update_data in updates:
+        user = users_by_id.get(user_id)
+        if not user:
+            report.add_error(line, "کاربر یافت نشد")
+            continue
+        operations.append(UpdateOne(
+            {"id": user_id},
+            {"$set": {**update_data, **user_search_fields(update_data.get('name'))}}
+        ))
+        lines.append(line)
+        if 'is_active' in update_data and user.get('role') == UserRole.DRIVER:
+            driver_changes.append({**user, **update_data})
+
+    if not operations:
+        return
+    try:
+        result = await db.users.bulk_write(operations, ordered=False)
+        report.applied += result.matched_count
+    except BulkWriteError as e:
+        report.applied += e.details.get('nMatched', 0)
+        record_bulk_write_errors(report, e, lines)
+
+    if not admin_feed.change_stream_active:
+        for driver in driver_changes:
+            await admin_feed.publish_driver_change(driver)
+
+async def run_bulk_user_job(request: Request, format: Optional[str], apply_chunk) -> BulkReport:
+    fmt = detect_format(request.headers.get('content-type'), format)
+    if fmt not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="فرمت باید csv یا ndjson باشد")
+
+    report = BulkReport()
+    async for chunk in iter_row_chunks(request.stream(), fmt, BULK_CHUNK_SIZE):
+        report.total_rows += len(chunk)
+        await apply_chunk(chunk, report)
+    return report
+
+@api_router.post("/admin/users/bulk")
+async def bulk_import_users(request: Request, format: Optional[str] = None, admin: dict = Depends(get_current_admin)):
+    """
+    Import users from a CSV (with header) or NDJSON body.
+    Rows are validated and inserted in chunks; invalid rows are reported by line and skipped.
+    """
+    report = await run_bulk_user_job(request, format, import_user_chunk)
+
+    await log_admin_activity(
+        admin_id=admin['id'],
+        admin_name=admin['name'],
+        action="bulk_import_users",
+        target_type="user",
+        details={"total_rows": report.total_rows, "inserted": report.applied, "failed": report.error_count}
+    )
+
+    return report.as_dict("inserted")
+
+@api_router.patch("/admin/users/bulk")
+async def bulk_update_users(request: Request, format: Optional[str] = None, admin: dict = Depends(get_current_admin)):
+    """
+    Update users from a CSV (with header) or NDJSON body; each row needs `id` plus the fields to change
+    """
+    report = await run_bulk_user_job(request, format, update_user_chunk)
+
+    await log_admin_activity(
+        admin_id=admin['id'],
+        admin_name=admin['name'],
+        action="bulk_update_users",
+        target_type="user",
+        details={"total_rows": report.total_rows, "updated": report.applied, "failed": report.error_count}
+    )
+
+    return report.as_dict("updated")
+
 @api_router.delete("/admin/users/{user_id}")
 async def delete_user(user_id: str):
     """
@@ -718,7 +1327,7 @@ async def get_all_trips(status: Optional[str] = None):
     if status:
         query["status"] = status
     
-    trips = await db.trips.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    trips = await find_trips(db, query)
     return [Trip(**deserialize_doc(t)) for t in trips]
 
 @api_router.get("/admin/drivers/active")
@@ -733,21 +1342,47 @@ async def get_active_drivers():
     
     return [deserialize_doc(d) for d in drivers]
 
+@api_router.get("/admin/map/snapshot")
+async def get_live_map_snapshot(admin: dict = Depends(get_current_admin)):
+    """
+    Compact state of all online drivers: {epoch, version, drivers: [[id, lat, lng, status, version], ...]}
+    """
+    return map_state.snapshot()
+
+@api_router.get("/admin/map/delta")
+async def get_live_map_delta(since: int, epoch: int, admin: dict = Depends(get_current_admin)):
+    """
+    Changes after version `since` (for polling clients); reload=true means the client must replace its state
+    """
+    delta = map_state.delta(since) if epoch == map_state.epoch else None
+    if delta is None:
+        return {**map_state.snapshot(), "reload": True}
+    return delta
+
 @api_router.post("/admin/notifications", response_model=Notification)
 async def send_notification(notification: NotificationCreate):
     """
     Send notification to specific user, role, or broadcast to all
     """
+    # Stored once: broadcasts are fanned out when read, not copied per user
     new_notification = Notification(**notification.model_dump())
     doc = new_notification.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     await db.notifications.insert_one(doc)
     
-    # Emit via WebSocket
+    # Deliver only to the addressed user or role room; broadcast only when untargeted
+    if notification.user_id:
+        room = user_room(notification.user_id)
+    elif notification.role:
+        room = role_room(notification.role)
+    else:
+        room = None
+    
     await sio.emit('notification', {
+        'id': new_notification.id,
         'message': notification.message,
-        'timestamp': new_notification.created_at.isoformat()
-    })
+        'timestamp': doc['created_at']
+    }, room=room)
     
     return new_notification
 
@@ -775,13 +1410,16 @@ async def get_revenue_analytics(period: str = "daily", admin: dict = Depends(get
         date_format = "%Y-%m"
     
     # Get completed trips
-    completed_trips = await db.trips.find(
+    completed_trips = await find_trips(
+        analytics_db,
         {
             "status": TripStatus.COMPLETED,
             "completed_at": {"$gte": start_date.isoformat()}
         },
-        {"_id": 0, "price": 1, "completed_at": 1}
-    ).to_list(10000)
+        {"price": 1, "completed_at": 1},
+        sort_field="completed_at",
+        limit=10000
+    )
     
     # Aggregate by period
     revenue_by_date = {}
@@ -807,47 +1445,58 @@ async def get_driver_performance(admin: dict = Depends(get_current_admin)):
     """
     Get driver performance metrics
     """
-    drivers = await db.users.find({"role": UserRole.DRIVER}, {"_id": 0}).to_list(1000)
-    performance_data = []
+    drivers = await analytics_db.users.find({"role": UserRole.DRIVER}, {"_id": 0, "id": 1, "name": 1}).to_list(1000)
+    driver_ids = [driver['id'] for driver in drivers]
+    
+    # One grouped aggregation per tier instead of a trip query per driver
+    pipeline = [
+        {"$match": {"driver_id": {"$in": driver_ids}}},
+        {"$group": {
+            "_id": "$driver_id",
+            "total": {"$sum": 1},
+            "completed": {"$sum": {"$cond": [{"$eq": ["$status", TripStatus.COMPLETED]}, 1, 0]}},
+            "cancelled": {"$sum": {"$cond": [{"$eq": ["$status", TripStatus.CANCELLED]}, 1, 0]}},
+            "revenue": {"$sum": {"$cond": [{"$eq": ["$status", TripStatus.COMPLETED]}, {"$ifNull": ["$price", 0]}, 0]}},
+        }},
+    ]
+    hot, cold = await asyncio.gather(
+        analytics_db.trips.aggregate(pipeline).to_list(None),
+        analytics_db[ARCHIVE_COLLECTION].aggregate(pipeline).to_list(None),
+    )
+    totals: Dict[str, Dict[str, float]] = {}
+    for row in hot + cold:
+        counts = totals.setdefault(row['_id'], {"total": 0, "completed": 0, "cancelled": 0, "revenue": 0})
+        for key in counts:
+            counts[key] += row.get(key, 0)
     
+    performance_data = []
     for driver in drivers:
-        driver_id = driver['id']
-        
-        # Get all trips
-        all_trips = await db.trips.find({"driver_id": driver_id}, {"_id": 0}).to_list(1000)
-        completed_trips = [t for t in all_trips if t.get('status') == TripStatus.COMPLETED]
-        cancelled_trips = [t for t in all_trips if t.get('status') == TripStatus.CANCELLED]
-        
-        total_revenue = sum(t.get('price', 0) for t in completed_trips)
-        completion_rate = (len(completed_trips) / len(all_trips) * 100) if all_trips else 0
+        counts = totals.get(driver['id'], {"total": 0, "completed": 0, "cancelled": 0, "revenue": 0})
+        completion_rate = (counts['completed'] / counts['total'] * 100) if counts['total'] else 0
         
         performance_data.append({
-            "driver_id": driver_id,
+            "driver_id": driver['id'],
             "driver_name": driver.get('name'),
-            "total_trips": len(all_trips),
-            "completed_trips": len(completed_trips),
-            "cancelled_trips": len(cancelled_trips),
-            "total_revenue": total_revenue,
+            "total_trips": counts['total'],
+            "completed_trips": counts['completed'],
+            "cancelled_trips": counts['cancelled'],
+            "total_revenue": counts['revenue'],
             "completion_rate": round(completion_rate, 2),
             "avg_rating": None  # Can be added later
         })
     
     return performance_data
 
-@api_router.get("/admin/trips/advanced")
-async def get_trips_advanced(
+def build_trip_filter(
     status: Optional[str] = None,
     driver_id: Optional[str] = None,
     passenger_id: Optional[str] = None,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     min_price: Optional[float] = None,
-    max_price: Optional[float] = None,
-    admin: dict = Depends(get_current_admin)
-):
-    """
-    Advanced trip filtering
-    """
+    max_price: Optional[float] = None
+) -> Dict[str, Any]:
+    """Mongo filter shared by the advanced trip search and the trip export"""
     query = {}
     
     if status:
@@ -869,7 +1518,25 @@ async def get_trips_advanced(
             query["price"] = {}
         query["price"]["$lte"] = max_price
     
-    trips = await db.trips.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    return query
+
+@api_router.get("/admin/trips/advanced")
+async def get_trips_advanced(
+    status: Optional[str] = None,
+    driver_id: Optional[str] = None,
+    passenger_id: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    admin: dict = Depends(get_current_admin)
+):
+    """
+    Advanced trip filtering
+    """
+    query = build_trip_filter(status, driver_id, passenger_id, start_date, end_date, min_price, max_price)
+    
+    trips = await find_trips(db, query)
     return [Trip(**deserialize_doc(t)) for t in trips]
 
 @api_router.get("/admin/activity-logs")
@@ -902,6 +1569,8 @@ async def update_pricing_config(pricing: PricingUpdate, admin: dict = Depends(ge
         "updated_at": datetime.now(timezone.utc).isoformat(),
         "updated_by": admin['id']
     }
+    if pricing.per_minute is not None:
+        update_data["per_minute"] = pricing.per_minute
     
     await db.pricing_config.update_one(
         {"id": "pricing_config"},
@@ -1054,14 +1723,11 @@ async def delete_fare_range(range_id: str, admin: dict = Depends(get_current_adm
 @api_router.get("/admin/search/users")
 async def search_users(q: str, role: Optional[str] = None, admin: dict = Depends(get_current_admin)):
     """
-    Search users by name or phone
+    Search users by name word prefixes or phone digit prefix (index-backed type-ahead)
     """
-    query = {
-        "$or": [
-            {"name": {"$regex": q, "$options": "i"}},
-            {"phone": {"$regex": q}}
-        ]
-    }
+    query = build_search_query(q)
+    if query is None:
+        return []
     if role:
         query["role"] = role
     
@@ -1072,14 +1738,21 @@ async def search_users(q: str, role: Optional[str] = None, admin: dict = Depends
 async def admin_update_trip_status(trip_id: str, status: str, admin: dict = Depends(get_current_admin)):
     """
     Manually update trip status (emergency override)
+    Only transitions allowed by the trip state machine are applied
     """
-    result = await db.trips.update_one(
-        {"id": trip_id},
-        {"$set": {"status": status}}
-    )
+    # Drivers are assigned through accept-trip; a driverless accepted trip breaks offers, feeds and finances
+    match = {"driver_id": {"$nin": [None, ""]}} if status in (TripStatus.ACCEPTED, TripStatus.IN_PROGRESS) else None
+    trip = await transition_trip(trip_id, status, match=match)
     
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="سفر یافت نشد")
+    if not trip:
+        if match and await db.trips.find_one({"id": trip_id, "driver_id": {"$in": [None, ""]}}, {"_id": 1}):
+            raise HTTPException(status_code=400, detail="سفر راننده ندارد؛ ابتدا باید راننده سفر را بپذیرد")
+        await raise_transition_error(trip_id, status)
+    
+    # Credit the driver exactly once; the transition above cannot complete a trip twice
+    if status == TripStatus.COMPLETED and trip.get('driver_id'):
+        trip = await finalize_trip_fare(trip)
+        await update_driver_finances_on_trip_completion(trip['driver_id'], trip.get('price', 0))
     
     # Log activity
     await log_admin_activity(
@@ -1091,7 +1764,6 @@ async def admin_update_trip_status(trip_id: str, status: str, admin: dict = Depe
         details={"new_status": status}
     )
     
-    trip = await db.trips.find_one({"id": trip_id}, {"_id": 0})
     return {"success": True, "message": "وضعیت سفر به‌روزرسانی شد", "trip": Trip(**deserialize_doc(trip))}
 
 @api_router.get("/admin/dashboard/realtime-stats")
@@ -1110,8 +1782,8 @@ async def get_realtime_stats(admin: dict = Depends(get_current_admin)):
     pending_trips = await db.trips.count_documents({"status": TripStatus.PENDING})
     accepted_trips = await db.trips.count_documents({"status": TripStatus.ACCEPTED})
     inprogress_trips = await db.trips.count_documents({"status": TripStatus.IN_PROGRESS})
-    completed_trips_all = await db.trips.count_documents({"status": TripStatus.COMPLETED})
-    cancelled_trips = await db.trips.count_documents({"status": TripStatus.CANCELLED})
+    completed_trips_all = await count_trips(db, {"status": TripStatus.COMPLETED})
+    cancelled_trips = await count_trips(db, {"status": TripStatus.CANCELLED})
     
     # Today's stats
     today_start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
@@ -1175,18 +1847,23 @@ async def update_driver_profile(driver_id: str, update: UserUpdate):
     """
     update_data = {k: v for k, v in update.model_dump().items() if v is not None}
     
-    result = await db.users.update_one(
+    if not update_data:
+        raise HTTPException(status_code=400, detail="هیچ داده‌ای برای به‌روزرسانی ارسال نشده")
+    
+    driver = await db.users.find_one_and_update(
         {"id": driver_id, "role": UserRole.DRIVER},
-        {"$set": update_data}
+        {"$set": {**update_data, **user_search_fields(update_data.get('name'))}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.matched_count == 0:
+    if not driver:
         raise HTTPException(status_code=404, detail="راننده یافت نشد")
     
-    driver = await db.users.find_one({"id": driver_id}, {"_id": 0})
     return User(**deserialize_doc(driver))
 
-@api_router.put("/driver/{driver_id}/location")
+@api_router.put("/driver/{driver_id}/location",
+                dependencies=[Depends(rate_limiter.dependency("location", RATE_LIMIT_LOCATION, "driver_id"))])
 async def update_driver_location(driver_id: str, location: LocationUpdate):
     """
     Update driver's current location
@@ -1195,7 +1872,10 @@ async def update_driver_location(driver_id: str, location: LocationUpdate):
     
     await db.users.update_one(
         {"id": driver_id, "role": UserRole.DRIVER},
-        {"$set": {"current_location": location_data}}
+        {"$set": {
+            "current_location": location_data,
+            "location_updated_at": datetime.now(timezone.utc).isoformat()
+        }}
     )
     
     # Store in memory for real-time tracking
@@ -1206,7 +1886,12 @@ async def update_driver_location(driver_id: str, location: LocationUpdate):
     }
     
     # Emit location update via WebSocket
-    await sio.emit(f'driver_location_{driver_id}', location_data)
+    location_batcher.add(driver_id, location.lat, location.lng)
+    map_state.update_location(driver_id, location.lat, location.lng)
+    if GPS_TRACES_ENABLED:
+        trace_writer.add(driver_id, location.lat, location.lng)
+    if LEGACY_LOCATION_EVENTS:
+        await sio.emit(f'driver_location_{driver_id}', location_data)
     
     return {"success": True, "message": "موقعیت به‌روزرسانی شد"}
 
@@ -1220,27 +1905,38 @@ async def get_nearby_requests(driver_id: str):
     if not driver or not driver.get('current_location'):
         return []
     
-    # Get all pending trips (in real app, filter by distance)
-    pending_trips = await db.trips.find(
-        {"status": TripStatus.PENDING},
-        {"_id": 0}
-    ).to_list(100)
+    # Get pending trips not currently offered to another driver (in real app, filter by distance)
+    query = {"status": TripStatus.PENDING}
+    query.update(offer_visible_filter(driver_id))
+    pending_trips = await db.trips.find(query, {"_id": 0}).to_list(100)
     
     return [Trip(**deserialize_doc(t)) for t in pending_trips]
 
 @api_router.post("/driver/{driver_id}/accept-trip/{trip_id}")
-async def accept_trip(driver_id: str, trip_id: str):
+async def accept_trip(
+    driver_id: str,
+    trip_id: str,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """
     Driver accepts a trip request
+    Replays with the same Idempotency-Key return the original response
     """
-    # Get driver info
-    driver = await db.users.find_one({"id": driver_id, "role": UserRole.DRIVER}, {"_id": 0})
+    idempotency_scope = f"accept_trip:{driver_id}"
+    replay = await get_idempotent_response(idempotency_scope, idempotency_key)
+    if replay is not None:
+        return replay
+    
+    # Get driver profile and lock state in one read (lock state is cached on the user)
+    driver = await db.users.find_one(
+        {"id": driver_id, "role": UserRole.DRIVER},
+        {"_id": 0, "name": 1, "phone": 1, "car_model": 1, "is_active": 1, "account_locked": 1}
+    )
     if not driver:
         raise HTTPException(status_code=404, detail="راننده یافت نشد")
     
     # Check if driver account is locked due to unpaid commission
-    finance = await db.driver_finances.find_one({"driver_id": driver_id}, {"_id": 0})
-    if finance and finance.get('account_locked', False):
+    if driver.get('account_locked', False):
         raise HTTPException(
             status_code=403, 
             detail="حساب شما به دلیل کمیسیون پرداخت نشده قفل شده است. لطفاً با مدیر سیستم تماس بگیرید."
@@ -1250,24 +1946,28 @@ async def accept_trip(driver_id: str, trip_id: str):
     if not driver.get('is_active', True):
         raise HTTPException(status_code=403, detail="حساب شما غیرفعال است")
     
-    # Update trip
-    result = await db.trips.update_one(
-        {"id": trip_id, "status": TripStatus.PENDING},
-        {"$set": {
+    # Accept the trip and get the updated document in the same round trip
+    trip = await transition_trip(
+        trip_id,
+        TripStatus.ACCEPTED,
+        match=offer_visible_filter(driver_id),
+        extra_set={
             "driver_id": driver_id,
             "driver_name": driver.get('name'),
             "driver_phone": driver.get('phone'),
-            "driver_car_model": driver.get('car_model'),
-            "status": TripStatus.ACCEPTED,
-            "accepted_at": datetime.now(timezone.utc).isoformat()
-        }}
+            "driver_car_model": driver.get('car_model')
+        }
     )
     
-    if result.matched_count == 0:
-        raise HTTPException(status_code=400, detail="سفر یافت نشد یا قبلاً پذیرفته شده")
-    
-    # Get updated trip
-    trip = await db.trips.find_one({"id": trip_id}, {"_id": 0})
+    if not trip:
+        # A retried accept by the same driver is not an error
+        trip = await db.trips.find_one(
+            {"id": trip_id, "driver_id": driver_id, "status": TripStatus.ACCEPTED},
+            {"_id": 0}
+        )
+        if not trip:
+            raise HTTPException(status_code=400, detail="سفر یافت نشد یا قبلاً پذیرفته شده")
+        return {"success": True, "message": "سفر با موفقیت پذیرفته شد", "trip": Trip(**deserialize_doc(trip))}
     
     # Notify passenger via WebSocket
     await sio.emit(f'trip_accepted_{trip["passenger_id"]}', {
@@ -1279,40 +1979,51 @@ async def accept_trip(driver_id: str, trip_id: str):
         }
     })
     
-    return {"success": True, "message": "سفر با موفقیت پذیرفته شد", "trip": Trip(**deserialize_doc(trip))}
+    response = {"success": True, "message": "سفر با موفقیت پذیرفته شد", "trip": Trip(**deserialize_doc(trip))}
+    await store_idempotent_response(idempotency_scope, idempotency_key, response)
+    
+    return response
 
 @api_router.post("/driver/{driver_id}/reject-trip/{trip_id}")
 async def reject_trip(driver_id: str, trip_id: str):
     """
     Driver rejects a trip request
+    The matcher will not offer this trip to the same driver again
     """
+    await db.trips.update_one(
+        {"id": trip_id, "status": TripStatus.PENDING},
+        {"$addToSet": {"rejected_driver_ids": driver_id}}
+    )
+    
+    # Release an outstanding offer so the trip is re-matched in the next window
+    released = await db.trips.find_one_and_update(
+        {"id": trip_id, "status": TripStatus.PENDING, "offered_driver_id": driver_id},
+        {"$set": {"offer_expires_at": datetime.now(timezone.utc).isoformat()}},
+        projection=TRIP_FEED_PROJECTION
+    )
+    if released:
+        await publish_trip_feed_add(released)
+    
     return {"success": True, "message": "سفر رد شد"}
 
 @api_router.put("/driver/{driver_id}/trip/{trip_id}/status")
 async def update_trip_status(driver_id: str, trip_id: str, status: str):
     """
-    Update trip status (in_progress, completed)
+    Update trip status (in_progress, completed, cancelled)
     """
-    update_data = {"status": status}
+    # Acceptance goes through accept-trip, which records the driver details
+    if status not in (TripStatus.IN_PROGRESS, TripStatus.COMPLETED, TripStatus.CANCELLED):
+        raise HTTPException(status_code=400, detail="وضعیت سفر نامعتبر است")
     
-    if status == TripStatus.IN_PROGRESS:
-        update_data["started_at"] = datetime.now(timezone.utc).isoformat()
-    elif status == TripStatus.COMPLETED:
-        update_data["completed_at"] = datetime.now(timezone.utc).isoformat()
+    trip = await transition_trip(trip_id, status, match={"driver_id": driver_id})
     
-    result = await db.trips.update_one(
-        {"id": trip_id, "driver_id": driver_id},
-        {"$set": update_data}
-    )
-    
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="سفر یافت نشد")
-    
-    trip = await db.trips.find_one({"id": trip_id}, {"_id": 0})
+    if not trip:
+        await raise_transition_error(trip_id, status, match={"driver_id": driver_id})
     
     # If trip is completed, update driver finances
     financial_update = None
-    if status == TripStatus.COMPLETED and trip:
+    if status == TripStatus.COMPLETED:
+        trip = await finalize_trip_fare(trip)
         trip_price = trip.get('price', 0)
         financial_update = await update_driver_finances_on_trip_completion(driver_id, trip_price)
     
@@ -1342,7 +2053,7 @@ async def get_driver_trips(driver_id: str, status: Optional[str] = None):
     if status:
         query["status"] = status
     
-    trips = await db.trips.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    trips = await find_trips(db, query)
     return [Trip(**deserialize_doc(t)) for t in trips]
 
 # ===================== Driver Financial Routes =====================
@@ -1373,12 +2084,18 @@ async def get_driver_earnings_summary(driver_id: str, period: str = "today"):
     else:  # all
         start_date = datetime.min.replace(tzinfo=timezone.utc)
     
-    # Get completed trips for the period
-    trips = await db.trips.find({
-        "driver_id": driver_id,
-        "status": TripStatus.COMPLETED,
-        "completed_at": {"$gte": start_date.isoformat()}
-    }, {"_id": 0}).to_list(10000)
+    # Get completed trips for the period, from both tiers ("month" and "all" reach archived trips)
+    trips = await find_trips(
+        db,
+        {
+            "driver_id": driver_id,
+            "status": TripStatus.COMPLETED,
+            "completed_at": {"$gte": start_date.isoformat()}
+        },
+        {"price": 1},
+        sort_field="completed_at",
+        limit=10000
+    )
     
     # Calculate earnings
     total_earned = sum(trip.get('price', 0) for trip in trips)
@@ -1435,54 +2152,118 @@ async def update_passenger_profile(passenger_id: str, update: UserUpdate):
     """
     update_data = {k: v for k, v in update.model_dump().items() if v is not None}
     
-    result = await db.users.update_one(
+    if not update_data:
+        raise HTTPException(status_code=400, detail="هیچ داده‌ای برای به‌روزرسانی ارسال نشده")
+    
+    passenger = await db.users.find_one_and_update(
         {"id": passenger_id, "role": UserRole.PASSENGER},
-        {"$set": update_data}
+        {"$set": {**update_data, **user_search_fields(update_data.get('name'))}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.matched_count == 0:
+    if not passenger:
         raise HTTPException(status_code=404, detail="مسافر یافت نشد")
     
-    passenger = await db.users.find_one({"id": passenger_id}, {"_id": 0})
     return User(**deserialize_doc(passenger))
 
 
 # ===================== Price Estimation API =====================
 
 class PriceEstimateRequest(BaseModel):
-    distance_km: float
+    distance_km: Optional[float] = None
+    origin: Optional[Dict[str, Any]] = None  # {lat, lng}, used when distance_km is not given
+    destination: Optional[Dict[str, Any]] = None
+
+class RouteMatrixRequest(BaseModel):
+    origins: List[Dict[str, Any]]  # [{lat, lng}, ...]
+    destinations: List[Dict[str, Any]]
+
+MAX_MATRIX_POINTS = 100
 
-@api_router.post("/estimate-price")
+@api_router.post("/estimate-price", dependencies=[Depends(rate_limiter.dependency("estimate_price", RATE_LIMIT_ESTIMATE))])
 async def estimate_trip_price(request: PriceEstimateRequest):
     """
-    Estimate trip price based on distance
+    Estimate trip price based on distance, or on the road route between origin and destination
     تخمین قیمت سفر بر اساس مسافت
     """
-    if request.distance_km <= 0:
+    duration_minutes = None
+    distance_km = request.distance_km
+    
+    if distance_km is None:
+        if not request.origin or not request.destination:
+            raise HTTPException(status_code=400, detail="مسافت یا مبدأ و مقصد باید ارسال شود")
+        route = await routing_service.route(location_point(request.origin), location_point(request.destination))
+        distance_km = round(route.distance_km, 2)
+        duration_minutes = max(1, round(route.duration_minutes))
+    
+    if distance_km <= 0:
         raise HTTPException(status_code=400, detail="مسافت باید بیشتر از صفر باشد")
     
-    price = await calculate_trip_price(request.distance_km)
+    price = await calculate_trip_price(distance_km)
     
-    return {
-        "distance_km": request.distance_km,
+    response = {
+        "distance_km": distance_km,
         "estimated_price": round(price, 2),
         "currency": "AFN"
     }
+    if duration_minutes is not None:
+        response["duration_minutes"] = duration_minutes
+    
+    return response
+
+@api_router.post("/routing/matrix")
+async def get_route_matrix(request: RouteMatrixRequest):
+    """
+    Distance (km) and duration (minutes) for every origin/destination pair
+    ماتریس مسافت و زمان
+    """
+    if len(request.origins) > MAX_MATRIX_POINTS or len(request.destinations) > MAX_MATRIX_POINTS:
+        raise HTTPException(status_code=400, detail=f"حداکثر {MAX_MATRIX_POINTS} مبدأ و مقصد مجاز است")
+    
+    origins = [location_point(o) for o in request.origins]
+    destinations = [location_point(d) for d in request.destinations]
+    distances, durations = await routing_service.matrix(origins, destinations)
+    
+    return {
+        "distances_km": distances.round(3).tolist(),
+        "durations_minutes": durations.round(1).tolist()
+    }
 
 # ===================== Passenger APIs =====================
 
-@api_router.post("/passenger/{passenger_id}/request-ride", response_model=Trip)
-async def request_ride(passenger_id: str, trip_data: TripCreate):
+@api_router.post("/passenger/{passenger_id}/request-ride", response_model=Trip,
+                 dependencies=[Depends(rate_limiter.dependency("request_ride", RATE_LIMIT_REQUEST_RIDE, "passenger_id"))])
+async def request_ride(
+    passenger_id: str,
+    trip_data: TripCreate,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """
     Passenger requests a new ride
+    Replays with the same Idempotency-Key return the original trip
     """
+    idempotency_scope = f"request_ride:{passenger_id}"
+    replay = await get_idempotent_response(idempotency_scope, idempotency_key)
+    if replay is not None:
+        return replay
+    
     # Get passenger info
     passenger = await db.users.find_one({"id": passenger_id, "role": UserRole.PASSENGER}, {"_id": 0})
     if not passenger:
         raise HTTPException(status_code=404, detail="مسافر یافت نشد")
     
-    # Calculate distance (mock calculation)
-    distance_km = random.uniform(2, 15)  # Random distance for demo
+    # Cheap early rejection; the unique partial index below still decides concurrent requests
+    active_trip = await find_active_trip(passenger_id)
+    if active_trip:
+        if idempotency_key:
+            # Replay of a request that is still in flight
+            return Trip(**deserialize_doc(active_trip))
+        raise HTTPException(status_code=409, detail="شما یک سفر فعال دارید")
+    
+    # Road distance and ETA between origin and destination
+    route = await routing_service.route(location_point(trip_data.origin), location_point(trip_data.destination))
+    distance_km = round(route.distance_km, 2)
     
     # Calculate price
     price = await calculate_trip_price(distance_km)
@@ -1496,36 +2277,55 @@ async def request_ride(passenger_id: str, trip_data: TripCreate):
         destination=trip_data.destination,
         price=price,
         distance_km=distance_km,
-        duration_minutes=int(distance_km * 2.5)  # Mock duration
+        duration_minutes=max(1, round(route.duration_minutes))
     )
     
     doc = new_trip.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
-    await db.trips.insert_one(doc)
-    
-    # Notify nearby drivers via WebSocket
-    await sio.emit('new_trip_request', {
-        "trip_id": new_trip.id,
-        "passenger_name": new_trip.passenger_name,
-        "origin": new_trip.origin,
-        "destination": new_trip.destination,
-        "price": new_trip.price
-    })
+    try:
+        await db.trips.insert_one(doc)
+    except DuplicateKeyError:
+        # The unique partial index allows only one active trip per passenger
+        active_trip = await find_active_trip(passenger_id)
+        if idempotency_key and active_trip:
+            # Concurrent replay of a request that is still in flight
+            return Trip(**deserialize_doc(active_trip))
+        raise HTTPException(status_code=409, detail="شما یک سفر فعال دارید")
+    
+    # Drivers subscribed to the push feed around the origin
+    await publish_trip_feed_add(doc)
+    
+    if not admin_feed.change_stream_active:
+        await admin_feed.publish_trip_change(doc, created=True)
+    
+    # Notify nearby drivers via WebSocket (with matching enabled, drivers get targeted offers instead)
+    if not MATCHING_ENABLED:
+        await sio.emit('new_trip_request', {
+            "trip_id": new_trip.id,
+            "passenger_name": new_trip.passenger_name,
+            "origin": new_trip.origin,
+            "destination": new_trip.destination,
+            "price": new_trip.price
+        })
+    
+    schedule_trip_expiry(new_trip.id, new_trip.created_at)
+    
+    await store_idempotent_response(idempotency_scope, idempotency_key, new_trip)
     
     return new_trip
 
+async def find_active_trip(passenger_id: str) -> Optional[Dict]:
+    return await db.trips.find_one(
+        {"passenger_id": passenger_id, "status": {"$in": ACTIVE_TRIP_STATUSES}},
+        {"_id": 0}
+    )
+
 @api_router.get("/passenger/{passenger_id}/active-trip")
 async def get_active_trip(passenger_id: str):
     """
     Get passenger's current active trip
     """
-    trip = await db.trips.find_one(
-        {
-            "passenger_id": passenger_id,
-            "status": {"$in": [TripStatus.PENDING, TripStatus.ACCEPTED, TripStatus.IN_PROGRESS]}
-        },
-        {"_id": 0}
-    )
+    trip = await find_active_trip(passenger_id)
     
     if not trip:
         return None
@@ -1537,42 +2337,206 @@ async def get_passenger_trips(passenger_id: str):
     """
     Get passenger's trip history
     """
-    trips = await db.trips.find(
-        {"passenger_id": passenger_id},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(1000)
+    trips = await find_trips(db, {"passenger_id": passenger_id})
     
     return [Trip(**deserialize_doc(t)) for t in trips]
 
+@api_router.get("/passenger/{passenger_id}/trip/{trip_id}/trace")
+async def get_passenger_trip_trace(passenger_id: str, trip_id: str, tolerance_m: float = 10):
+    """
+    Route the driver actually took on this trip, simplified to within tolerance_m metres
+    """
+    trips = await find_trips(db, {"id": trip_id, "passenger_id": passenger_id}, limit=1)
+    if not trips:
+        raise HTTPException(status_code=404, detail="سفر یافت نشد")
+    return await simplified_trace(db, trips[0], tolerance_m)
+
 @api_router.delete("/passenger/{passenger_id}/trip/{trip_id}")
 async def cancel_trip(passenger_id: str, trip_id: str):
     """
     Cancel a pending trip
     """
-    result = await db.trips.update_one(
-        {"id": trip_id, "passenger_id": passenger_id, "status": TripStatus.PENDING},
-        {"$set": {"status": TripStatus.CANCELLED}}
+    trip = await transition_trip(
+        trip_id,
+        TripStatus.CANCELLED,
+        match={"passenger_id": passenger_id},
+        allowed_from=[TripStatus.PENDING]
     )
     
-    if result.matched_count == 0:
+    if not trip:
         raise HTTPException(status_code=400, detail="سفر یافت نشد یا قابل لغو نیست")
     
     return {"success": True, "message": "سفر لغو شد"}
 
 # ===================== Notifications =====================
 
+async def notification_inbox_filter(user_id: str) -> Dict:
+    """Notifications addressed to the user, plus broadcasts to everyone or to the user's role"""
+    # The role always comes from the user record; a caller-supplied role would expose other roles' broadcasts
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "role": 1})
+    role = user.get('role') if user else None
+    return {"$or": [
+        {"user_id": user_id},
+        {"user_id": None, "role": {"$in": [None, role]}}
+    ]}
+
+async def get_last_read_at(user_id: str) -> str:
+    cursor = await db.notification_reads.find_one({"user_id": user_id}, {"_id": 0, "last_read_at": 1})
+    return cursor.get('last_read_at', '') if cursor else ''
+
 @api_router.get("/notifications/{user_id}")
-async def get_user_notifications(user_id: str):
+async def get_user_notifications(
+    user_id: str,
+    before: Optional[str] = None,
+    limit: int = 50
+):
     """
-    Get notifications for a specific user
+    Get notifications for a specific user, newest first
+    Page with ?before=<created_at of the last item>
     """
-    notifications = await db.notifications.find(
-        {"$or": [{"user_id": user_id}, {"user_id": None}]},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(100)
+    limit = max(1, min(limit, 100))
+    query = await notification_inbox_filter(user_id)
+    if before:
+        query["created_at"] = {"$lt": before}
+    
+    notifications = await db.notifications.find(query, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+    last_read_at = await get_last_read_at(user_id)
+    
+    for n in notifications:
+        n['is_read'] = n.get('created_at', '') <= last_read_at
     
     return [Notification(**deserialize_doc(n)) for n in notifications]
 
+@api_router.get("/notifications/{user_id}/unread-count")
+async def get_unread_notification_count(user_id: str):
+    """
+    Number of notifications newer than the user's last-read cursor
+    """
+    query = await notification_inbox_filter(user_id)
+    last_read_at = await get_last_read_at(user_id)
+    if last_read_at:
+        query["created_at"] = {"$gt": last_read_at}
+    
+    unread_count = await db.notifications.count_documents(query)
+    return {"user_id": user_id, "unread_count": unread_count, "last_read_at": last_read_at or None}
+
+@api_router.post("/notifications/{user_id}/read")
+async def mark_notifications_read(user_id: str, request: Optional[NotificationReadRequest] = None):
+    """
+    Move the user's last-read cursor forward (everything up to `up_to`, default now, is read)
+    """
+    now = datetime.now(timezone.utc)
+    up_to = now
+    if request and request.up_to:
+        try:
+            up_to = parse_time(request.up_to).astimezone(timezone.utc)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="زمان up_to نامعتبر است")
+    # Stored in the same UTC ISO form as notification created_at, so the text comparison holds;
+    # a cursor in the future would mark notifications as read before they exist
+    up_to = min(up_to, now).isoformat()
+    
+    # $max keeps the cursor monotonic when older read markers arrive late
+    await db.notification_reads.update_one(
+        {"user_id": user_id},
+        {"$max": {"last_read_at": up_to}},
+        upsert=True
+    )
+    
+    return {"success": True, "last_read_at": up_to}
+
+# ===================== Accounting Exports =====================
+
+# Rows per cursor batch, CSV write and Parquet row group
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '5000'))
+
+def export_response(rows, columns, format: str, name: str) -> StreamingResponse:
+    """Stream cursor rows as CSV or Parquet; memory stays at one batch however many rows match"""
+    format = format.lower()
+    if format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="فرمت باید csv یا parquet باشد")
+    if format == "parquet" and not parquet_available():
+        raise HTTPException(status_code=400, detail="خروجی Parquet در این سرور فعال نیست (pyarrow نصب نشده)")
+    
+    filename = f"{name}-{datetime.now(timezone.utc).strftime('%Y%m%d')}.{format}"
+    return StreamingResponse(
+        stream_export(rows, columns, format, EXPORT_BATCH_SIZE),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+async def log_export(admin: dict, target_type: str, format: str, filters: Dict[str, Any]):
+    await log_admin_activity(
+        admin_id=admin['id'],
+        admin_name=admin['name'],
+        action="export",
+        target_type=target_type,
+        details={"format": format, "filters": filters}
+    )
+
+@api_router.get("/admin/export/trips")
+async def export_trips(
+    format: str = "csv",
+    status: Optional[str] = None,
+    driver_id: Optional[str] = None,
+    passenger_id: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    admin: dict = Depends(get_current_admin)
+):
+    """
+    Export trips (same filters as /admin/trips/advanced, no row cap), archived trips first, then the hot tier oldest first
+    """
+    query = build_trip_filter(status, driver_id, passenger_id, start_date, end_date, min_price, max_price)
+    projection = export_projection(TRIP_EXPORT_COLUMNS)
+    rows = chain_cursors(
+        analytics_db[ARCHIVE_COLLECTION].find(query, projection).sort("created_at", 1).batch_size(EXPORT_BATCH_SIZE),
+        analytics_db.trips.find(query, projection).sort("created_at", 1).batch_size(EXPORT_BATCH_SIZE)
+    )
+    response = export_response(rows, TRIP_EXPORT_COLUMNS, format, "trips")
+    await log_export(admin, "trip", format, query)
+    return response
+
+@api_router.get("/admin/export/finances/drivers")
+async def export_driver_finances(format: str = "csv", admin: dict = Depends(get_current_admin)):
+    """
+    Export every driver's finance summary
+    """
+    cursor = analytics_db.driver_finances.find({}, export_projection(DRIVER_FINANCE_EXPORT_COLUMNS)).sort("driver_id", 1).batch_size(EXPORT_BATCH_SIZE)
+    response = export_response(cursor, DRIVER_FINANCE_EXPORT_COLUMNS, format, "driver-finances")
+    await log_export(admin, "driver_finance", format, {})
+    return response
+
+@api_router.get("/admin/export/finances/payments")
+async def export_commission_payments(
+    format: str = "csv",
+    driver_id: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    admin: dict = Depends(get_current_admin)
+):
+    """
+    Export recorded commission payments, oldest first
+    """
+    query: Dict[str, Any] = {}
+    if driver_id:
+        query["driver_id"] = driver_id
+    if start_date or end_date:
+        query["payment_date"] = {}
+        if start_date:
+            query["payment_date"]["$gte"] = start_date
+        if end_date:
+            query["payment_date"]["$lte"] = end_date
+    
+    cursor = analytics_db.commission_payments.find(
+        query, export_projection(COMMISSION_PAYMENT_EXPORT_COLUMNS)
+    ).sort("payment_date", 1).batch_size(EXPORT_BATCH_SIZE)
+    response = export_response(cursor, COMMISSION_PAYMENT_EXPORT_COLUMNS, format, "commission-payments")
+    await log_export(admin, "commission_payment", format, query)
+    return response
+
 # ===================== Admin Financial Management Routes =====================
 
 @api_router.get("/admin/finances/drivers")
@@ -1597,7 +2561,7 @@ async def get_driver_finance_details(driver_id: str, admin: dict = Depends(get_c
     ).sort("payment_date", -1).to_list(100)
     
     # Get trip statistics
-    completed_trips = await db.trips.count_documents({
+    completed_trips = await count_trips(db, {
         "driver_id": driver_id,
         "status": TripStatus.COMPLETED
     })
@@ -1703,8 +2667,10 @@ async def unlock_driver_account(driver_id: str, admin: dict = Depends(get_curren
     # Unlock user account
     await db.users.update_one(
         {"id": driver_id},
-        {"$set": {"is_active": True}}
+        {"$set": {"is_active": True, "account_locked": False}}
     )
+    if not admin_feed.change_stream_active:
+        await admin_feed.publish_driver_change({"id": driver_id, "is_active": True})
     
     # Log admin activity
     await log_admin_activity(
@@ -1727,7 +2693,7 @@ async def get_financial_summary(admin: dict = Depends(get_current_admin)):
     Get overall financial summary for the system
     """
     # Get all driver finances
-    all_finances = await db.driver_finances.find({}, {"_id": 0}).to_list(1000)
+    all_finances = await analytics_db.driver_finances.find({}, {"_id": 0}).to_list(1000)
     
     total_earnings = sum(f.get('total_earnings', 0) for f in all_finances)
     total_commission_owed = sum(f.get('commission_owed', 0) for f in all_finances)
@@ -1745,33 +2711,361 @@ async def get_financial_summary(admin: dict = Depends(get_current_admin)):
         "currency": "AFN"
     }
 
+# ===================== Trip Matching =====================
+
+async def load_matchable_trips() -> List[Dict]:
+    """Pending trips without a live offer, oldest first"""
+    return await db.trips.find(
+        {
+            "status": TripStatus.PENDING,
+            "$or": [
+                {"offer_expires_at": None},
+                {"offer_expires_at": {"$lt": datetime.now(timezone.utc).isoformat()}}
+            ]
+        },
+        {"_id": 0, "id": 1, "origin": 1, "destination": 1, "price": 1, "passenger_name": 1, "rejected_driver_ids": 1}
+    ).sort("created_at", 1).to_list(500)
+
+async def load_available_drivers() -> List[Dict]:
+    """Active, unlocked drivers with a fresh location who are neither on a trip nor holding an offer"""
+    now = datetime.now(timezone.utc)
+    cutoff = (now - timedelta(seconds=DRIVER_LOCATION_STALE_SECONDS)).isoformat()
+    
+    # Socket pings only update this worker's memory; REST pings also stamp the user document
+    fresh_in_memory = {
+        driver_id: loc for driver_id, loc in driver_locations.items()
+        if loc.get('timestamp', '') >= cutoff
+    }
+    
+    drivers = await db.users.find(
+        {
+            "role": UserRole.DRIVER,
+            "is_active": True,
+            "account_locked": {"$ne": True},
+            "$or": [
+                {"location_updated_at": {"$gte": cutoff}},
+                {"id": {"$in": list(fresh_in_memory)}}
+            ]
+        },
+        {"_id": 0, "id": 1, "current_location": 1}
+    ).to_list(5000)
+    
+    if not drivers:
+        return []
+    
+    driver_ids = [d['id'] for d in drivers]
+    busy_trips = await db.trips.find(
+        {"$or": [
+            {"driver_id": {"$in": driver_ids}, "status": {"$in": [TripStatus.ACCEPTED, TripStatus.IN_PROGRESS]}},
+            {"offered_driver_id": {"$in": driver_ids}, "status": TripStatus.PENDING, "offer_expires_at": {"$gt": now.isoformat()}}
+        ]},
+        {"_id": 0, "driver_id": 1, "offered_driver_id": 1}
+    ).to_list(5000)
+    busy = {t.get('driver_id') for t in busy_trips} | {t.get('offered_driver_id') for t in busy_trips}
+    
+    available = []
+    for driver in drivers:
+        location = fresh_in_memory.get(driver['id']) or driver.get('current_location')
+        if driver['id'] in busy or not location:
+            continue
+        available.append({"id": driver['id'], "lat": location['lat'], "lng": location['lng']})
+    return available
+
+async def offer_trip_to_driver(trip: Dict, driver: Dict, pickup_km: float, pickup_minutes: float) -> bool:
+    """Reserve a pending trip for one driver for OFFER_TIMEOUT_SECONDS and push the offer"""
+    now = datetime.now(timezone.utc)
+    expires_at = (now + timedelta(seconds=OFFER_TIMEOUT_SECONDS)).isoformat()
+    
+    result = await db.trips.update_one(
+        {
+            "id": trip['id'],
+            "status": TripStatus.PENDING,
+            "$or": [{"offer_expires_at": None}, {"offer_expires_at": {"$lt": now.isoformat()}}]
+        },
+        {"$set": {"offered_driver_id": driver['id'], "offer_expires_at": expires_at}}
+    )
+    if result.modified_count == 0:
+        return False
+    
+    schedule_offer_timeout(trip['id'], driver['id'], datetime.fromisoformat(expires_at))
+    
+    # Reserved for this driver: other drivers' feeds drop it until the offer is released
+    await publish_trip_feed_remove(trip)
+    
+    await sio.emit('trip_offer', {
+        "trip_id": trip['id'],
+        "passenger_name": trip.get('passenger_name'),
+        "origin": trip.get('origin'),
+        "destination": trip.get('destination'),
+        "price": trip.get('price'),
+        "pickup_distance_km": round(pickup_km, 2),
+        "pickup_eta_minutes": round(pickup_minutes, 1),
+        "expires_at": expires_at
+    }, room=user_room(driver['id']))
+    return True
+
+# ===================== Trip Expiry & Offer Timeouts =====================
+
+async def expire_pending_trip(trip_id: str):
+    """Cancel a trip that is still pending after PENDING_TRIP_TIMEOUT_SECONDS"""
+    trip = await transition_trip(
+        trip_id,
+        TripStatus.CANCELLED,
+        extra_set={"cancel_reason": "expired"},
+        allowed_from=[TripStatus.PENDING]
+    )
+    if not trip:
+        return  # accepted or cancelled meanwhile, possibly by another worker
+    
+    await sio.emit(f'trip_status_{trip["passenger_id"]}', {
+        "trip_id": trip_id,
+        "status": TripStatus.CANCELLED,
+        "reason": "expired"
+    })
+
+async def expire_trip_offer(trip_id: str, driver_id: str):
+    """An unanswered offer counts as a decline so the next window offers the trip to someone else"""
+    trip = await db.trips.find_one_and_update(
+        {
+            "id": trip_id,
+            "status": TripStatus.PENDING,
+            "offered_driver_id": driver_id,
+            "offer_expires_at": {"$lte": datetime.now(timezone.utc).isoformat()}
+        },
+        {"$addToSet": {"rejected_driver_ids": driver_id}},
+        projection=TRIP_FEED_PROJECTION
+    )
+    if trip:
+        await sio.emit('trip_offer_expired', {"trip_id": trip_id}, room=user_room(driver_id))
+        await publish_trip_feed_add(trip)  # available to every nearby driver again
+
+def schedule_trip_expiry(trip_id: str, created_at: datetime):
+    deadline = created_at.timestamp() + PENDING_TRIP_TIMEOUT_SECONDS
+    trip_scheduler.schedule(f"expire:{trip_id}", deadline, lambda: expire_pending_trip(trip_id))
+
+def schedule_offer_timeout(trip_id: str, driver_id: str, expires_at: datetime):
+    trip_scheduler.schedule(f"offer:{trip_id}", expires_at.timestamp(), lambda: expire_trip_offer(trip_id, driver_id))
+
+async def rehydrate_trip_timers():
+    """Recreate expiry and offer timers for every pending trip after a restart"""
+    pending_trips = db.trips.find(
+        {"status": TripStatus.PENDING},
+        {"_id": 0, "id": 1, "created_at": 1, "offered_driver_id": 1, "offer_expires_at": 1}
+    )
+    count = 0
+    async for trip in pending_trips:
+        # One malformed legacy trip must not stop the rest (or startup); naive timestamps are UTC
+        try:
+            schedule_trip_expiry(trip['id'], parse_time(trip['created_at']))
+            if trip.get('offered_driver_id') and trip.get('offer_expires_at'):
+                schedule_offer_timeout(trip['id'], trip['offered_driver_id'], parse_time(trip['offer_expires_at']))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            logger.warning(f"Skipping timers for pending trip {trip.get('id')}: {e!r}")
+            continue
+        count += 1
+    logger.info(f"Rehydrated timers for {count} pending trips")
+
+matching_engine = MatchingEngine(
+    routing_service,
+    load_trips=load_matchable_trips,
+    load_drivers=load_available_drivers,
+    make_offer=offer_trip_to_driver,
+    window_seconds=MATCHING_WINDOW_SECONDS,
+    max_pickup_km=MATCHING_MAX_PICKUP_KM,
+    solver=MATCHING_SOLVER
+)
+
+@api_router.get("/admin/matching/stats")
+async def get_matching_stats(admin: dict = Depends(get_current_admin)):
+    """
+    Matching latency and driver utilisation metrics
+    """
+    return {"enabled": MATCHING_ENABLED, **matching_engine.stats}
+
+@api_router.get("/admin/trips/{trip_id}/trace")
+async def get_trip_trace(trip_id: str, tolerance_m: float = 10, admin: dict = Depends(get_current_admin)):
+    """
+    Recorded GPS route of a trip (Douglas–Peucker simplified), e.g. for fare audits
+    """
+    trips = await find_trips(db, {"id": trip_id}, limit=1)
+    if not trips:
+        raise HTTPException(status_code=404, detail="سفر یافت نشد")
+    return await simplified_trace(db, trips[0], tolerance_m)
+
+@api_router.get("/admin/trips/archive/stats")
+async def get_trip_archive_stats(admin: dict = Depends(get_current_admin)):
+    """
+    Hot/archive trip counts and archive job metrics
+    """
+    hot_trips, archived_trips = await asyncio.gather(
+        db.trips.estimated_document_count(),
+        db[ARCHIVE_COLLECTION].estimated_document_count()
+    )
+    return {
+        "enabled": trip_archiver.enabled,
+        "hot_trips": hot_trips,
+        "archived_trips": archived_trips,
+        **trip_archiver.stats
+    }
+
+@api_router.post("/admin/trips/archive/run")
+async def run_trip_archive(admin: dict = Depends(get_current_admin)):
+    """
+    Archive finished trips past the retention window now instead of waiting for the next run
+    """
+    if not trip_archiver.enabled:
+        raise HTTPException(status_code=400, detail="بایگانی سفرها غیرفعال است (TRIP_ARCHIVE_AFTER_DAYS=0)")
+    
+    archived = await trip_archiver.run_once()
+    
+    await log_admin_activity(
+        admin_id=admin['id'],
+        admin_name=admin['name'],
+        action="archive_trips",
+        target_type="trip",
+        details={"archived": archived, "cutoff_days": TRIP_ARCHIVE_AFTER_DAYS}
+    )
+    
+    return {"success": True, "archived": archived}
+
 # ===================== WebSocket Events =====================
 
 @sio.event
 async def connect(sid, environ):
     """Handle WebSocket connection"""
-    logger.info(f"Client connected: {sid}")
+    socket_logger.info("Client connected: %s", sid, extra={"event": "connect", "sid": sid})
 
 @sio.event
 async def disconnect(sid):
     """Handle WebSocket disconnection"""
-    logger.info(f"Client disconnected: {sid}")
+    socket_logger.info("Client disconnected: %s", sid, extra={"event": "disconnect", "sid": sid})
+
+@sio.on('connect', namespace=ADMIN_NAMESPACE)
+async def admin_feed_connect(sid, environ, auth=None):
+    """Only authenticated admins may receive the live dashboard feed"""
+    token = (auth or {}).get('token')
+    if not token:
+        return False
+    try:
+        verify_token(token)
+    except HTTPException:
+        return False
+    socket_logger.info("Admin dashboard connected: %s", sid, extra={"event": "admin_connect", "sid": sid})
+
+@sio.on('map_subscribe', namespace=ADMIN_NAMESPACE)
+async def admin_map_subscribe(sid, data=None):
+    """
+    Start the live map: returns the snapshot, then map_delta events follow.
+    Apply a delta when its `from` is at most the local version and its epoch matches; otherwise
+    (or when it carries reload=true) replace the local state, or call map_subscribe again.
+    """
+    await sio.enter_room(sid, MAP_ROOM, namespace=ADMIN_NAMESPACE)
+    return map_state.snapshot()
+
+@sio.on('map_unsubscribe', namespace=ADMIN_NAMESPACE)
+async def admin_map_unsubscribe(sid, data=None):
+    await sio.leave_room(sid, MAP_ROOM, namespace=ADMIN_NAMESPACE)
+    return {"success": True}
 
 @sio.event
 async def join_room(sid, data):
     """Join a specific room (for targeted updates)"""
     room = data.get('room')
     await sio.enter_room(sid, room)
-    logger.info(f"Client {sid} joined room: {room}")
+    socket_logger.info("Client %s joined room: %s", sid, room, extra={"event": "join_room", "sid": sid})
+
+@sio.event
+async def subscribe_trip_feed(sid, data):
+    """
+    Driver subscribes to pending trips around a location.
+    Joins the 3x3 block of feed cells and returns the trips currently pending there;
+    afterwards trip_feed_add / trip_feed_remove events keep the list current.
+    Re-subscribe with the new location when the driver moves to another cell.
+    """
+    try:
+        lat, lng = float(data['lat']), float(data['lng'])
+    except (KeyError, TypeError, ValueError):
+        return {"success": False, "trips": []}
+    
+    row, col = cell_key(lat, lng, TRIP_FEED_CELL_DEG)
+    rooms = {f"trip_cell_{r}_{c}" for r in range(row - 1, row + 2) for c in range(col - 1, col + 2)}
+    for room in sio.rooms(sid):
+        if room.startswith("trip_cell_") and room not in rooms:
+            await sio.leave_room(sid, room)
+    for room in rooms:
+        await sio.enter_room(sid, room)
+    
+    # Initial snapshot: pending trips whose origin lies inside the subscribed block
+    query = {
+        "status": TripStatus.PENDING,
+        "origin.lat": {"$gte": (row - 1) * TRIP_FEED_CELL_DEG, "$lt": (row + 2) * TRIP_FEED_CELL_DEG},
+        "origin.lng": {"$gte": (col - 1) * TRIP_FEED_CELL_DEG, "$lt": (col + 2) * TRIP_FEED_CELL_DEG}
+    }
+    if data.get('driver_id'):
+        query.update(offer_visible_filter(data['driver_id']))
+        # Offers go to the personal room; feed subscribers get them without a separate register_user
+        await sio.enter_room(sid, user_room(data['driver_id']))
+    trips = await db.trips.find(query, TRIP_FEED_PROJECTION).sort("created_at", -1).to_list(100)
+    
+    return {"success": True, "trips": trips}
+
+@sio.event
+async def unsubscribe_trip_feed(sid, data=None):
+    """Stop receiving trip feed events"""
+    for room in sio.rooms(sid):
+        if room.startswith("trip_cell_"):
+            await sio.leave_room(sid, room)
+    return {"success": True}
+
+@sio.event
+async def subscribe_locations(sid, data=None):
+    """
+    Choose the driver location wire format for this client.
+    "binary": batched "locations" frames (see location_frames.py) plus "location_index" updates;
+    the reply carries the current index table. "json": per-ping driver_location_<id> events only.
+    """
+    wire_format = (data or {}).get('format', 'binary')
+    if wire_format == 'binary':
+        await sio.enter_room(sid, BINARY_ROOM)
+        return {"success": True, "format": "binary", "interval_ms": LOCATION_FRAME_INTERVAL_MS, **location_batcher.index.table()}
+    await sio.leave_room(sid, BINARY_ROOM)
+    return {"success": LEGACY_LOCATION_EVENTS, "format": "json"}
+
+@sio.event
+async def register_user(sid, data):
+    """Join the personal and role rooms used for targeted notifications and offers"""
+    user_id = data.get('user_id')
+    role = data.get('role')
+    if user_id:
+        await sio.enter_room(sid, user_room(user_id))
+    if role:
+        await sio.enter_room(sid, role_room(role))
+    return {"success": bool(user_id or role)}
 
 @sio.event
 async def location_update(sid, data):
     """Handle real-time location updates from drivers"""
+    # Same rules as LocationUpdate on the REST route; a bad ping is dropped before it reaches
+    # the frame batcher, the live map or the GPS traces
+    if not isinstance(data, dict):
+        return
     driver_id = data.get('driver_id')
-    lat = data.get('lat')
-    lng = data.get('lng')
+    try:
+        lat, lng = float(data['lat']), float(data['lng'])
+    except (KeyError, TypeError, ValueError):
+        return
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):  # also false for NaN
+        return
+    
+    # Over-eager clients: drop the ping (the next one carries a fresher position anyway)
+    if driver_id and RATE_LIMIT_LOCATION and await rate_limiter.retry_after("location", RATE_LIMIT_LOCATION, user=driver_id):
+        return
     
-    if driver_id and lat and lng:
+    if driver_id:
+        # An online driver receives matcher offers in the personal room, even without register_user
+        if user_room(driver_id) not in sio.rooms(sid):
+            await sio.enter_room(sid, user_room(driver_id))
+        
         driver_locations[driver_id] = {
             "lat": lat,
             "lng": lng,
@@ -1779,10 +3073,15 @@ async def location_update(sid, data):
         }
         
         # Broadcast to subscribers
-        await sio.emit(f'driver_location_{driver_id}', {
-            "lat": lat,
-            "lng": lng
-        })
+        location_batcher.add(driver_id, lat, lng)
+        map_state.update_location(driver_id, lat, lng)
+        if GPS_TRACES_ENABLED:
+            trace_writer.add(driver_id, lat, lng)
+        if LEGACY_LOCATION_EVENTS:
+            await sio.emit(f'driver_location_{driver_id}', {
+                "lat": lat,
+                "lng": lng
+            })
 
 # ===================== Root & Health Check =====================
 
@@ -1802,12 +3101,74 @@ async def health_check():
         await db.command('ping')
         return {"status": "healthy", "database": "connected"}
     except Exception as e:
-        return {"status": "unhealthy", "error": str(e)}
+        return JSONResponse(status_code=503, content={"status": "unhealthy", "error": str(e)})
+
+@api_router.get("/health/live")
+async def liveness_check():
+    """Liveness: the process and its event loop respond (no dependency checks)"""
+    return {"status": "alive", "event_loop_lag_ms": round(loop_lag_monitor.lag_ms, 2)}
+
+@api_router.get("/health/ready")
+async def readiness_check():
+    """
+    Readiness: 503 when this worker should stop receiving traffic.
+    Checks event-loop lag, Mongo ping latency, pool saturation and background queue depth.
+    """
+    loop_lag = loop_lag_monitor.max_lag_ms()
+    ping_ms = await mongo_ping_ms(db, READY_MAX_MONGO_PING_MS / 1000)
+    max_pool_size = client.options.pool_options.max_pool_size
+    pool_in_use = pool_monitor.busiest()
+    # Every worker holds a timer per pending trip, so only overdue timers say this worker is behind
+    queues = {
+        "trip_timers_overdue": trip_scheduler.overdue(),
+        "log_records": log_listener.queue.qsize() if log_listener is not None else 0,
+        "gps_traces": len(trace_writer),
+    }
+    
+    ready, report = evaluate({
+        "event_loop": {"ok": loop_lag <= READY_MAX_LOOP_LAG_MS, "lag_ms": round(loop_lag, 2), "max_ms": READY_MAX_LOOP_LAG_MS},
+        "mongo": {"ok": ping_ms is not None, "ping_ms": ping_ms, "timeout_ms": READY_MAX_MONGO_PING_MS},
+        "mongo_pool": {
+            "ok": not max_pool_size or pool_in_use < max_pool_size * READY_MAX_POOL_USAGE,
+            "in_use": pool_in_use,
+            "max_size": max_pool_size,
+            "checkout_failures": pool_monitor.checkout_failures
+        },
+        "queues": {"ok": max(queues.values()) <= READY_MAX_QUEUE_DEPTH, **queues, "max_depth": READY_MAX_QUEUE_DEPTH},
+    })
+    report["socketio_connections"] = len(sio.eio.sockets)
+    report["trip_timers"] = len(trip_scheduler)
+    return JSONResponse(status_code=200 if ready else 503, content=report)
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(authorization: Optional[str] = Header(None)):
+    """Prometheus scrape endpoint (metrics of this worker only)"""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if METRICS_TOKEN and not hmac.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="توکن متریک نامعتبر است")
+    return PlainTextResponse(metrics.render(), media_type=PROMETHEUS_CONTENT_TYPE)
 
 # ===================== Include Router & Middleware =====================
 
 app.include_router(api_router)
 
+if QUERY_PROFILER != "off":
+    @app.middleware("http")
+    async def profile_request_queries(request: Request, call_next):
+        return await profile_request(request, call_next, QUERY_PROFILER, QUERY_BUDGET, QUERY_REPEAT_LIMIT)
+
+@app.middleware("http")
+async def admit_request(request: Request, call_next):
+    return await admission_controller.dispatch(request, call_next)
+
+if METRICS_ENABLED:
+    @app.middleware("http")
+    async def record_request_metrics(request: Request, call_next):
+        return await time_request(metrics, request, call_next)
+
+# Outermost, so responses produced by the middleware above (503 from admission control,
+# 429s, profiler errors) also carry CORS headers and browsers can read them
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -1816,10 +3177,160 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# The event loop keeps only weak references to tasks; fire-and-forget startup work is held here
+background_tasks: set = set()
+
+def run_in_background(coro, name: str) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    
+    def finished(done: asyncio.Task):
+        background_tasks.discard(done)
+        if not done.cancelled() and done.exception():
+            logger.error(f"Background task {name} failed: {done.exception()!r}")
+    
+    task.add_done_callback(finished)
+    return task
+
+@app.on_event("startup")
+async def create_indexes():
+    """Create the indexes the API relies on"""
+    # At most one active trip per passenger (partial $in filters need MongoDB 6.0+). Without it the
+    # active-trip check in request-ride still applies, but two concurrent requests can both pass it
+    try:
+        await create_active_trip_index(db)
+    except OperationFailure as e:
+        logger.error(
+            f"Could not create the one-active-trip-per-passenger index: {e}. "
+            "Run `python migrate.py active-trips` to review duplicate active trips, then again with --apply"
+        )
+    
+    # One user per phone and role; login, create-user and bulk import rely on it against concurrent inserts.
+    # Existing duplicates are merged by migrate.py, never here
+    indexes = await db.users.index_information()
+    if "phone_1_role_1" not in indexes:
+        try:
+            await create_user_phone_index(db)
+        except OperationFailure as e:
+            logger.warning(f"Unique phone/role index on users is missing: {e}. Run `python migrate.py users` to review duplicates")
+    elif not indexes["phone_1_role_1"].get("unique"):
+        logger.warning("The phone/role index on users is not unique. Run `python migrate.py users` to review duplicates")
+    
+    index_specs = [
+        # Expire idempotency records once their replay window has passed
+        (db.idempotency_keys, [("created_at", 1)], {"expireAfterSeconds": IDEMPOTENCY_TTL_SECONDS}),
+        # Pending-trip scans by the matcher and drivers, status counts
+        (db.trips, [("status", 1), ("created_at", 1)], {}),
+        # Date-range trip listings and exports without a status filter
+        (db.trips, [("created_at", 1)], {}),
+        # Trip history per driver / passenger, in both the hot and archive tiers
+        (db.trips, [("driver_id", 1), ("created_at", -1)], {}),
+        (db.trips, [("passenger_id", 1), ("created_at", -1)], {}),
+        (db[ARCHIVE_COLLECTION], [("driver_id", 1), ("created_at", -1)], {}),
+        (db[ARCHIVE_COLLECTION], [("passenger_id", 1), ("created_at", -1)], {}),
+        (db[ARCHIVE_COLLECTION], [("status", 1), ("created_at", 1)], {}),
+        (db[ARCHIVE_COLLECTION], [("created_at", 1)], {}),
+        # Drivers with a recent location
+        (db.users, [("role", 1), ("location_updated_at", 1)], {}),
+        # Admin user search: word prefixes and phone digit prefixes
+        (db.users, [("search_prefixes", 1), ("role", 1)], {}),
+        (db.users, [("phone_digits", 1)], {}),
+        # Notification inbox: targeted, and broadcast by role, newest first
+        (db.notifications, [("user_id", 1), ("created_at", -1)], {}),
+        (db.notifications, [("user_id", 1), ("role", 1), ("created_at", -1)], {}),
+        (db.notification_reads, [("user_id", 1)], {"unique": True}),
+        # Trip feed snapshots (pending trips by origin bounding box)
+        (db.trips, [("status", 1), ("origin.lat", 1), ("origin.lng", 1)], {}),
+    ]
+    
+    for collection, keys, options in index_specs:
+        try:
+            await collection.create_index(keys, **options)
+        except OperationFailure as e:
+            logger.warning(f"Could not create index {keys} on {collection.name}: {e}")
+
+@app.on_event("startup")
+async def start_loop_lag_monitor():
+    """Sample event-loop lag for the readiness check"""
+    loop_lag_monitor.start()
+
+@app.on_event("startup")
+async def start_location_batcher():
+    """Flush binary location frames every LOCATION_FRAME_INTERVAL_MS"""
+    location_batcher.start()
+
+@app.on_event("startup")
+async def start_map_state():
+    """Start the live map sync and delta push"""
+    map_state.start()
+
+@app.on_event("startup")
+async def start_trace_writer():
+    """Create the GPS trace collection and start the batched writer"""
+    if GPS_TRACES_ENABLED:
+        await ensure_trace_collection(db, GPS_TRACE_RETENTION_DAYS)
+        trace_writer.start()
+
+@app.on_event("startup")
+async def start_trip_scheduler():
+    """Start the expiry scheduler and restore timers for trips that were pending before a restart"""
+    trip_scheduler.start()
+    await rehydrate_trip_timers()
+
+@app.on_event("startup")
+async def start_admin_feed():
+    """Start the shared change-stream consumer for the admin dashboard"""
+    admin_feed.start()
+
+@app.on_event("startup")
+async def start_trip_archiver():
+    """Start the periodic hot-to-archive trip move"""
+    trip_archiver.start()
+
+@app.on_event("startup")
+async def start_matching_engine():
+    """Start the batched matcher when enabled"""
+    if MATCHING_ENABLED:
+        matching_engine.start()
+        logger.info(f"Matching engine started ({matching_engine.stats['solver']}, {MATCHING_WINDOW_SECONDS}s window)")
+
+async def backfill_user_search_fields(batch_size: int = 1000):
+    """Add search fields to users created before the search index existed"""
+    updated = 0
+    while True:
+        users = await db.users.find(
+            {"search_prefixes": {"$exists": False}},
+            {"_id": 0, "id": 1, "name": 1, "phone": 1}
+        ).limit(batch_size).to_list(batch_size)
+        if not users:
+            break
+        # A null name or phone still gets (empty) fields, or the same users would be selected forever
+        await db.users.bulk_write([
+            UpdateOne({"id": u['id']}, {"$set": user_search_fields(u.get('name') or '', u.get('phone') or '')})
+            for u in users
+        ], ordered=False)
+        updated += len(users)
+    if updated:
+        logger.info(f"Backfilled search fields for {updated} users")
+
+@app.on_event("startup")
+async def start_search_backfill():
+    """Backfill user search fields in the background"""
+    run_in_background(backfill_user_search_fields(), "search field backfill")
+
+@app.on_event("startup")
+async def start_road_network_loading():
+    """Load the offline road network in the background; haversine is used until it is ready"""
+    run_in_background(load_road_graph(routing_service, os.environ.get("ROAD_NETWORK_PATH")), "road network loading")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await trace_writer.stop()  # write buffered pings before the connection closes
     client.close()
+    analytics_client.close()
     logger.info("Database connection closed")
+    if log_listener is not None:
+        log_listener.stop()
 
 # Export socket app for supervisor
 # In production, use: uvicorn server:socket_app
@@ -0,0 +1,77 @@
+"""
+User Search Normalisation
+نرمال‌سازی متن برای جستجوی کاربران
+
+Names are folded (Arabic/Persian letter variants, diacritics, ZWNJ, case) and
+indexed as word prefixes; phones are indexed as plain digits. Queries become
+exact lookups on those indexed fields instead of unanchored regex scans.
+"""
+
+import re
+import unicodedata
+from typing import Dict, List, Optional
+
+# Longest indexed prefix per word; longer query words are truncated to match
+MAX_PREFIX_LENGTH = 12
+
+_CHAR_FOLDING = str.maketrans({
+    "\u064a": "\u06cc", "\u0649": "\u06cc", "\u0626": "\u06cc",  # Arabic yeh variants -> Persian yeh
+    "\u0643": "\u06a9",  # Arabic kaf -> Persian keheh
+    "\u0629": "\u0647", "\u06c0": "\u0647",  # teh marbuta, heh with yeh -> heh
+    "\u0623": "\u0627", "\u0625": "\u0627", "\u0622": "\u0627", "\u0671": "\u0627",  # alef variants
+    "\u0624": "\u0648",  # waw with hamza
+    "\u200c": " ",  # zero-width non-joiner separates words
+    "\u200d": "",
+    **{chr(0x06F0 + i): str(i) for i in range(10)},  # Persian digits
+    **{chr(0x0660 + i): str(i) for i in range(10)},  # Arabic-Indic digits
+})
+
+# Harakat, superscript alef and tatweel
+_DIACRITICS = re.compile("[\u064b-\u065f\u0670\u0640]")
+_NON_WORD = re.compile(r"[^\w\s]")
+_NON_DIGIT = re.compile(r"\D")
+
+
+def normalize_text(text: str) -> str:
+    """Fold a name or query to its searchable form"""
+    text = unicodedata.normalize("NFKC", text or "").translate(_CHAR_FOLDING)
+    text = _DIACRITICS.sub("", text)
+    text = _NON_WORD.sub(" ", text.casefold())
+    return " ".join(text.split())
+
+
+def phone_digits(phone: str) -> str:
+    """Digits of a phone number (Persian/Arabic digits converted)"""
+    return _NON_DIGIT.sub("", (phone or "").translate(_CHAR_FOLDING))
+
+
+def name_prefixes(name: str) -> List[str]:
+    """Every prefix (up to MAX_PREFIX_LENGTH) of every word in the normalised name"""
+    prefixes = set()
+    for word in normalize_text(name).split():
+        for length in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1):
+            prefixes.add(word[:length])
+    return sorted(prefixes)
+
+
+def user_search_fields(name: Optional[str] = None, phone: Optional[str] = None) -> Dict[str, object]:
+    """Indexed search fields to store alongside a user's name and/or phone"""
+    fields: Dict[str, object] = {}
+    if name is not None:
+        fields["search_prefixes"] = name_prefixes(name)
+    if phone is not None:
+        fields["phone_digits"] = phone_digits(phone)
+    return fields
+
+
+def build_search_query(q: str) -> Optional[Dict[str, object]]:
+    """Index-backed Mongo filter for a type-ahead query, or None if nothing is searchable"""
+    compact = re.sub(r"[\s+\-()]", "", (q or "").translate(_CHAR_FOLDING))
+    if compact.isascii() and compact.isdigit():
+        # Anchored prefix on an indexed field: an index range scan, not a collection scan
+        return {"phone_digits": {"$regex": "^" + re.escape(compact)}}
+
+    words = [word[:MAX_PREFIX_LENGTH] for word in normalize_text(q).split()]
+    if not words:
+        return None
+    return {"search_prefixes": {"$all": words}}
@@ -0,0 +1,59 @@
+"""
+Live admin dashboard feed (backend/admin_feed.py)
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+from admin_feed import AdminFeed, previous_trip_status  # noqa: E402
+
+
+class FakeSio:
+    def __init__(self):
+        self.emitted = []
+
+    async def emit(self, event, data, namespace=None):
+        self.emitted.append((event, data))
+
+
+def revenue(sio):
+    return sum(data.get("revenue", 0) for event, data in sio.emitted if event == "stats_delta")
+
+
+def completed_trip(price):
+    return {"id": "trip-1", "status": "completed", "price": price, "driver_id": "d", "started_at": "t"}
+
+
+def test_previous_status_of_cancelled_trip():
+    assert previous_trip_status({"status": "cancelled"}) == "pending"
+    assert previous_trip_status({"status": "cancelled", "accepted_at": "t"}) == "accepted"
+    assert previous_trip_status({"status": "cancelled", "accepted_at": "t", "started_at": "t"}) == "in_progress"
+
+
+def test_revenue_counts_final_fare_once():
+    sio = FakeSio()
+    feed = AdminFeed(db=None, sio=sio)
+    asyncio.run(feed.publish_trip_change(completed_trip(price=99.0)))
+    assert revenue(sio) == 0
+    asyncio.run(feed.publish_trip_fare(completed_trip(price=70.0)))
+    assert revenue(sio) == 70.0
+
+
+def test_change_stream_counts_fare_update_not_completion():
+    sio = FakeSio()
+    feed = AdminFeed(db=None, sio=sio)
+    # With updateLookup both events may already see the final price
+    trip = {**completed_trip(price=70.0), "fare_source": "trace"}
+    asyncio.run(feed._handle_trip({
+        "operationType": "update", "fullDocument": trip,
+        "updateDescription": {"updatedFields": {"status": "completed"}},
+    }))
+    asyncio.run(feed._handle_trip({
+        "operationType": "update", "fullDocument": trip,
+        "updateDescription": {"updatedFields": {"fare_source": "trace"}},
+    }))
+    assert revenue(sio) == 70.0
+    assert [event for event, _ in sio.emitted] == ["trip_status", "stats_delta", "trip_fare", "stats_delta"]
@@ -0,0 +1,88 @@
+"""
+Streaming CSV/NDJSON parsing for bulk user import (backend/bulk_import.py)
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+from bulk_import import MAX_REPORTED_ERRORS, BulkReport, detect_format, iter_lines, iter_row_chunks  # noqa: E402
+
+
+async def byte_stream(data: bytes, chunk_size: int):
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+
+
+def parse(data: bytes, fmt: str, chunk_size: int = 3, stream_chunk: int = 7):
+    async def collect():
+        return [chunk async for chunk in iter_row_chunks(byte_stream(data, stream_chunk), fmt, chunk_size)]
+    return asyncio.run(collect())
+
+
+def test_detect_format():
+    assert detect_format("text/csv") == "csv"
+    assert detect_format("application/x-ndjson") == "ndjson"
+    assert detect_format(None) == "ndjson"
+    assert detect_format("text/csv", explicit="NDJSON") == "ndjson"
+
+
+def test_lines_split_across_chunks_and_multibyte_characters():
+    data = "﻿نام,phone\r\nعلی,0700\nlast".encode("utf-8")
+
+    async def collect():
+        return [line async for line in iter_lines(byte_stream(data, 3))]
+
+    assert asyncio.run(collect()) == ["نام,phone\r\n", "علی,0700\n", "last"]
+
+
+def test_csv_rows_with_quoted_newlines_and_errors():
+    data = (
+        'name,phone,role\n'
+        '"Ali\nAhmadi",0700000001,passenger\n'
+        '\n'
+        'Sara,0700000002,,extra\n'
+        'Omid, 0700000003 ,\n'
+    ).encode()
+    chunks = parse(data, "csv", chunk_size=2)
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    rows = [row for chunk in chunks for row in chunk]
+    assert rows[0] == (2, {"name": "Ali\nAhmadi", "phone": "0700000001", "role": "passenger"}, None)
+    assert rows[1][0] == 5 and rows[1][1] is None and "3" in rows[1][2]
+    assert rows[2] == (6, {"name": "Omid", "phone": "0700000003"}, None)
+
+
+def test_csv_unclosed_quote_is_reported():
+    rows = parse(b'name,phone\n"Ali,0700\n', "csv")[0]
+    assert rows == [(2, None, "فیلد نقل‌قول‌دار بسته نشده است")]
+
+
+def test_ndjson_rows_and_errors():
+    data = b'{"name": "Ali"}\n\nnot json\n[1, 2]\n{"name": "Sara"}'
+    rows = [row for chunk in parse(data, "ndjson", chunk_size=10) for row in chunk]
+    assert rows[0] == (1, {"name": "Ali"}, None)
+    assert rows[1][0] == 3 and rows[1][1] is None
+    assert rows[2] == (4, None, "هر خط باید یک شیء JSON باشد")
+    assert rows[3] == (5, {"name": "Sara"}, None)
+
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(ValueError, match="xml"):
+        parse(b"", "xml")
+
+
+def test_report_truncates_echoed_errors():
+    report = BulkReport()
+    report.total_rows = MAX_REPORTED_ERRORS + 5
+    for line in range(MAX_REPORTED_ERRORS + 5, 0, -1):
+        report.add_error(line, "bad")
+    result = report.as_dict("created")
+    assert result["failed"] == MAX_REPORTED_ERRORS + 5
+    assert len(result["errors"]) == MAX_REPORTED_ERRORS
+    assert result["errors_truncated"] is True
+    assert result["errors"][0]["line"] < result["errors"][-1]["line"]
+    assert result["created"] == 0
@@ -0,0 +1,75 @@
+"""
+Driver earnings summary across the hot and archive trip tiers
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_driver_earnings")
+
+import server  # noqa: E402
+from archive import ARCHIVE_COLLECTION  # noqa: E402
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, *args):
+        return self
+
+    def limit(self, n):
+        return self
+
+    async def to_list(self, length=None):
+        return list(self.docs)
+
+
+class FakeCollection:
+    def __init__(self, *docs):
+        self.docs = list(docs)
+
+    def find(self, query, projection=None):
+        return FakeCursor([
+            doc for doc in self.docs
+            if doc["driver_id"] == query["driver_id"] and doc["completed_at"] >= query["completed_at"]["$gte"]
+        ])
+
+    async def find_one(self, query, projection=None):
+        return self.docs[0] if self.docs else None
+
+
+class FakeDB:
+    def __init__(self, **collections):
+        self.collections = collections
+
+    def __getattr__(self, name):
+        return self.collections[name]
+
+    def __getitem__(self, name):
+        return self.collections[name]
+
+
+def test_earnings_include_archived_trips(monkeypatch):
+    recent = datetime.now(timezone.utc) - timedelta(days=2)
+    old = datetime.now(timezone.utc) - timedelta(days=20)
+    monkeypatch.setattr(server, "db", FakeDB(**{
+        "trips": FakeCollection({"id": "hot", "driver_id": "d1", "price": 100.0, "completed_at": recent.isoformat()}),
+        ARCHIVE_COLLECTION: FakeCollection(
+            {"id": "cold", "driver_id": "d1", "price": 50.0, "completed_at": old.isoformat()},
+        ),
+        "driver_finances": FakeCollection({"driver_id": "d1", "total_earnings": 150.0}),
+    }))
+
+    month = asyncio.run(server.get_driver_earnings_summary("d1", period="month"))
+    assert month["trip_count"] == 2
+    assert month["total_earned"] == 150.0
+    assert month["net_earnings"] == 120.0
+
+    week = asyncio.run(server.get_driver_earnings_summary("d1", period="week"))
+    assert week["trip_count"] == 1
@@ -0,0 +1,36 @@
+"""
+Readiness monitors (backend/health.py)
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+from health import LoopLagMonitor, evaluate  # noqa: E402
+
+
+def test_loop_lag_max_survives_reads():
+    monitor = LoopLagMonitor(window_seconds=10)
+    monitor.record(400.0, now=100.0)
+    monitor.record(5.0, now=100.5)
+    assert monitor.lag_ms == 5.0
+    assert monitor.max_lag_ms(now=101.0) == 400.0
+    assert monitor.max_lag_ms(now=101.0) == 400.0  # a second probe sees the same spike
+
+
+def test_loop_lag_max_expires_after_window():
+    monitor = LoopLagMonitor(window_seconds=10)
+    monitor.record(400.0, now=100.0)
+    monitor.record(5.0, now=105.0)
+    assert monitor.max_lag_ms(now=111.0) == 5.0
+    monitor.record(7.0, now=116.0)
+    assert len(monitor._samples) == 1
+    assert LoopLagMonitor().max_lag_ms() == 0.0
+
+
+def test_evaluate_lists_failing_checks():
+    ready, body = evaluate({"event_loop": {"ok": True}, "mongo": {"ok": False}})
+    assert not ready
+    assert body["status"] == "not_ready"
+    assert body["failing"] == ["mongo"]
@@ -0,0 +1,119 @@
+"""
+Compact binary location frames (backend/location_frames.py)
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+from location_frames import (  # noqa: E402
+    HEADER, INDEX_EVENT, LOCATION_EVENT, RECORD, DriverIndex, LocationBatcher, decode_frame, encode_frame,
+)
+
+
+class FakeSio:
+    def __init__(self):
+        self.emitted = []
+
+    async def emit(self, event, data, room=None):
+        self.emitted.append((event, data))
+
+
+# ----------- Frames -----------
+
+def test_frame_round_trip():
+    records = [(0, 34.512345, 69.123456, 1700000000.9), (7, -33.9, -70.65, 1700000001)]
+    frame = encode_frame(123456, records)
+    assert len(frame) == HEADER.size + 2 * RECORD.size
+    epoch, decoded = decode_frame(frame)
+    assert epoch == 123456
+    assert decoded == [(0, 34.512345, 69.123456, 1700000000), (7, -33.9, -70.65, 1700000001)]
+
+
+def test_unknown_frame_version_is_rejected():
+    frame = bytearray(encode_frame(1, []))
+    frame[0] = 99
+    with pytest.raises(ValueError):
+        decode_frame(bytes(frame))
+
+
+# ----------- LocationBatcher.flush -----------
+
+def test_flush_announces_new_drivers_and_keeps_latest_ping():
+    sio = FakeSio()
+    batcher = LocationBatcher(sio)
+    batcher.add("a", 1.0, 1.0, timestamp=10)
+    batcher.add("a", 1.5, 1.5, timestamp=11)
+    batcher.add("b", 2.0, 2.0, timestamp=12)
+    assert asyncio.run(batcher.flush()) == 2
+    assert sio.emitted[0] == (INDEX_EVENT, {"epoch": batcher.index.epoch, "drivers": {0: "a", 1: "b"}})
+    event, frame = sio.emitted[1]
+    assert event == LOCATION_EVENT
+    assert decode_frame(frame) == (batcher.index.epoch, [(0, 1.5, 1.5, 11), (1, 2.0, 2.0, 12)])
+
+    batcher.add("a", 1.6, 1.6, timestamp=13)
+    asyncio.run(batcher.flush())
+    assert [event for event, _ in sio.emitted[2:]] == [LOCATION_EVENT]  # "a" is already announced
+    assert asyncio.run(batcher.flush()) == 0
+
+
+# ----------- DriverIndex -----------
+
+def test_index_is_stable_per_driver():
+    index = DriverIndex()
+    assert index.get("a", now=0) == (0, True)
+    assert index.get("b", now=0) == (1, True)
+    assert index.get("a", now=1) == (0, False)
+    assert index.table() == {"epoch": index.epoch, "drivers": {0: "a", 1: "b"}}
+
+
+def test_idle_drivers_expire_without_reusing_indexes():
+    index = DriverIndex(idle_seconds=10)
+    index.get("a", now=0)
+    index.get("b", now=8)
+    assert index.expire(now=15) is False
+    assert index.table()["drivers"] == {1: "b"}
+    assert index.get("a", now=16) == (2, True)
+
+
+def test_mostly_expired_epoch_is_rotated():
+    index = DriverIndex(idle_seconds=10)
+    for i in range(100):
+        index.get(f"d{i}", now=0)
+    index.get("d42", now=20)
+    epoch = index.epoch
+    assert index.expire(now=25) is True
+    assert index.epoch != epoch
+    assert index.table()["drivers"] == {0: "d42"}
+    assert index.get("new", now=26) == (1, True)
+
+
+def test_table_since_lists_recently_seen_drivers():
+    index = DriverIndex()
+    index.get("a", now=0)
+    index.get("b", now=5)
+    assert index.table(since=3)["drivers"] == {1: "b"}
+
+
+# ----------- LocationBatcher.resend_index -----------
+
+def test_resend_only_covers_drivers_that_moved():
+    sio = FakeSio()
+    batcher = LocationBatcher(sio, index_resend_seconds=30)
+    batcher.add("a", 1.0, 1.0)
+    batcher.add("b", 2.0, 2.0)
+    asyncio.run(batcher.flush())
+    assert asyncio.run(batcher.resend_index()) is True
+    assert sio.emitted[-1] == (INDEX_EVENT, {"epoch": batcher.index.epoch, "drivers": {0: "a", 1: "b"}})
+
+    assert asyncio.run(batcher.resend_index()) is False  # nobody moved since
+
+    batcher.add("a", 1.5, 1.5)
+    asyncio.run(batcher.flush())
+    asyncio.run(batcher.resend_index())
+    assert sio.emitted[-1] == (INDEX_EVENT, {"epoch": batcher.index.epoch, "drivers": {0: "a"}})
+    assert batcher.stats["index_resends"] == 2
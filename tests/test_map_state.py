@@ -0,0 +1,102 @@
+"""
+Versioned snapshot/delta state for the admin live map (backend/map_state.py)
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import map_state  # noqa: E402
+from map_state import STATUS_AVAILABLE, STATUS_ON_TRIP, MapState  # noqa: E402
+
+
+class FakeSio:
+    def __init__(self):
+        self.emitted = []
+
+    async def emit(self, event, data, **kwargs):
+        self.emitted.append((event, data))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(map_state, "time", SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def new_state(**kwargs):
+    return MapState(db=None, sio=FakeSio(), namespace="/admin", **kwargs)
+
+
+def test_small_moves_do_not_create_versions(clock):
+    state = new_state(min_move_deg=0.001)
+    state.update_location("d1", 34.5, 69.1)
+    assert state.version == 1
+    state.update_location("d1", 34.5004, 69.1)
+    assert state.version == 1
+    state.update_location("d1", 34.502, 69.1)
+    assert state.version == 2
+    assert state.snapshot()["drivers"] == [["d1", 34.502, 69.1, STATUS_AVAILABLE, 2]]
+
+
+def test_delta_lists_changes_and_removals_since_version(clock):
+    state = new_state()
+    state.update_location("d1", 34.5, 69.1)
+    state.update_location("d2", 34.6, 69.2)
+    since = state.version
+    state.set_status("d1", STATUS_ON_TRIP)
+    state.set_status("d1", STATUS_ON_TRIP)  # unchanged: no new version
+    state.remove("d2")
+    delta = state.delta(since)
+    assert delta["from"] == since and delta["to"] == state.version == since + 2
+    assert delta["upserts"] == [["d1", 34.5, 69.1, STATUS_ON_TRIP, since + 1]]
+    assert delta["removes"] == ["d2"]
+    assert state.delta(state.version + 1) is None
+
+
+def test_stale_drivers_expire(clock):
+    state = new_state(stale_seconds=60)
+    state.update_location("d1", 34.5, 69.1)
+    clock.now += 30
+    state.update_location("d2", 34.6, 69.2)
+    clock.now += 40
+    assert state.expire_stale() == 1
+    assert [row[0] for row in state.snapshot()["drivers"]] == ["d2"]
+    assert state.stats["expired"] == 1
+
+
+def test_dropped_tombstones_force_reload(clock):
+    state = new_state(max_tombstones=4)
+    for i in range(6):
+        state.update_location(f"d{i}", 34.5, 69.1)
+    for i in range(6):
+        state.remove(f"d{i}")
+    assert len(state._removed) <= 4
+    assert state.delta(0) is None
+    assert state.delta(state.version)["removes"] == []
+
+
+def test_push_sends_delta_then_nothing(clock):
+    state = new_state()
+    state.update_location("d1", 34.5, 69.1)
+    asyncio.run(state.push())
+    asyncio.run(state.push())
+    assert len(state.sio.emitted) == 1
+    event, delta = state.sio.emitted[0]
+    assert event == "map_delta"
+    assert delta["upserts"] == [["d1", 34.5, 69.1, STATUS_AVAILABLE, 1]]
+    assert state.stats["deltas"] == 1
@@ -0,0 +1,102 @@
+"""
+Batched driver–trip matching (backend/matching.py)
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import matching  # noqa: E402
+from matching import INFEASIBLE, MatchingEngine, greedy_assignment, optimal_assignment  # noqa: E402
+
+
+class FakeRouting:
+    def __init__(self, distances, durations):
+        self.distances = np.array(distances, dtype=float)
+        self.durations = np.array(durations, dtype=float)
+
+    async def matrix(self, origins, destinations):
+        assert self.distances.shape == (len(origins), len(destinations))
+        return self.distances, self.durations
+
+
+def loader(items):
+    async def load():
+        return items
+    return load
+
+
+def test_greedy_takes_cheapest_pairs_once():
+    cost = np.array([
+        [1.0, 2.0, 9.0],
+        [1.5, 8.0, 9.0],
+    ])
+    assert greedy_assignment(cost) == [(0, 0), (1, 1)]
+
+
+def test_greedy_skips_infeasible_pairs():
+    cost = np.array([
+        [INFEASIBLE, 3.0],
+        [INFEASIBLE, 1.0],
+    ])
+    assert greedy_assignment(cost) == [(1, 1)]
+    assert greedy_assignment(np.full((2, 2), INFEASIBLE)) == []
+    assert greedy_assignment(np.empty((0, 3))) == []
+
+
+@pytest.mark.skipif(matching.linear_sum_assignment is None, reason="SciPy is optional")
+def test_optimal_beats_greedy_total_cost():
+    cost = np.array([
+        [1.0, 2.0],
+        [2.0, 100.0],
+    ])
+    assert sorted(optimal_assignment(cost)) == [(0, 1), (1, 0)]
+    assert optimal_assignment(np.array([[INFEASIBLE]])) == []
+
+
+def test_cost_matrix_excludes_far_and_rejected_drivers():
+    engine = MatchingEngine(None, loader([]), loader([]), None, max_pickup_km=5, solver="greedy")
+    drivers = [{"id": "near"}, {"id": "far"}]
+    trips = [{"id": "t1", "rejected_driver_ids": ["near"]}, {"id": "t2"}]
+    cost = engine.build_cost_matrix(
+        drivers, trips,
+        distances=np.array([[1.0, 2.0], [9.0, 3.0]]),
+        durations=np.array([[4.0, 6.0], [20.0, 8.0]]),
+    )
+    assert np.isinf(cost[0, 0])  # rejected
+    assert np.isinf(cost[1, 0])  # beyond max_pickup_km
+    assert cost[0, 1] == 6.0 and cost[1, 1] == 8.0
+
+
+def test_run_once_offers_each_trip_to_one_driver():
+    trips = [
+        {"id": "t1", "origin": {"lat": 0, "lng": 0}},
+        {"id": "t2", "origin": {"lat": 1, "lng": 1}},
+    ]
+    drivers = [{"id": "d1", "lat": 0, "lng": 0}, {"id": "d2", "lat": 1, "lng": 1}]
+    offers = []
+
+    async def make_offer(trip, driver, pickup_km, pickup_minutes):
+        offers.append((trip["id"], driver["id"], pickup_km, pickup_minutes))
+        return trip["id"] != "t2"  # t2 was taken meanwhile
+
+    routing = FakeRouting(distances=[[0.5, 3.0], [3.0, 0.7]], durations=[[2.0, 9.0], [9.0, 3.0]])
+    engine = MatchingEngine(routing, loader(trips), loader(drivers), make_offer, solver="greedy")
+    assert asyncio.run(engine.run_once()) == 1
+    assert sorted(offers) == [("t1", "d1", 0.5, 2.0), ("t2", "d2", 0.7, 3.0)]
+    assert engine.stats["rounds"] == 1
+    assert engine.stats["last_utilisation"] == 0.5
+
+
+def test_run_once_without_trips_skips_drivers():
+    async def no_drivers():
+        raise AssertionError("drivers are only loaded when trips are pending")
+
+    engine = MatchingEngine(None, loader([]), no_drivers, None, solver="greedy")
+    assert asyncio.run(engine.run_once()) == 0
+    assert engine.stats["last_pending_trips"] == 0
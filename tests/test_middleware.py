@@ -0,0 +1,20 @@
+"""
+HTTP middleware order (server.app)
+"""
+
+import os
+import sys
+from pathlib import Path
+
+from fastapi.middleware.cors import CORSMiddleware
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_middleware")
+
+import server  # noqa: E402
+
+
+def test_cors_is_outermost():
+    # user_middleware lists the outermost first; 503s from admission control must get CORS headers
+    assert server.app.user_middleware[0].cls is CORSMiddleware
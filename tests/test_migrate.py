@@ -0,0 +1,153 @@
+"""
+One-off data migrations (backend/migrate.py)
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import migrate  # noqa: E402
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length=None):
+        return list(self.docs)
+
+
+class FakeCollection:
+    """Records writes; aggregate returns the canned pipeline result"""
+
+    def __init__(self, aggregated=None, referenced=()):
+        self.aggregated = aggregated or []
+        self.referenced = set(referenced)
+        self.indexes = {"_id_": {}, "phone_1_role_1": {"key": [("phone", 1), ("role", 1)]}}
+        self.writes = []
+
+    def aggregate(self, pipeline):
+        return FakeCursor(self.aggregated)
+
+    def find(self, query, projection=None):
+        return FakeCursor(self.aggregated)
+
+    async def update_many(self, query, update):
+        self.writes.append(("update_many", query, update))
+        return type("Result", (), {"modified_count": len(self.aggregated)})()
+
+    async def insert_many(self, docs):
+        self.writes.append(("insert_many", docs))
+
+    async def delete_many(self, query):
+        self.writes.append(("delete_many", query))
+        return type("Result", (), {"deleted_count": len(query["id"]["$in"])})()
+
+    async def distinct(self, field, query):
+        return [value for value in query[field]["$in"] if value in self.referenced]
+
+    async def index_information(self):
+        return self.indexes
+
+    async def drop_index(self, name):
+        self.writes.append(("drop_index", name))
+
+    async def create_index(self, keys, **kwargs):
+        self.writes.append(("create_index", kwargs.get("name") or "_".join(f"{field}_{order}" for field, order in keys)))
+
+
+class FakeDB:
+    def __init__(self, trips=None, users=None, archived_trips=None):
+        self.trips = trips or FakeCollection()
+        self.users = users or FakeCollection()
+        self.notifications = FakeCollection()
+        self.driver_finances = FakeCollection()
+        self.notification_reads = FakeCollection()
+        self.archive = archived_trips or FakeCollection()
+
+    def __getitem__(self, name):
+        assert name == migrate.ARCHIVE_COLLECTION
+        return self.archive
+
+
+def duplicate_trips():
+    return FakeCollection([{
+        "_id": "passenger-1",
+        "count": 3,
+        "trips": [
+            {"id": "old-pending", "status": "pending", "created_at": "2024-01-01T08:00:00+00:00"},
+            {"id": "accepted", "status": "accepted", "created_at": "2024-01-01T09:00:00+00:00"},
+            {"id": "new-pending", "status": "pending", "created_at": "2024-01-01T10:00:00+00:00"},
+        ],
+    }])
+
+
+def test_active_trips_dry_run_writes_nothing():
+    db = FakeDB(duplicate_trips())
+    plan = asyncio.run(migrate.migrate_active_trips(db))
+    assert plan == [{"passenger_id": "passenger-1", "keep": "accepted", "cancel": ["new-pending", "old-pending"]}]
+    assert db.trips.writes == []
+    assert db.notifications.writes == []
+
+
+def test_active_trips_apply_cancels_notifies_and_indexes():
+    db = FakeDB(duplicate_trips())
+    asyncio.run(migrate.migrate_active_trips(db, apply=True))
+    update = db.trips.writes[0]
+    assert update[1]["id"] == {"$in": ["new-pending", "old-pending"]}
+    assert update[2]["$set"]["cancel_reason"] == "duplicate"
+    assert db.trips.writes[-1] == ("create_index", "one_active_trip_per_passenger")
+    notification = db.notifications.writes[0][1][0]
+    assert notification["user_id"] == "passenger-1"
+    assert notification["role"] == "passenger"
+
+
+def duplicate_users():
+    return FakeCollection([{
+        "_id": {"phone": "0700000000", "role": "passenger"},
+        "count": 3,
+        "users": [
+            {"id": "newest", "created_at": "2024-03-01T00:00:00+00:00"},
+            {"id": "oldest", "created_at": "2024-01-01T00:00:00+00:00"},
+            {"id": "archived-rider", "created_at": "2024-02-01T00:00:00+00:00"},
+        ],
+    }])
+
+
+def test_users_dry_run_reports_history():
+    db = FakeDB(users=duplicate_users(), archived_trips=FakeCollection(referenced=["archived-rider"]))
+    plan = asyncio.run(migrate.migrate_users(db))
+    assert plan == [{
+        "phone": "0700000000", "role": "passenger",
+        "keep": "oldest", "delete": ["newest"], "merge": ["archived-rider"],
+    }]
+    assert db.users.writes == []
+
+
+def test_users_apply_keeps_index_until_merged():
+    db = FakeDB(users=duplicate_users(), archived_trips=FakeCollection(referenced=["archived-rider"]))
+    asyncio.run(migrate.migrate_users(db, apply=True))
+    assert db.users.writes == [("delete_many", {"id": {"$in": ["newest"]}})]
+
+
+def test_users_apply_replaces_non_unique_index():
+    db = FakeDB(users=duplicate_users())
+    asyncio.run(migrate.migrate_users(db, apply=True))
+    assert db.users.writes == [
+        ("delete_many", {"id": {"$in": ["archived-rider", "newest"]}}),
+        ("drop_index", "phone_1_role_1"),
+        ("create_index", "phone_1_role_1"),
+    ]
+
+
+def test_read_cursors_in_the_future_are_reset():
+    db = FakeDB()
+    db.notification_reads = FakeCollection([{"user_id": "u1", "last_read_at": "z"}])
+    assert asyncio.run(migrate.migrate_read_cursors(db)) == [{"user_id": "u1", "last_read_at": "z"}]
+    assert db.notification_reads.writes == []
+
+    asyncio.run(migrate.migrate_read_cursors(db, apply=True))
+    _, query, update = db.notification_reads.writes[0]
+    assert update["$set"]["last_read_at"] == query["last_read_at"]["$gt"]
@@ -0,0 +1,39 @@
+"""
+Notification inbox and read cursor (server notification endpoints)
+"""
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_notifications")
+
+import server  # noqa: E402
+
+
+class FakeUsers:
+    def __init__(self, *docs):
+        self.docs = {doc["id"]: doc for doc in docs}
+
+    async def find_one(self, query, projection=None):
+        return self.docs.get(query["id"])
+
+
+class FakeDB:
+    def __init__(self, users):
+        self.users = users
+
+
+def test_inbox_role_comes_from_user_record(monkeypatch):
+    monkeypatch.setattr(server, "db", FakeDB(FakeUsers({"id": "driver-1", "role": "driver"})))
+    query = asyncio.run(server.notification_inbox_filter("driver-1"))
+    assert query["$or"][1] == {"user_id": None, "role": {"$in": [None, "driver"]}}
+
+
+def test_inbox_of_unknown_user_gets_only_global_broadcasts(monkeypatch):
+    monkeypatch.setattr(server, "db", FakeDB(FakeUsers()))
+    query = asyncio.run(server.notification_inbox_filter("ghost"))
+    assert query["$or"] == [{"user_id": "ghost"}, {"user_id": None, "role": {"$in": [None, None]}}]
@@ -0,0 +1,120 @@
+"""
+Token-bucket rate limits and admission control (backend/rate_limit.py)
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import rate_limit  # noqa: E402
+from rate_limit import AdmissionController, MemoryBackend, RateLimit, RateLimiter  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, "time", SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def make_request(path="/api/rides", client="10.0.0.1", headers=(), path_params=None):
+    return Request({
+        "type": "http",
+        "method": "GET",
+        "scheme": "http",
+        "server": ("testserver", 80),
+        "path": path,
+        "query_string": b"",
+        "headers": [(name.encode(), value.encode()) for name, value in headers],
+        "client": (client, 1234),
+        "path_params": path_params or {},
+    })
+
+
+def test_parse_rate_limit_spec():
+    limit = RateLimit.parse("10/60")
+    assert (limit.burst, limit.per_second) == (10, pytest.approx(10 / 60))
+    assert RateLimit.parse("5").per_second == 5
+    assert RateLimit.parse("0") is None
+    assert RateLimit.parse("") is None
+    scaled = limit.scaled(0.01)
+    assert scaled.burst == 1
+
+
+def test_bucket_allows_burst_then_refills(clock):
+    backend = MemoryBackend()
+    limit = RateLimit(burst=2, per_second=1)
+    take = lambda: asyncio.run(backend.take("k", limit))  # noqa: E731
+    assert take() == 0
+    assert take() == 0
+    assert take() == pytest.approx(1.0)
+    clock.now += 0.5
+    assert take() == pytest.approx(0.5)
+    clock.now += 0.5
+    assert take() == 0
+
+
+def test_ip_bucket_is_looser_next_to_user_bucket(clock):
+    limiter = RateLimiter(MemoryBackend(), ip_multiplier=3)
+    limit = RateLimit(burst=1, per_second=0.001)
+    # Different users behind one IP share the IP bucket of 3
+    waits = [asyncio.run(limiter.retry_after("login", limit, ip="1.1.1.1", user=f"u{i}")) for i in range(4)]
+    assert [bool(wait) for wait in waits] == [False, False, False, True]
+    assert asyncio.run(limiter.retry_after("login", limit, ip="2.2.2.2", user="u0")) > 0
+    assert limiter.stats == {"allowed": 3, "limited": 2}
+
+
+def test_forwarded_for_only_when_trusted():
+    request = make_request(headers=[("x-forwarded-for", "203.0.113.9, 10.0.0.2")])
+    assert RateLimiter(MemoryBackend()).client_ip(request) == "10.0.0.1"
+    assert RateLimiter(MemoryBackend(), trust_forwarded=True).client_ip(request) == "203.0.113.9"
+
+
+def test_dependency_raises_429_with_retry_after(clock):
+    limiter = RateLimiter(MemoryBackend())
+    check = limiter.dependency("ride", RateLimit(burst=1, per_second=0.5), user_param="passenger_id")
+    request = make_request(path_params={"passenger_id": "p1"})
+    asyncio.run(check(request))
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(check(request))
+    assert error.value.status_code == 429
+    assert error.value.headers == {"Retry-After": "2"}
+    asyncio.run(limiter.dependency("ride", None)(request))  # disabled limit
+
+
+def test_admission_sheds_when_busy_or_lagging():
+    lag = {"ms": 0.0}
+    controller = AdmissionController(1, 100, lambda: lag["ms"], exempt_prefixes=["/api/health"])
+
+    async def call_next(request):
+        # A second request while this one is in flight is shed
+        nested = await controller.dispatch(make_request(), lambda r: None)
+        return nested
+
+    shed = asyncio.run(controller.dispatch(make_request(), call_next))
+    assert shed.status_code == 503
+    assert controller.in_flight == 0
+
+    lag["ms"] = 500
+
+    async def ok(request):
+        return "ok"
+
+    assert asyncio.run(controller.dispatch(make_request(), ok)).status_code == 503
+    assert asyncio.run(controller.dispatch(make_request(path="/api/health/ready"), ok)) == "ok"
+    assert controller.stats == {"admitted": 1, "shed_in_flight": 1, "shed_loop_lag": 1}
@@ -0,0 +1,78 @@
+"""
+In-process timeout scheduler (backend/scheduler.py)
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+from scheduler import TimeoutScheduler  # noqa: E402
+
+
+def recorder(calls, name):
+    async def callback():
+        calls.append(name)
+    return callback
+
+
+def test_due_timers_pop_in_deadline_order():
+    scheduler = TimeoutScheduler()
+    calls = []
+    scheduler.schedule("late", 30.0, recorder(calls, "late"))
+    scheduler.schedule("early", 10.0, recorder(calls, "early"))
+    scheduler.schedule("future", 100.0, recorder(calls, "future"))
+    for callback in scheduler._pop_due(now=50.0):
+        asyncio.run(callback())
+    assert calls == ["early", "late"]
+    assert len(scheduler) == 1
+
+
+def test_rescheduling_replaces_the_timer():
+    scheduler = TimeoutScheduler()
+    calls = []
+    scheduler.schedule("trip", 10.0, recorder(calls, "first"))
+    scheduler.schedule("trip", 20.0, recorder(calls, "second"))
+    assert len(scheduler) == 1
+    assert scheduler._pop_due(now=15.0) == []
+    for callback in scheduler._pop_due(now=25.0):
+        asyncio.run(callback())
+    assert calls == ["second"]
+
+
+def test_cancelled_timer_never_fires():
+    scheduler = TimeoutScheduler()
+    scheduler.schedule("trip", 10.0, recorder([], "x"))
+    scheduler.cancel("trip")
+    scheduler.cancel("unknown")
+    assert scheduler._pop_due(now=20.0) == []
+    assert len(scheduler) == 0
+    assert scheduler._heap == []
+
+
+def test_overdue_counts_only_live_timers_past_grace():
+    scheduler = TimeoutScheduler()
+    now = time.time()
+    scheduler.schedule("overdue", now - 60, recorder([], "a"))
+    scheduler.schedule("within-grace", now - 1, recorder([], "b"))
+    scheduler.schedule("cancelled", now - 60, recorder([], "c"))
+    scheduler.cancel("cancelled")
+    scheduler.schedule("future", now + 60, recorder([], "d"))
+    assert scheduler.overdue(grace_seconds=5) == 1
+
+
+def test_running_scheduler_fires_callbacks():
+    calls = []
+
+    async def main():
+        scheduler = TimeoutScheduler()
+        scheduler.start()
+        scheduler.schedule("later", time.time() + 60, recorder(calls, "later"))
+        scheduler.schedule("soon", time.time() + 0.05, recorder(calls, "soon"))
+        await asyncio.sleep(0.2)
+        await scheduler.stop()
+
+    asyncio.run(main())
+    assert calls == ["soon"]
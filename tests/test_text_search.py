@@ -0,0 +1,52 @@
+"""
+Name/phone normalisation for indexed user search (backend/text_search.py)
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+from text_search import (  # noqa: E402
+    MAX_PREFIX_LENGTH, build_search_query, name_prefixes, normalize_text, phone_digits, user_search_fields,
+)
+
+
+def test_arabic_letter_variants_fold_to_persian():
+    assert normalize_text("علي كريمي") == normalize_text("علی کریمی")
+    assert normalize_text("فاطمة") == "فاطمه"
+
+
+def test_diacritics_zwnj_punctuation_and_case():
+    assert normalize_text("مُحَمَّد") == "محمد"
+    assert normalize_text("عبد‌الله") == "عبد الله"
+    assert normalize_text("  Ali-Reza  AHMADI! ") == "ali reza ahmadi"
+    assert normalize_text(None) == ""
+
+
+def test_phone_digits_converts_persian_digits():
+    assert phone_digits("+93 (۰۷۰) ۱۲۳-۴۵۶۷") == "930701234567"
+    assert phone_digits(None) == ""
+
+
+def test_name_prefixes_cover_every_word():
+    assert name_prefixes("Ali Bo") == ["a", "al", "ali", "b", "bo"]
+    long_word = "x" * (MAX_PREFIX_LENGTH + 5)
+    assert max(len(prefix) for prefix in name_prefixes(long_word)) == MAX_PREFIX_LENGTH
+
+
+def test_user_search_fields_only_for_given_values():
+    assert user_search_fields() == {}
+    assert user_search_fields(phone="0700 123") == {"phone_digits": "0700123"}
+    assert user_search_fields(name="Al")["search_prefixes"] == ["a", "al"]
+
+
+def test_phone_query_is_anchored_prefix():
+    assert build_search_query("۰۷۰ 12") == {"phone_digits": {"$regex": "^07012"}}
+
+
+def test_name_query_matches_all_word_prefixes():
+    assert build_search_query("علي Kar") == {"search_prefixes": {"$all": ["علی", "kar"]}}
+    query = build_search_query("y" * 40)
+    assert query == {"search_prefixes": {"$all": ["y" * MAX_PREFIX_LENGTH]}}
+    assert build_search_query("  !? ") is None
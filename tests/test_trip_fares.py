@@ -0,0 +1,225 @@
+"""
+Final fares from the recorded GPS trace (backend/gps_traces.py, server.finalize_trip_fare)
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_trip_fares")
+
+import gps_traces  # noqa: E402
+import server  # noqa: E402
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    async def to_list(self, length=None):
+        return list(self.docs)
+
+
+class FakeCollection:
+    def __init__(self, docs=None):
+        self.docs = list(docs or [])
+        self.updates = []
+
+    def find(self, *args, **kwargs):
+        return FakeCursor(self.docs)
+
+    async def find_one(self, *args, **kwargs):
+        return self.docs[0] if self.docs else None
+
+    async def insert_one(self, doc):
+        self.docs.append(doc)
+
+    async def update_one(self, query, update):
+        self.updates.append((query, update))
+
+
+class FakeDB:
+    def __init__(self, **collections):
+        self.collections = {name: FakeCollection(docs) for name, docs in collections.items()}
+
+    def __getattr__(self, name):
+        return self.collections.setdefault(name, FakeCollection())
+
+
+def completed_trip(ride_seconds=600, price=99.0):
+    started_at = datetime.now(timezone.utc) - timedelta(seconds=ride_seconds)
+    return {
+        "id": "trip-1",
+        "driver_id": "driver-1",
+        "price": price,
+        "started_at": started_at.isoformat(),
+        "completed_at": (started_at + timedelta(seconds=ride_seconds)).isoformat(),
+    }
+
+
+def trace_measure(distance_km, elapsed_seconds, points=100):
+    measure = gps_traces.TraceDistance()
+    measure.meters = distance_km * 1000
+    measure.points = points
+    measure.first_ts = 0.0
+    measure.last = (0.0, 0.0, float(elapsed_seconds))
+    return measure
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    db = FakeDB(pricing_config=[{"id": "pricing_config", "base_fare": 20, "per_km": 10, "per_minute": 2}])
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "FARE_FROM_TRACE", True)
+    return db
+
+
+@pytest.fixture
+def published_fares(monkeypatch):
+    fares = []
+
+    async def publish_trip_fare(trip):
+        fares.append(trip)
+
+    monkeypatch.setattr(server.admin_feed, "change_stream_active", False)
+    monkeypatch.setattr(server.admin_feed, "publish_trip_fare", publish_trip_fare)
+    return fares
+
+
+# ----------- TraceDistance -----------
+
+def test_trace_distance_sums_segments_and_time():
+    measure = gps_traces.TraceDistance()
+    for i in range(11):
+        measure.add(34.5 + i * 0.001, 69.1, 1000.0 + i * 10)
+    expected_km = gps_traces.haversine_m(34.5, 69.1, 34.51, 69.1) / 1000
+    assert measure.distance_km == pytest.approx(expected_km, rel=1e-6)
+    assert measure.points == 11
+    assert measure.elapsed_seconds == 100
+
+
+def test_trace_distance_skips_gps_spikes():
+    measure = gps_traces.TraceDistance(max_speed_kmh=200)
+    measure.add(34.5, 69.1, 0)
+    measure.add(40.0, 69.1, 1)  # ~600 km in one second
+    measure.add(34.501, 69.1, 10)
+    assert measure.skipped == 1
+    assert measure.points == 2
+    assert measure.distance_km == pytest.approx(0.111, abs=0.001)
+
+
+def test_trace_distance_empty():
+    measure = gps_traces.TraceDistance()
+    assert measure.distance_km == 0
+    assert measure.elapsed_seconds == 0
+
+
+# ----------- calculate_trip_price -----------
+
+def test_price_adds_per_minute_rate(fake_db):
+    assert asyncio.run(server.calculate_trip_price(5)) == 70
+    assert asyncio.run(server.calculate_trip_price(5, duration_minutes=10)) == 90
+
+
+def test_price_from_fare_ranges_adds_per_minute_rate(fake_db):
+    fake_db.collections["fare_ranges"] = FakeCollection([{"min_km": 0, "max_km": 10, "rate_per_km": 15}])
+    assert asyncio.run(server.calculate_trip_price(4)) == 60
+    assert asyncio.run(server.calculate_trip_price(4, duration_minutes=5)) == 70
+
+
+# ----------- finalize_trip_fare -----------
+
+def test_fare_from_trace(fake_db, published_fares, monkeypatch):
+    async def measure(*args, **kwargs):
+        return trace_measure(distance_km=3, elapsed_seconds=590)
+
+    monkeypatch.setattr(server, "measure_trip", measure)
+    trip = asyncio.run(server.finalize_trip_fare(completed_trip(ride_seconds=600)))
+    assert trip["fare_source"] == "trace"
+    assert trip["price"] == 20 + 3 * 10 + 10 * 2
+    assert trip["quoted_price"] == 99.0
+    assert fake_db.trips.updates[-1][1]["$set"]["price"] == trip["price"]
+    # The admin dashboard counts the final fare, not the quote
+    assert [fare["price"] for fare in published_fares] == [trip["price"]]
+
+
+def test_sparse_trace_keeps_quote(fake_db, published_fares, monkeypatch):
+    async def measure(*args, **kwargs):
+        return trace_measure(distance_km=1, elapsed_seconds=60)
+
+    monkeypatch.setattr(server, "measure_trip", measure)
+    trip = asyncio.run(server.finalize_trip_fare(completed_trip(ride_seconds=600)))
+    assert trip["fare_source"] == "quote"
+    assert trip["price"] == 99.0
+    assert [fare["price"] for fare in published_fares] == [99.0]
+
+
+def test_trace_error_keeps_quote(fake_db, published_fares, monkeypatch):
+    async def measure(*args, **kwargs):
+        raise TypeError("must be real number, not str")
+
+    monkeypatch.setattr(server, "measure_trip", measure)
+    trip = asyncio.run(server.finalize_trip_fare(completed_trip()))
+    assert trip["fare_source"] == "quote"
+    assert trip["price"] == 99.0
+    assert fake_db.trips.updates[-1][1] == {"$set": {"fare_source": "quote"}}
+
+
+def test_slow_trace_keeps_quote(fake_db, published_fares, monkeypatch):
+    async def measure(*args, **kwargs):
+        await asyncio.sleep(5)
+
+    monkeypatch.setattr(server, "measure_trip", measure)
+    monkeypatch.setattr(server, "FARE_TRACE_TIMEOUT_SECONDS", 0.05)
+    trip = asyncio.run(server.finalize_trip_fare(completed_trip()))
+    assert trip["fare_source"] == "quote"
+
+
+def test_trip_without_pickup_keeps_quote(fake_db, published_fares, monkeypatch):
+    async def measure(*args, **kwargs):
+        raise AssertionError("not measured")
+
+    monkeypatch.setattr(server, "measure_trip", measure)
+    trip = completed_trip()
+    del trip["started_at"]
+    assert asyncio.run(server.finalize_trip_fare(trip))["fare_source"] == "quote"
+
+
+def test_measure_trip_includes_buffered_pings():
+    class TraceCursor:
+        def __init__(self, docs):
+            self.docs = docs
+
+        def sort(self, *args):
+            return self
+
+        def batch_size(self, size):
+            return self
+
+        async def __aiter__(self):
+            for doc in self.docs:
+                yield doc
+
+    trip = completed_trip(ride_seconds=60)
+    start = datetime.fromisoformat(trip["started_at"])
+    stored = [{"lat": 34.5, "lng": 69.1, "ts": start + timedelta(seconds=1)}]
+    trace_db = {gps_traces.TRACE_COLLECTION: type("Traces", (), {"find": lambda self, *a: TraceCursor(stored)})()}
+
+    writer = gps_traces.TraceWriter(trace_db)
+    writer.add("driver-1", 34.501, 69.1, start + timedelta(seconds=30))
+    writer.add("driver-2", 10.0, 10.0, start + timedelta(seconds=30))
+    writer.add("driver-1", 34.6, 69.1, start + timedelta(seconds=600))  # after completion
+
+    measure = asyncio.run(gps_traces.measure_trip(trace_db, trip, buffered=writer.pending("driver-1")))
+    assert measure.points == 2
+    assert measure.elapsed_seconds == 29
+    assert measure.distance_km == pytest.approx(0.111, abs=0.001)
@@ -0,0 +1,116 @@
+"""
+Trip state machine (server.transition_trip and the admin status override)
+"""
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_trip_state")
+
+import server  # noqa: E402
+from server import TripStatus  # noqa: E402
+
+
+def matches(doc, query):
+    for field, condition in query.items():
+        value = doc.get(field)
+        if isinstance(condition, dict):
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+            if "$nin" in condition and value in condition["$nin"]:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeTrips:
+    """Just enough of a Motor collection for transition_trip"""
+
+    def __init__(self, *docs):
+        self.docs = [dict(doc) for doc in docs]
+
+    async def find_one(self, query, projection=None):
+        return next((dict(doc) for doc in self.docs if matches(doc, query)), None)
+
+    async def find_one_and_update(self, query, update, projection=None, return_document=None):
+        for doc in self.docs:
+            if matches(doc, query):
+                doc.update(update["$set"])
+                return dict(doc)
+        return None
+
+
+class FakeDB:
+    def __init__(self, trips):
+        self.trips = trips
+
+
+@pytest.fixture
+def trips(monkeypatch):
+    collection = FakeTrips(
+        {"id": "pending", "status": TripStatus.PENDING, "driver_id": None},
+        {"id": "accepted", "status": TripStatus.ACCEPTED, "driver_id": "driver-1"},
+        {"id": "driverless", "status": TripStatus.ACCEPTED, "driver_id": None},
+    )
+    monkeypatch.setattr(server, "db", FakeDB(collection))
+    monkeypatch.setattr(server.admin_feed, "change_stream_active", True)
+
+    async def no_feed(trip):
+        pass
+
+    monkeypatch.setattr(server, "publish_trip_feed_remove", no_feed)
+    return collection
+
+
+def test_allowed_prior_statuses():
+    assert server.allowed_prior_statuses(TripStatus.ACCEPTED) == [TripStatus.PENDING]
+    assert server.allowed_prior_statuses(TripStatus.COMPLETED) == [TripStatus.IN_PROGRESS]
+    assert set(server.allowed_prior_statuses(TripStatus.CANCELLED)) == set(server.ACTIVE_TRIP_STATUSES)
+    assert server.allowed_prior_statuses(TripStatus.PENDING) == []
+
+
+def test_transition_applies_once(trips):
+    trip = asyncio.run(server.transition_trip("accepted", TripStatus.IN_PROGRESS))
+    assert trip["status"] == TripStatus.IN_PROGRESS
+    assert "started_at" in trip
+    assert asyncio.run(server.transition_trip("accepted", TripStatus.IN_PROGRESS)) is None
+
+
+def test_illegal_transition_is_rejected(trips):
+    assert asyncio.run(server.transition_trip("pending", TripStatus.COMPLETED)) is None
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.raise_transition_error("pending", TripStatus.COMPLETED))
+    assert error.value.status_code == 400
+
+
+def test_admin_cannot_accept_without_driver(trips):
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.admin_update_trip_status("pending", TripStatus.ACCEPTED, admin={"id": "a", "name": "A"}))
+    assert error.value.status_code == 400
+    assert trips.docs[0]["status"] == TripStatus.PENDING
+
+    with pytest.raises(HTTPException):
+        asyncio.run(server.admin_update_trip_status("driverless", TripStatus.IN_PROGRESS, admin={"id": "a", "name": "A"}))
+    assert trips.docs[2]["status"] == TripStatus.ACCEPTED
+
+
+def test_admin_moves_trip_with_driver(trips, monkeypatch):
+    async def log_admin_activity(**kwargs):
+        pass
+
+    monkeypatch.setattr(server, "log_admin_activity", log_admin_activity)
+    trips.docs[1].update({
+        "passenger_id": "p", "passenger_name": "P", "passenger_phone": "1", "price": 50,
+        "origin": {"lat": 1, "lng": 1}, "destination": {"lat": 2, "lng": 2},
+        "created_at": "2024-01-01T00:00:00+00:00",
+    })
+    response = asyncio.run(server.admin_update_trip_status("accepted", TripStatus.IN_PROGRESS, admin={"id": "a", "name": "A"}))
+    assert response["trip"].status == TripStatus.IN_PROGRESS